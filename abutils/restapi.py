@@ -0,0 +1,91 @@
+# Standard
+from collections import defaultdict
+from typing import Dict, List
+
+# Third Party
+from django.db import transaction, DatabaseError
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+
+# Local
+
+__author__ = 'Adrian'
+
+# Per-item outcomes of a bulk upsert. These are also the ETL's progress characters.
+OUTCOME_ADDED = "+"
+OUTCOME_UPDATED = "U"
+OUTCOME_UNCHANGED = "="
+OUTCOME_PROTECTED = "P"
+OUTCOME_ERROR = "E"
+
+
+def has_new_data(older: dict, newer: dict) -> bool:
+    """True if newer, a serialized item, has a non-null value that differs from the one in older."""
+    for newkey, newval in newer.items():
+        if newkey in ['id', 'protected']: continue
+        if newval is None: continue
+        if newkey not in older: return True
+        elif older[newkey] != newer[newkey]: return True
+    return False
+
+
+class BulkUpsertMixin(object):
+    """
+    Adds a bulk-upsert/ route to a ModelViewSet for a model with the ETL fields, ctrlid and protected.
+    It takes a list of serialized items and adds or updates each, identified by its ctrlid. Protected items are
+    left alone. The response lists the outcome of each item, in order, with the item's data as now stored,
+    or with the errors if it couldn't be stored.
+    """
+
+    bulk_upsert_max = 1000  # The most items accepted in a single request.
+
+    @action(detail=False, methods=['post'], url_path='bulk-upsert')
+    def bulk_upsert(self, request):
+        items = request.data
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            return Response({'detail': "Expected a list of items."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > self.bulk_upsert_max:
+            return Response(
+                {'detail': "At most {} items can be upserted at once.".format(self.bulk_upsert_max)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        matches = defaultdict(list)  # type: Dict[str, List]
+        for obj in self.get_queryset().filter(ctrlid__in=[item.get('ctrlid') for item in items]):
+            matches[obj.ctrlid].append(obj)
+
+        results = [self._upsert_one(item, matches[item.get('ctrlid')]) for item in items]
+        return Response({'results': results})
+
+    def _upsert_one(self, item: dict, matches: list) -> dict:
+        """matches are the stored items with the item's ctrlid. An item that's added is appended to them."""
+        ctrlid = item.get('ctrlid')
+        if ctrlid is None:
+            return {'ctrlid': None, 'outcome': OUTCOME_ERROR, 'data': {'ctrlid': ["This field is required."]}}
+        if len(matches) > 1:
+            return {'ctrlid': ctrlid, 'outcome': OUTCOME_ERROR, 'data': {'ctrlid': ["Too many matches."]}}
+
+        if len(matches) == 0:
+            serializer = self.get_serializer(data=item)
+            outcome = OUTCOME_ADDED
+        else:
+            current = self.get_serializer(matches[0]).data
+            if current['protected']:
+                return {'ctrlid': ctrlid, 'outcome': OUTCOME_PROTECTED, 'data': current}
+            if not has_new_data(current, item):
+                return {'ctrlid': ctrlid, 'outcome': OUTCOME_UNCHANGED, 'data': current}
+            serializer = self.get_serializer(matches[0], data=item)
+            outcome = OUTCOME_UPDATED
+
+        if not serializer.is_valid():
+            return {'ctrlid': ctrlid, 'outcome': OUTCOME_ERROR, 'data': serializer.errors}
+        try:
+            # Each item gets its own savepoint so that one that fails doesn't undo the others.
+            with transaction.atomic():
+                serializer.save()
+        except DatabaseError as e:
+            return {'ctrlid': ctrlid, 'outcome': OUTCOME_ERROR, 'data': {'non_field_errors': [str(e)]}}
+        if outcome == OUTCOME_ADDED:
+            matches.append(serializer.instance)  # So a later item with the same ctrlid updates this one.
+        return {'ctrlid': ctrlid, 'outcome': outcome, 'data': serializer.data}
@@ -0,0 +1,8 @@
+# Third Party
+from django.dispatch import Signal
+
+__author__ = 'Adrian'
+
+# Sent after objects are written with bulk_create, bulk_update, update(), or COPY, which don't send post_save.
+# The sender is the model. Receivers get "objs", a list of the objects that were written, each with its pk.
+objects_saved_in_bulk = Signal(providing_args=["objs"])
@@ -1,10 +1,12 @@
 # Standard
 from datetime import date, time, timedelta, datetime
 from decimal import Decimal
+from typing import List, Optional
 import calendar
 
 # Third-Party
 from nptime import nptime
+import numpy as np
 
 # Local
 
@@ -58,47 +60,128 @@ def ordinals_of_month_str(obj) -> str:
         )
 
 
-# REVIEW: There are a few classes that have this form. Make an ABC?
-def matches_weekday_of_month_pattern(pattern, d: date) -> bool:
+# Field names on weekday-of-month patterns, e.g. RecurringTaskTemplate. Some models use plural day names.
+WEEKDAY_FIELDS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']  # date.weekday() order
+ORDINAL_FIELDS = ['first', 'second', 'third', 'fourth']
+MONTH_FIELDS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+ALL_WEEKDAYS = 0b1111111
+ALL_MONTHS = 0b111111111111
+EVERY_OCCURRENCE = 0b11111  # A weekday occurs at most 5 times in a month.
+LAST_OCCURRENCE = 0b100000
+
+
+class WeekdayOfMonthPattern(object):
+    """
+    A weekday-of-month pattern (e.g. "1st and 3rd Tuesdays in Jan thru Jun") compiled into bitmasks.
+    Bit n of weekdays is date.weekday() == n. Bit n of ordinals is the (n+1)th occurrence of the weekday
+    in the month, and LAST_OCCURRENCE is the last one. Bit n of months is month n+1.
+    """
+
+    def __init__(self, weekdays: int, ordinals: int, months: int = ALL_MONTHS):
+        self.weekdays = weekdays
+        self.ordinals = ordinals
+        self.months = months
+
+    @classmethod
+    def from_fields(cls, obj) -> 'WeekdayOfMonthPattern':
+        """
+        Compile the pattern from the boolean fields of obj, e.g. a RecurringTaskTemplate or TimeBlock.
+        Objects without month fields match every month.
+        """
+        suffix = "s" if hasattr(obj, 'sundays') else ""  # As in days_of_week_str
+        weekdays = 0
+        for n, name in enumerate(WEEKDAY_FIELDS):
+            if getattr(obj, name + suffix):
+                weekdays |= 1 << n
+        if obj.every:
+            ordinals = EVERY_OCCURRENCE
+        else:
+            ordinals = LAST_OCCURRENCE if obj.last else 0
+            for n, name in enumerate(ORDINAL_FIELDS):
+                if getattr(obj, name):
+                    ordinals |= 1 << n
+        months = ALL_MONTHS
+        if hasattr(obj, MONTH_FIELDS[0]):
+            months = 0
+            for n, name in enumerate(MONTH_FIELDS):
+                if getattr(obj, name):
+                    months |= 1 << n
+        return cls(weekdays, ordinals, months)
+
+    @property
+    def is_empty(self) -> bool:
+        return self.weekdays == 0 or self.ordinals == 0 or self.months == 0
+
+    def matches(self, d: date) -> bool:
+        if not (self.months >> (d.month-1)) & 1:
+            return False
+        if not (self.weekdays >> d.weekday()) & 1:
+            return False
+        if (self.ordinals >> ((d.day-1) // 7)) & 1:
+            return True
+        return bool(self.ordinals & LAST_OCCURRENCE) and d.day + 7 > calendar.monthrange(d.year, d.month)[1]
+
+    def matching_dates(self, start: date, end: date) -> List[date]:
+        """All the dates from start to end (inclusive) that match, computed over the whole range at once."""
+        if end < start or self.is_empty:
+            return []
+        days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+        months = days.astype('datetime64[M]')
+        month_starts = months.astype('datetime64[D]')
+        day_of_month = (days - month_starts).astype(int) + 1
+        month_length = ((months + 1).astype('datetime64[D]') - month_starts).astype(int)
+        weekday = (days.astype(int) + 3) % 7  # 1970-01-01 was a Thursday.
+        month_index = months.astype(int) % 12
+
+        is_match = ((self.months >> month_index) & 1).astype(bool)
+        is_match &= ((self.weekdays >> weekday) & 1).astype(bool)
+        ordinal_match = ((self.ordinals >> ((day_of_month-1) // 7)) & 1).astype(bool)
+        if self.ordinals & LAST_OCCURRENCE:
+            ordinal_match |= day_of_month + 7 > month_length
+        is_match &= ordinal_match
+        return days[is_match].tolist()
+
+    def next_occurrence(self, after: date) -> Optional[date]:
+        """The first matching date after the given one, or None if the pattern never matches."""
+        if self.is_empty:
+            return None
+        # Every weekday has a 1st thru 4th and a last occurrence in every month, so a match is always within a year.
+        dates = self.matching_dates(after + timedelta(days=1), after + timedelta(days=400))
+        return dates[0] if len(dates) > 0 else None
+
+
+class WeekdayOfMonthPatternMixin(object):
+    """
+    For models that have weekday-of-month pattern fields. The pattern is compiled the first time
+    it's needed and cached on the instance until the instance is saved or refreshed.
+    """
+
+    @property
+    def weekday_of_month_pattern(self) -> WeekdayOfMonthPattern:
+        compiled = self.__dict__.get('_compiled_wom_pattern')
+        if compiled is None:
+            compiled = WeekdayOfMonthPattern.from_fields(self)
+            self.__dict__['_compiled_wom_pattern'] = compiled
+        return compiled
+
+    def save(self, *args, **kwargs):
+        self.__dict__.pop('_compiled_wom_pattern', None)
+        super().save(*args, **kwargs)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.__dict__.pop('_compiled_wom_pattern', None)
+        super().refresh_from_db(*args, **kwargs)
 
-    def nth_xday(d):
-        """ Return a value which indicates that date d is the nth <x>day of the month. """
-        dom_num = d.day
-        ord_num = 1
-        while dom_num > 7:
-            dom_num -= 7
-            ord_num += 1
-        return ord_num
-
-    def is_last_xday(d):
-        """ Return a value which indicates whether date d is the LAST <x>day of the month. """
-        month = d.month
-        d += timedelta(weeks=+1)
-        return d.month != month  # Don't use gt because 1 is not gt 12
-
-    dow_num = d.weekday()  # day-of-week number
-    day_matches = (dow_num == 0 and pattern.monday) \
-        or (dow_num == 1 and pattern.tuesday) \
-        or (dow_num == 2 and pattern.wednesday) \
-        or (dow_num == 3 and pattern.thursday) \
-        or (dow_num == 4 and pattern.friday) \
-        or (dow_num == 5 and pattern.saturday) \
-        or (dow_num == 6 and pattern.sunday)
-    if not day_matches:
-        return False  # Doesn't match template if day-of-week doesn't match.
-    if pattern.every:
-        return True  # Does match if it happens every week and the day-of-week matches.
-    if is_last_xday(d) and pattern.last:
-        return True  # Check for last <x>day match.
-
-    # Otherwise, figure out the ordinal and see if we match it.
-    ord_num = nth_xday(d)
-    ordinal_matches = (ord_num == 1 and pattern.first) \
-        or (ord_num == 2 and pattern.second) \
-        or (ord_num == 3 and pattern.third) \
-        or (ord_num == 4 and pattern.fourth)
-
-    return ordinal_matches
+
+def matches_weekday_of_month_pattern(pattern, d: date) -> bool:
+    """
+    True if d matches pattern's days of week and weeks of month. Use a compiled WeekdayOfMonthPattern
+    instead when checking more than one date.
+    """
+    compiled = WeekdayOfMonthPattern.from_fields(pattern)
+    compiled.months = ALL_MONTHS  # Months have never been part of this check.
+    return compiled.matches(d)
 
 
 def time_in_timespan(test_time: time, spans_start_time: time, spans_duration: timedelta) -> bool:
@@ -0,0 +1,91 @@
+# Standard
+import io
+from abc import ABCMeta, abstractmethod
+from typing import List
+
+# Third Party
+from django.db import connection, models
+
+# Local
+from abutils.signals import objects_saved_in_bulk
+
+__author__ = 'Adrian'
+
+
+class BatchSink(object):
+    """Saves batches of new model instances. Used by the journal generator to write entries and line items."""
+
+    __metaclass__ = ABCMeta
+
+    # The journal generator flushes its batches when they grow beyond this size.
+    batch_size = 1000
+
+    def save(self, model: type, objs: List[models.Model]) -> None:
+        """Insert the given (unsaved) instances of model. On return, each instance has its pk."""
+        if len(objs) == 0:
+            return
+        self.insert(model, objs)
+        objects_saved_in_bulk.send(sender=model, objs=objs)
+
+    @abstractmethod
+    def insert(self, model: type, objs: List[models.Model]) -> None:
+        """Does the work of save(), without sending objects_saved_in_bulk. Never given an empty batch."""
+        raise NotImplementedError
+
+
+class BulkCreateSink(BatchSink):
+    """Saves batches using bulk_create. Works with any backend that returns pks from bulk_create."""
+
+    def insert(self, model: type, objs: List[models.Model]) -> None:
+        model.objects.bulk_create(objs)
+
+
+def _csv_value(value) -> str:
+    # In PostgreSQL's CSV format, an unquoted empty value is NULL and a quoted one is an empty string.
+    if value is None:
+        return ""
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+class PostgresCopySink(BatchSink):
+    """
+    Saves batches by streaming them through PostgreSQL's COPY FROM STDIN, which is much faster than INSERTs.
+    Pks are allocated from the table's sequence beforehand, so instances have them just as with bulk_create.
+    """
+
+    batch_size = 10000
+
+    @staticmethod
+    def _allocate_pks(cursor, model: type, count: int) -> List[int]:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [model._meta.db_table, model._meta.pk.column, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def insert(self, model: type, objs: List[models.Model]) -> None:
+        fields = model._meta.concrete_fields
+        with connection.cursor() as cursor:
+            pks = self._allocate_pks(cursor, model, len(objs))
+            buffer = io.StringIO()
+            for obj, pk in zip(objs, pks):
+                obj.pk = pk
+                # get_db_prep_save does the same conversions, e.g. rounding decimals, that bulk_create would do.
+                values = [f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields]
+                buffer.write(",".join(_csv_value(v) for v in values))
+                buffer.write("\n")
+            buffer.seek(0)
+            columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+            sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                connection.ops.quote_name(model._meta.db_table), columns)
+            cursor.copy_expert(sql, buffer)
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = connection.alias
+
+
+def default_batch_sink() -> BatchSink:
+    if connection.vendor == 'postgresql':
+        return PostgresCopySink()
+    else:
+        return BulkCreateSink()
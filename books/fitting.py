@@ -0,0 +1,59 @@
+# Standard
+from typing import Optional, Sequence
+
+# Third Party
+import numpy as np
+
+# Local
+
+__author__ = 'Adrian'
+
+# Limits the size of the offsets x days matrices built by count_crossings.
+MAX_CELLS_PER_BLOCK = 1000000
+
+
+def count_crossings(bank: Sequence[float], cash: Sequence[float], offsets: Sequence[float]) -> np.ndarray:
+    """
+    For each offset, count how many times the residual bank-(cash+offset) changes sign from one day to the next.
+    Days on which the residual is exactly zero don't count as a crossing on either side.
+    """
+    bs = np.asarray(bank, dtype=float)
+    cs = np.asarray(cash, dtype=float)
+    offsets = np.asarray(offsets, dtype=float)
+    assert bs.shape == cs.shape
+
+    result = np.zeros(len(offsets), dtype=int)
+    block_rows = max(1, MAX_CELLS_PER_BLOCK // max(1, len(bs)))
+    for lo in range(0, len(offsets), block_rows):
+        block = offsets[lo:lo+block_rows]
+        residuals = bs[np.newaxis, :] - (cs[np.newaxis, :] + block[:, np.newaxis])  # offsets x days
+        signs = np.sign(residuals)
+        # A product of adjacent signs is -1 for a crossing, and 0 if either residual is zero.
+        result[lo:lo+block_rows] = np.count_nonzero(signs[:, 1:] * signs[:, :-1] < 0, axis=1)
+    return result
+
+
+def _best_offset(bank, cash, offsets: np.ndarray) -> Optional[float]:
+    crossings = count_crossings(bank, cash, offsets)
+    if len(crossings) == 0 or crossings.max() == 0:
+        return None
+    # There are often runs of offsets with the max crossing count. Take the middle one.
+    best = np.flatnonzero(crossings == crossings.max())
+    return float(offsets[best[len(best)//2]])
+
+
+def fit_offset(bank: Sequence[float], cash: Sequence[float],
+               lo: float = -50000, hi: float = 50000, step: float = 100,
+               fine_step: Optional[float] = 1) -> Optional[float]:
+    """
+    Find the offset that best fits the cash according to our books to the cash according to the bank,
+    i.e. the offset for which bank-(cash+offset) crosses zero the most times. Offsets from lo up to (but
+    not including) hi are tried, step apart. If fine_step is given, a second pass tries offsets fine_step
+    apart within a step of the best one found by the first pass.
+    Returns None if no offset gives any crossings.
+    """
+    best = _best_offset(bank, cash, np.arange(lo, hi, step))
+    if best is None or fine_step is None:
+        return best
+    fine_best = _best_offset(bank, cash, np.arange(best-step, best+step+fine_step, fine_step))
+    return fine_best if fine_best is not None else best
@@ -0,0 +1,100 @@
+# Standard
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import List, Tuple
+
+# Third party
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+# Local
+from books.batchsinks import BatchSink, BulkCreateSink, PostgresCopySink
+from books.models import Account, JournalEntry, JournalEntryLineItem
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Compares the speed of the journal's batch sinks by writing a synthetic ledger. Nothing is kept."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entries', type=int, default=20000,
+            help="The number of synthetic journal entries to write with each sink.")
+        parser.add_argument('--lines', type=int, default=3,
+            help="The number of line items in each synthetic journal entry.")
+
+    @staticmethod
+    def synthetic_ledger(accts: List[Account], entry_count: int, line_count: int) \
+            -> List[Tuple[JournalEntry, List[JournalEntryLineItem]]]:
+        rand = random.Random(0)  # Same ledger for every sink.
+        ledger = []
+        first_day = date(2015, 1, 1)
+        for n in range(entry_count):
+            je = JournalEntry(
+                when=first_day + timedelta(days=rand.randrange(3650)),
+                source_url="https://example.com/synthetic/{}/".format(n),
+            )
+            jelis = [
+                JournalEntryLineItem(
+                    account=rand.choice(accts),
+                    action=rand.choice([JournalEntryLineItem.ACTION_BALANCE_INCREASE, JournalEntryLineItem.ACTION_BALANCE_DECREASE]),
+                    amount=Decimal(rand.randrange(1, 100000)) / 100,
+                    description="Synthetic line {} of entry {}".format(i, n),
+                )
+                for i in range(line_count)
+            ]
+            ledger.append((je, jelis))
+        return ledger
+
+    @staticmethod
+    def time_sink(sink: BatchSink, ledger: List[Tuple[JournalEntry, List[JournalEntryLineItem]]]) -> float:
+        start = time.perf_counter()
+        for i in range(0, len(ledger), sink.batch_size):
+            chunk = ledger[i:i+sink.batch_size]
+            sink.save(JournalEntry, [je for je, _ in chunk])
+            jelis = []  # type: List[JournalEntryLineItem]
+            for je, je_jelis in chunk:
+                for jeli in je_jelis:
+                    jeli.journal_entry_id = je.id
+                    jelis.append(jeli)
+            sink.save(JournalEntryLineItem, jelis)
+        return time.perf_counter() - start
+
+    def handle(self, *args, **options):
+
+        sinks = [BulkCreateSink()]
+        if connection.vendor == 'postgresql':
+            sinks.append(PostgresCopySink())
+        else:
+            print("COPY isn't available with {}. Only timing bulk_create.".format(connection.vendor))
+
+        entry_count = options['entries']
+        line_count = options['lines']
+        if entry_count < 1 or line_count < 1:
+            raise CommandError("There must be at least one entry and one line item per entry.")
+
+        # Everything is written inside a transaction that is rolled back, so it's safe to run against real data.
+        with transaction.atomic():
+            accts = [
+                Account.objects.create(
+                    name="Synthetic {}".format(n),
+                    category=Account.CAT_ASSET,
+                    type=Account.TYPE_DEBIT,
+                    description="Synthetic account for benchmarking."
+                )
+                for n in range(10)
+            ]
+            print("\n{} entries with {} line items each".format(entry_count, line_count))
+            for sink in sinks:
+                ledger = Command.synthetic_ledger(accts, entry_count, line_count)
+                sid = transaction.savepoint()
+                seconds = Command.time_sink(sink, ledger)
+                transaction.savepoint_rollback(sid)
+                rate = entry_count * (1 + line_count) / seconds
+                print("   {:16} {:8.2f} s {:10.0f} rows/s".format(type(sink).__name__, seconds, rate))
+            transaction.set_rollback(True)
+
+        print("\nDone.\n")
@@ -16,6 +16,7 @@ from books.mailviews import (
     CashDonationMailView,
     ReceivableInvoiceMailView,
 )
+import modelmailer.outbox as outbox
 
 __author__ = 'adrian'
 
@@ -29,7 +30,7 @@ class Command(BaseCommand):
         mv = PhysicalDonationMailView()
         for donation in Donation.objects.filter(send_receipt=True).all():
             try:
-                sent = mv.send(donation)
+                sent = mv.enqueue(donation)
                 if sent:
                     donation.send_receipt = False
                     donation.save()
@@ -50,7 +51,7 @@ class Command(BaseCommand):
                 if sale.monetarydonation_set.count() == 0:
                     # Protect against case where admin checked the "send DONATION receipt" box but there aren't any donations.
                     continue
-                sent = mv.send(sale)
+                sent = mv.enqueue(sale)
                 if sent:
                     sale.send_receipt = False
                     sale.save()
@@ -69,7 +70,7 @@ class Command(BaseCommand):
         mv = ReceivableInvoiceMailView()
         for rinv in ReceivableInvoice.objects.filter(send_invoice=True).all():
             try:
-                sent = mv.send(rinv)
+                sent = mv.enqueue(rinv)
                 if sent:
                     rinv.send_invoice = False
                     rinv.save()
@@ -86,4 +87,5 @@ class Command(BaseCommand):
         self.send_physical_donation_receipts()
         self.send_monetary_donation_receipts()
         self.send_receivable_invoices()
+        outbox.deliver()
 
@@ -1,31 +1,108 @@
 # Standard
-from typing import List
+import multiprocessing as mp
+from decimal import Decimal
+from typing import List, Tuple
 
 # Third party
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.apps import apps
+from django.db import connection
 
 # Local
 from books.models import (
     JournalEntry,
     Journaler, JournalLiner,
+    JournalerDirtyMarker,
+    DailyAccountBalance,
     registered_journaler_classes,
 )
 
 __author__ = 'adrian'
 
+PARTITIONS_PER_WORKER = 4  # More partitions than workers, so that a slow partition doesn't idle the others.
+
+
+def partition_journaler_class(journaler_class, partition_count: int) -> List[Tuple[str, str, int, int]]:
+    """Split the journalers of the given class into pk ranges holding (about) the same number of journalers."""
+    pks = list(journaler_class.objects.order_by('pk').values_list('pk', flat=True))
+    if len(pks) == 0:
+        return []
+    size = -(-len(pks) // partition_count)  # Ceiling division
+    meta = journaler_class._meta
+    return [
+        (meta.app_label, meta.model_name, pks[i], pks[min(i+size, len(pks))-1])
+        for i in range(0, len(pks), size)
+    ]
+
+
+def generate_partition(partition: Tuple[str, str, int, int]) -> Tuple[Decimal, Decimal, List[int]]:
+    """Generate the journal entries for one pk range of one journaler class. Runs in a worker process."""
+    app_label, model_name, lo_pk, hi_pk = partition
+    journaler_class = apps.get_model(app_label, model_name)
+    Journaler.reset_journal_state()
+    links = journaler_class.link_names_of_relevant_children()
+    journalers = journaler_class.objects.filter(pk__gte=lo_pk, pk__lte=hi_pk).prefetch_related(*links)
+    for journaler in journalers:  # type: Journaler
+        journaler.create_journalentry()
+    Journaler.save_je_batch()
+    JournalLiner.save_jeli_batch()
+    return Journaler.get_journal_state()
+
 
 class Command(BaseCommand):
 
-    help = "(Re)generates the journal from existing transactions."
+    help = "(Re)generates the journal from existing transactions. Only changed transactions, unless --full."
 
-    def handle(self, *args, **options):
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action="store_true", default=False,
+            help="Delete the entire journal and regenerate it from ALL transactions.")
+        parser.add_argument('--batch-size', type=int, default=500,
+            help="The number of changed transactions to regenerate per database transaction.")
+        parser.add_argument('--workers', type=int, default=1,
+            help="The number of worker processes to use for a full regeneration.")
 
+    @staticmethod
+    def delete_journal():
         print("\nDeleting unfrozen journal entries... ", end="", flush=True)
         JournalEntry.objects.all().delete()
+        # Everything is about to be regenerated, so nothing remains dirty.
+        JournalerDirtyMarker.objects.all().delete()
         print("Done.\n")
 
+    @staticmethod
+    def generate_full_parallel(worker_count: int):
+
+        Command.delete_journal()
+
+        partitions = {}
+        for journaler_class in registered_journaler_classes:
+            partitions[journaler_class] = partition_journaler_class(
+                journaler_class, worker_count * PARTITIONS_PER_WORKER)
+
+        # Each worker must open its own connection instead of sharing the one inherited from this process.
+        connection.close()
+        pool = mp.Pool(worker_count)
+        try:
+            for journaler_class, class_partitions in partitions.items():
+                print("{}s".format(journaler_class.__name__), flush=True)
+                count = 0  # type: int
+                for state in pool.imap_unordered(generate_partition, class_partitions):
+                    Journaler.merge_journal_state(state)
+                    count += 1
+                    progress = 1.0 * count / len(class_partitions)
+                    print("\r   Processed {:.0%} ... ".format(progress), end="", flush=True)
+                print("Done.\n")
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def generate_full():
+
+        Command.delete_journal()
+
         for journaler_class in registered_journaler_classes:
             # print("\rGenerating entries for {} transactions...".format(journaler_class.__name__))
             count = 0  # type: int
@@ -46,6 +123,40 @@ class Command(BaseCommand):
         Journaler.save_je_batch()
         JournalLiner.save_jeli_batch()
 
+    @staticmethod
+    def generate_incremental(batch_size: int):
+        total_count = JournalerDirtyMarker.objects.count()
+        print("\nRegenerating entries for {} changed transactions... ".format(total_count), end="", flush=True)
+        count = 0  # type: int
+        while True:
+            processed = JournalerDirtyMarker.regenerate_batch(batch_size)
+            if processed == 0:
+                break
+            count += processed
+            print("\r   Processed {} ... ".format(count), end="", flush=True)
+        print("Done.\n")
+
+    def handle(self, *args, **options):
+
+        worker_count = options['workers']
+        if worker_count < 1:
+            raise CommandError("There must be at least one worker.")
+        if worker_count > 1 and not options['full']:
+            raise CommandError("Multiple workers are only used for a --full regeneration.")
+
+        if options['full'] and worker_count > 1:
+            Command.generate_full_parallel(worker_count)
+        elif options['full']:
+            Command.generate_full()
+        else:
+            Command.generate_incremental(options['batch_size'])
+
+        if options['full']:
+            # The incremental path patches the rollup as it goes.
+            print("Rebuilding daily account balances... ", end="", flush=True)
+            DailyAccountBalance.rebuild()
+            print("Done.\n")
+
         errors = Journaler.get_unbalanced_journal_entries()
         print("Found {} Errors:".format(len(errors)))
         for je in errors:
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.18 on 2026-10-18 04:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('books', '0027_auto_20180903_1542'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='journalentry',
+            name='source_url',
+            field=models.URLField(db_index=True, help_text='URL to retrieve the item that gave rise to this journal entry.'),
+        ),
+        migrations.CreateModel(
+            name='JournalerDirtyMarker',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_url', models.URLField(help_text='The absolute url of the journaler whose journal entries are out of date.', unique=True)),
+                ('object_id', models.PositiveIntegerField(help_text='The id of the journaler whose journal entries are out of date.')),
+                ('when_marked', models.DateTimeField(auto_now=True, help_text='The most recent time at which the journaler was changed.')),
+                ('content_type', models.ForeignKey(help_text='The type of the journaler whose journal entries are out of date.', on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+    ]
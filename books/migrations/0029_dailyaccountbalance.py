@@ -0,0 +1,54 @@
+# Generated by Django 2.2.18 on 2026-10-18 04:44
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Case, When, Sum, Value
+import django.db.models.deletion
+
+
+def build_rollup(apps, schema_editor):
+    # Same as DailyAccountBalance.rebuild(), which isn't available to migrations.
+    JournalEntryLineItem = apps.get_model('books', 'JournalEntryLineItem')
+    DailyAccountBalance = apps.get_model('books', 'DailyAccountBalance')
+    zero = Decimal("0.00")
+    activity = JournalEntryLineItem.objects.values('account_id', 'journal_entry__when').annotate(
+        increase=Sum(Case(When(action=">", then='amount'), default=Value(zero), output_field=models.DecimalField())),
+        decrease=Sum(Case(When(action="<", then='amount'), default=Value(zero), output_field=models.DecimalField())),
+    ).order_by('account_id', 'journal_entry__when')
+    balances = {}
+    rollups = []
+    for row in activity:
+        acct_id = row['account_id']
+        balances[acct_id] = balances.get(acct_id, zero) + row['increase'] - row['decrease']
+        rollups.append(DailyAccountBalance(
+            account_id=acct_id, day=row['journal_entry__when'],
+            increase=row['increase'], decrease=row['decrease'], balance=balances[acct_id],
+        ))
+    DailyAccountBalance.objects.bulk_create(rollups, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0028_journalerdirtymarker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(help_text='The day whose activity is summarized.')),
+                ('increase', models.DecimalField(decimal_places=2, help_text='The total of the increases to the account on this day.', max_digits=10)),
+                ('decrease', models.DecimalField(decimal_places=2, help_text='The total of the decreases to the account on this day.', max_digits=10)),
+                ('balance', models.DecimalField(decimal_places=2, help_text='The balance of the account at the end of this day, i.e. all increases less all decreases to date.', max_digits=10)),
+                ('account', models.ForeignKey(help_text='The account whose activity is summarized.', on_delete=django.db.models.deletion.CASCADE, to='books.Account')),
+            ],
+            options={
+                'ordering': ['account', 'day'],
+                'unique_together': {('account', 'day')},
+            },
+        ),
+        migrations.RunPython(build_rollup, migrations.RunPython.noop),
+    ]
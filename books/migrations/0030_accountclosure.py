@@ -0,0 +1,41 @@
+# Generated by Django 2.2.18 on 2026-10-18 04:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_closure(apps, schema_editor):
+    # Same as AccountClosure.rebuild(), which isn't available to migrations.
+    Account = apps.get_model('books', 'Account')
+    AccountClosure = apps.get_model('books', 'AccountClosure')
+    parent_ids = dict(Account.objects.values_list('id', 'parent_id'))
+    links = []
+    for acct_id in parent_ids:
+        ancestor_id, depth = acct_id, 0
+        while ancestor_id is not None and depth <= len(parent_ids):
+            links.append(AccountClosure(ancestor_id=ancestor_id, descendant_id=acct_id, depth=depth))
+            ancestor_id, depth = parent_ids.get(ancestor_id), depth+1
+    AccountClosure.objects.bulk_create(links)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0029_dailyaccountbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField(help_text="The number of levels from ancestor down to descendant. Zero if they're the same account.")),
+                ('ancestor', models.ForeignKey(help_text='The ancestor account.', on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='books.Account')),
+                ('descendant', models.ForeignKey(help_text="An account in the ancestor's subtree.", on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='books.Account')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
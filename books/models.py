@@ -1,21 +1,25 @@
 # pylint: disable=C0330
 
 # Standard
+import time as systime
+import uuid
 from datetime import date
 from decimal import Decimal
 from typing import Dict, List, Optional, Tuple
 from abc import abstractmethod, ABCMeta
 from logging import getLogger
-from collections import Counter
+from collections import Counter, defaultdict
 
 # Third party
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, When, Sum, Min, Value
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.core.cache import caches
 from nameparser import HumanName
 from django.urls import reverse
 from django.utils.html import format_html
@@ -25,11 +29,23 @@ from django.utils.translation import ugettext_lazy as _
 # Local
 from abutils.utils import generate_ctrlid
 from abutils.models import get_url_str
+from books.batchsinks import BatchSink, default_batch_sink
 
 logger = getLogger("books")
 
 ORG_NAME = settings.BZWOPS_CONFIG['ORG_NAME']
 
+# The name of the cache, in settings.CACHES, that holds the generation of the account tree.
+# It should be shared by all processes so that a change to the accounts made by one of them is seen by the others.
+ACCOUNT_TREE_CACHE_ALIAS = getattr(settings, 'BZWOPS_BOOKS_CONFIG', {}).get('ACCOUNT_TREE_CACHE', 'default')
+ACCOUNT_TREE_GENERATION_KEY = "books-account-tree-generation"
+
+# The generation is checked at most this often, since the tree is used for every subaccount test.
+ACCOUNT_TREE_CHECK_SECONDS = 1.0
+
+# The tree is reloaded at least this often, in case accounts were changed without sending signals (e.g. by update()).
+ACCOUNT_TREE_MAX_AGE_SECONDS = 15*60
+
 DEC0 = Decimal("0.00")
 DEC1 = Decimal("1.00")
 
@@ -188,20 +204,105 @@ class Account(models.Model):
             logger.exception("Couldn't find account #{} ".format(acct_num))
             raise
 
+    # The account hierarchy, loaded by tree(). Cleared by a signal handler when any account is saved or deleted,
+    # and reloaded when another process has done that, per the generation in the shared cache.
+    # Maps account id to (account, ancestor ids nearest first, descendant ids in tree order).
+    tree_cache = None  # type: Optional[Dict[int, Tuple[Account, List[int], List[int]]]]
+    tree_cache_generation = None  # type: Optional[str]
+    tree_cache_loaded = float('-inf')  # type: float
+    tree_cache_checked = float('-inf')  # type: float
+
+    @staticmethod
+    def _tree_generation() -> str:
+        cache = caches[ACCOUNT_TREE_CACHE_ALIAS]
+        generation = cache.get(ACCOUNT_TREE_GENERATION_KEY)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            cache.set(ACCOUNT_TREE_GENERATION_KEY, generation, None)
+        return generation
+
+    @staticmethod
+    def clear_tree_cache() -> None:
+        """Clear the tree cache in every process."""
+        Account.tree_cache = None
+
+        def new_generation():
+            caches[ACCOUNT_TREE_CACHE_ALIAS].set(ACCOUNT_TREE_GENERATION_KEY, uuid.uuid4().hex, None)
+        new_generation()
+        # Another process might reload from the old data before the change commits, so do it again afterwards.
+        transaction.on_commit(new_generation)
+
+    @staticmethod
+    def _tree_cache_is_current() -> bool:
+        if Account.tree_cache is None:
+            return False
+        now = systime.monotonic()
+        if now - Account.tree_cache_loaded > ACCOUNT_TREE_MAX_AGE_SECONDS:
+            return False
+        if now - Account.tree_cache_checked >= ACCOUNT_TREE_CHECK_SECONDS:
+            Account.tree_cache_checked = now
+            return Account.tree_cache_generation == Account._tree_generation()
+        return True
+
+    @staticmethod
+    def tree(category: Optional[str] = None) -> List['Account']:
+        """
+        Fetch all accounts in a single query, ordered depth first with siblings by name, so that each account
+        immediately precedes its subaccounts. Each account gets a "depth" attribute, which is 0 for root accounts.
+        Also (re)loads the cache behind descendants_of() and ancestors_of().
+        """
+        generation = Account._tree_generation()  # Before the query, so a change made during it isn't missed.
+        accts = list(Account.objects.order_by('name'))
+        children = defaultdict(list)  # type: Dict[Optional[int], List[Account]]
+        for acct in accts:
+            children[acct.parent_id].append(acct)
+
+        ordered = []  # type: List[Account]
+        cache = {}  # type: Dict[int, Tuple[Account, List[int], List[int]]]
+        stack = [(root, []) for root in reversed(children[None])]  # type: List[Tuple[Account, List[int]]]
+        while len(stack) > 0:
+            acct, ancestor_ids = stack.pop()
+            acct.depth = len(ancestor_ids)
+            ordered.append(acct)
+            cache[acct.id] = (acct, ancestor_ids, [])
+            for ancestor_id in ancestor_ids:
+                cache[ancestor_id][2].append(acct.id)
+            for child in reversed(children[acct.id]):
+                stack.append((child, [acct.id] + ancestor_ids))
+
+        Account.tree_cache = cache
+        Account.tree_cache_generation = generation
+        Account.tree_cache_loaded = Account.tree_cache_checked = systime.monotonic()
+        if category is not None:
+            ordered = [acct for acct in ordered if acct.category == category]
+        return ordered
+
+    @staticmethod
+    def _tree_entry(acct: 'Account') -> Tuple['Account', List[int], List[int]]:
+        if not Account._tree_cache_is_current() or acct.id not in Account.tree_cache:
+            # A miss can mean that the account was created by another process, so reload.
+            Account.tree()
+        return Account.tree_cache[acct.id]
+
+    @staticmethod
+    def descendants_of(acct: 'Account') -> List['Account']:
+        """All subaccounts of acct, at any depth, in tree order."""
+        return [Account.tree_cache[i][0] for i in Account._tree_entry(acct)[2]]
+
+    @staticmethod
+    def ancestors_of(acct: 'Account') -> List['Account']:
+        """All accounts that acct is a subaccount of, nearest first."""
+        return [Account.tree_cache[i][0] for i in Account._tree_entry(acct)[1]]
+
     @property
     def subaccounts(self) -> List['Account']:
-        result = []  # type: List['Account']
-        for subacct in self.account_set.all():
-            result.append(subacct)
-            result.extend(subacct.subaccounts)
-        return result
+        return Account.descendants_of(self)
 
     def is_subaccount_of(self, other: 'Account') -> bool:
-        if self.parent is None:
-            return False
-        if self.parent == other:
-            return True
-        return self.parent.is_subaccount_of(other)
+        if self.pk is None:
+            # Not in the hierarchy yet, but its parent may be.
+            return self.parent is not None and (self.parent == other or self.parent.is_subaccount_of(other))
+        return other.id in Account._tree_entry(self)[1]
 
     @property
     def category_name(self):
@@ -224,6 +325,44 @@ class Account(models.Model):
         ordering = ['name']
 
 
+class AccountClosure(models.Model):
+    """
+    Every (ancestor, descendant) pair in the account hierarchy, including each account paired with itself.
+    This lets queries select an account's whole subtree with a single join, e.g. account__ancestor_links__ancestor=acct.
+    Rebuilt by a signal handler whenever an account is saved.
+    """
+
+    ancestor = models.ForeignKey(Account, null=False, blank=False,
+        on_delete=models.CASCADE,
+        related_name='descendant_links',
+        help_text="The ancestor account.")
+
+    descendant = models.ForeignKey(Account, null=False, blank=False,
+        on_delete=models.CASCADE,
+        related_name='ancestor_links',
+        help_text="An account in the ancestor's subtree.")
+
+    depth = models.IntegerField(null=False, blank=False,
+        help_text="The number of levels from ancestor down to descendant. Zero if they're the same account.")
+
+    @staticmethod
+    def rebuild() -> None:
+        # The hierarchy is small and changes rarely, so it's simplest to rebuild all of it.
+        parent_ids = dict(Account.objects.values_list('id', 'parent_id'))  # type: Dict[int, Optional[int]]
+        links = []  # type: List[AccountClosure]
+        for acct_id in parent_ids:
+            ancestor_id, depth = acct_id, 0
+            while ancestor_id is not None and depth <= len(parent_ids):  # The depth check guards against cycles.
+                links.append(AccountClosure(ancestor_id=ancestor_id, descendant_id=acct_id, depth=depth))
+                ancestor_id, depth = parent_ids.get(ancestor_id), depth+1
+        with transaction.atomic():
+            AccountClosure.objects.all().delete()
+            AccountClosure.objects.bulk_create(links)
+
+    class Meta:
+        unique_together = ['ancestor', 'descendant']
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # JOURNAL - The journal is generated (and regenerated) from other models
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -233,7 +372,7 @@ class JournalEntry(models.Model):
     frozen = models.BooleanField(default=False,
         help_text="If frozen, this entry (and its lines) won't be deleted/regenerated.")
 
-    source_url = models.URLField(blank=False, null=False,
+    source_url = models.URLField(blank=False, null=False, db_index=True,
         help_text="URL to retrieve the item that gave rise to this journal entry.")
 
     when = models.DateField(null=False, blank=False,
@@ -326,6 +465,10 @@ class JournalEntry(models.Model):
                 lis.append(line)
         return lis
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related('journalentrylineitem_set')
+
     def dbcheck(self):
         # Relationships can't be checked in clean but can be checked later in a "db check" operation.
         total_debits, total_credits = self.debit_and_credit_totals()
@@ -392,6 +535,104 @@ class JournalEntryLineItem(models.Model):
         )
 
 
+class DailyAccountBalance(models.Model):
+    """
+    A rollup of the journal: the total increase and decrease of an account on a day, and its resulting balance.
+    This is derived data. It's rebuilt when the journal is regenerated and patched when journalers are re-journaled.
+    """
+
+    account = models.ForeignKey(Account, null=False, blank=False,
+        on_delete=models.CASCADE,  # This is derived data, so it can go if the account goes.
+        help_text="The account whose activity is summarized.")
+
+    day = models.DateField(null=False, blank=False,
+        help_text="The day whose activity is summarized.")
+
+    increase = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False,
+        help_text="The total of the increases to the account on this day.")
+
+    decrease = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False,
+        help_text="The total of the decreases to the account on this day.")
+
+    balance = models.DecimalField(max_digits=10, decimal_places=2, null=False, blank=False,
+        help_text="The balance of the account at the end of this day, i.e. all increases less all decreases to date.")
+
+    @property
+    def change(self) -> Decimal:
+        return self.increase - self.decrease
+
+    @staticmethod
+    def _daily_activity(jelis):
+        """Group the given line items by account and day, in that order, totaling increases and decreases."""
+        return jelis.values('account_id', 'journal_entry__when').annotate(
+            increase=Sum(Case(
+                When(action=JournalEntryLineItem.ACTION_BALANCE_INCREASE, then='amount'),
+                default=Value(DEC0), output_field=models.DecimalField())),
+            decrease=Sum(Case(
+                When(action=JournalEntryLineItem.ACTION_BALANCE_DECREASE, then='amount'),
+                default=Value(DEC0), output_field=models.DecimalField())),
+        ).order_by('account_id', 'journal_entry__when')
+
+    @classmethod
+    def _create_from_activity(cls, activity, opening_balances: Dict[int, Decimal]) -> None:
+        balances = dict(opening_balances)
+        rollups = []  # type: List[DailyAccountBalance]
+        for row in activity:
+            acct_id = row['account_id']
+            balances[acct_id] = balances.get(acct_id, DEC0) + row['increase'] - row['decrease']
+            rollups.append(cls(
+                account_id=acct_id,
+                day=row['journal_entry__when'],
+                increase=row['increase'],
+                decrease=row['decrease'],
+                balance=balances[acct_id],
+            ))
+        cls.objects.bulk_create(rollups, batch_size=1000)
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """Rebuild the entire rollup from the journal."""
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls._create_from_activity(cls._daily_activity(JournalEntryLineItem.objects.all()), {})
+
+    @classmethod
+    def rebuild_from(cls, first_days: Dict[int, date]) -> None:
+        """
+        Rebuild the rollup for some accounts, from the given days onward. Earlier days are unaffected.
+        :param first_days: Maps account ids to the earliest day on which the account's activity changed.
+        """
+        with transaction.atomic():
+            for acct_id, first_day in first_days.items():
+                cls.objects.filter(account_id=acct_id, day__gte=first_day).delete()
+                prior = cls.objects.filter(account_id=acct_id, day__lt=first_day).order_by('-day').first()
+                jelis = JournalEntryLineItem.objects.filter(account_id=acct_id, journal_entry__when__gte=first_day)
+                opening_balances = {acct_id: prior.balance} if prior is not None else {}
+                cls._create_from_activity(cls._daily_activity(jelis), opening_balances)
+
+    @staticmethod
+    def first_days_for(source_urls) -> Dict[int, date]:
+        """The earliest day on which each account is affected by the journal entries with the given source urls."""
+        rows = JournalEntryLineItem.objects.filter(journal_entry__source_url__in=source_urls)\
+            .values('account_id').annotate(first_day=Min('journal_entry__when'))
+        return {row['account_id']: row['first_day'] for row in rows}
+
+    @staticmethod
+    def merge_first_days(*first_days_dicts: Dict[int, date]) -> Dict[int, date]:
+        result = dict()  # type: Dict[int, date]
+        for first_days in first_days_dicts:
+            for acct_id, first_day in first_days.items():
+                result[acct_id] = min(first_day, result.get(acct_id, first_day))
+        return result
+
+    def __str__(self):
+        return "{} on {}: {}".format(self.account, self.day, self.balance)
+
+    class Meta:
+        unique_together = ['account', 'day']
+        ordering = ['account', 'day']
+
+
 class Journaler(models.Model):
 
     __metaclass__ = ABCMeta
@@ -449,20 +690,25 @@ class Journaler(models.Model):
             for child in children:
                 child.create_journalentry_lineitems(je)
 
-    def get_absolute_url(self):
-        content_type = ContentType.objects.get_for_model(self.__class__)
+    @classmethod
+    def absolute_url_for(cls, pk: int) -> str:
+        """The absolute url of the journaler with the given pk. It doesn't need to be fetched, or even exist."""
+        content_type = ContentType.objects.get_for_model(cls)
         url_name = "admin:{}_{}_change".format(content_type.app_label, content_type.model)
-        relative_url = reverse(url_name, args=[str(self.id)])
+        relative_url = reverse(url_name, args=[str(pk)])
         return "https://{}{}".format(PROD_HOST, relative_url)
 
+    def get_absolute_url(self):
+        return self.absolute_url_for(self.id)
+
     @classmethod
     def save_je_batch(cls):
         """
-        Save the currently batched JournalEntry instances using bulk_create,
+        Save the currently batched JournalEntry instances using the batch sink,
         and stage the associated pre-batched JournalEntryLineItems for batch creation.
         """
-        # NOTE: As of 1/18/2016, this will only work in Django version 1.10 with Postgres
-        JournalEntry.objects.bulk_create(cls._je_batch)
+        # NOTE: The sink must provide PKs for the saved entries. bulk_create only does so with Postgres.
+        get_batch_sink().save(JournalEntry, cls._je_batch)
         for je in cls._je_batch:
             je.process_prebatch()
         cls._je_batch = []
@@ -482,7 +728,7 @@ class Journaler(models.Model):
             cls._unbalanced_journal_entries.append(je)
             je.unbalanced = True
         cls._je_batch.append(je)
-        if len(cls._je_batch) > 1000:
+        if len(cls._je_batch) > get_batch_sink().batch_size:
             cls.save_je_batch()
         return je
 
@@ -491,15 +737,50 @@ class Journaler(models.Model):
         Create and save journal entries for this one transaction.
         Intended to be used after a transaction is created or updated in admin.
         """
-        JournalEntry.objects.filter(source_url=self.get_absolute_url()).delete()
-        self.create_journalentry()
-        Journaler.save_je_batch()
-        JournalLiner.save_jeli_batch()
+        source_url = self.get_absolute_url()
+        with transaction.atomic():
+            old_first_days = DailyAccountBalance.first_days_for([source_url])
+            JournalEntry.objects.filter(source_url=source_url).delete()
+            self.create_journalentry()
+            Journaler.save_je_batch()
+            JournalLiner.save_jeli_batch()
+            new_first_days = DailyAccountBalance.first_days_for([source_url])
+            DailyAccountBalance.rebuild_from(DailyAccountBalance.merge_first_days(old_first_days, new_first_days))
+            JournalerDirtyMarker.objects.filter(source_url=source_url).delete()
 
     @classmethod
     def get_unbalanced_journal_entries(cls):
         return cls._unbalanced_journal_entries
 
+    @classmethod
+    def reset_journal_state(cls):
+        """
+        Discard any batched entries/line items and zero the grand totals.
+        Each process that generates journal entries starts from this state.
+        """
+        Journaler._je_batch = []
+        Journaler._unbalanced_journal_entries = []
+        Journaler._grand_total_debits = Decimal(0.00)
+        Journaler._grand_total_credits = Decimal(0.00)
+        JournalLiner._jeli_batch = []
+
+    @classmethod
+    def get_journal_state(cls) -> Tuple[Decimal, Decimal, List[int]]:
+        """
+        Summarize the work done so far as (total debits, total credits, pks of unbalanced entries).
+        All batches must have been saved so that the unbalanced entries have pks.
+        """
+        unbalanced_pks = [je.pk for je in Journaler._unbalanced_journal_entries]
+        return Journaler._grand_total_debits, Journaler._grand_total_credits, unbalanced_pks
+
+    @classmethod
+    def merge_journal_state(cls, state: Tuple[Decimal, Decimal, List[int]]):
+        """Merge a summary produced by get_journal_state (typically in another process) into this process's state."""
+        total_debits, total_credits, unbalanced_pks = state
+        Journaler._grand_total_debits += total_debits
+        Journaler._grand_total_credits += total_credits
+        Journaler._unbalanced_journal_entries.extend(JournalEntry.objects.filter(pk__in=unbalanced_pks))
+
 
 class JournalLiner(object):
     __metaclass__ = ABCMeta
@@ -513,17 +794,34 @@ class JournalLiner(object):
 
     @classmethod
     def save_jeli_batch(cls):
-        created = JournalEntryLineItem.objects.bulk_create(cls._jeli_batch)
+        get_batch_sink().save(JournalEntryLineItem, cls._jeli_batch)
         cls._jeli_batch = []
 
     @classmethod
     def batch_jeli(cls, jeli: JournalEntryLineItem):
         cls._jeli_batch.append(jeli)
-        if len(cls._jeli_batch) > 1000:
+        if len(cls._jeli_batch) > get_batch_sink().batch_size:
             cls.save_jeli_batch()
         return jeli
 
 
+_batch_sink = None  # type: Optional[BatchSink]
+
+
+def get_batch_sink() -> BatchSink:
+    """The sink through which batched journal entries and line items are saved."""
+    global _batch_sink
+    if _batch_sink is None:
+        _batch_sink = default_batch_sink()
+    return _batch_sink
+
+
+def set_batch_sink(sink: Optional[BatchSink]) -> None:
+    """Replace the batch sink. None restores the default sink for the database in use."""
+    global _batch_sink
+    _batch_sink = sink
+
+
 registered_journaler_classes = []  # type: List[Journaler]
 
 
@@ -537,6 +835,132 @@ def register_journaler():
     return _decorator
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# DIRTY TRACKING - Journalers whose journal entries need to be regenerated
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+_journaler_parent_fields = dict()  # type: Dict[type, List[models.ForeignKey]]
+_journaler_peer_relations = dict()  # type: Dict[type, List[models.ManyToOneRel]]
+
+
+def journaler_parent_fields(model: type) -> List[models.ForeignKey]:
+    """
+    The fields of the given model that point to the Journaler(s) it is a part of.
+    E.g. OtherItem.sale or ExpenseLineItem.claim. Links to PEER transactions are excluded.
+    """
+    if model not in _journaler_parent_fields:
+        fields = []
+        if not issubclass(model, Note):  # Notes don't affect the journal.
+            fields = [
+                f for f in model._meta.get_fields()
+                  if (f.many_to_one or f.one_to_one)
+                  and f.concrete
+                  and issubclass(f.related_model, Journaler)
+                  and not hasattr(f, 'is_not_parent')
+            ]
+        _journaler_parent_fields[model] = fields
+    return _journaler_parent_fields[model]
+
+
+def journaler_peer_relations(journaler_class: type) -> List[models.ManyToOneRel]:
+    """
+    The reverse relations through which JournalLiners in OTHER journalers refer to the given journaler class.
+    E.g. the journal entry for an ExpenseTransaction depends on the ExpenseClaims it pays.
+    """
+    if journaler_class not in _journaler_peer_relations:
+        _journaler_peer_relations[journaler_class] = [
+            f for f in journaler_class._meta.get_fields()
+              if f.one_to_many
+              and f.auto_created
+              and not f.concrete
+              and hasattr(f.field, 'is_not_parent')
+              and issubclass(f.related_model, JournalLiner)
+        ]
+    return _journaler_peer_relations[journaler_class]
+
+
+class JournalerDirtyMarker(models.Model):
+    """
+    Records that the journal entries of some Journaler are out of date.
+    Markers are created by signal handlers and consumed by "generatejournal", which regenerates
+    only the entries of marked journalers unless it's asked to do a full rebuild.
+    """
+
+    # This is the same as the source_url of the journaler's journal entries.
+    source_url = models.URLField(unique=True, blank=False, null=False,
+        help_text="The absolute url of the journaler whose journal entries are out of date.")
+
+    content_type = models.ForeignKey(ContentType, null=False, blank=False,
+        on_delete=models.CASCADE,
+        help_text="The type of the journaler whose journal entries are out of date.")
+
+    object_id = models.PositiveIntegerField(null=False, blank=False,
+        help_text="The id of the journaler whose journal entries are out of date.")
+
+    when_marked = models.DateTimeField(auto_now=True,
+        help_text="The most recent time at which the journaler was changed.")
+
+    @classmethod
+    def mark(cls, journaler_class: type, pk: int) -> None:
+        """Mark the given journaler, and any journalers that depend on it, as needing regeneration."""
+        # update_or_create blocks on a marker that is locked by a regeneration in progress, so a change
+        # made during regeneration will re-create the marker after the regeneration deletes it.
+        cls.objects.update_or_create(
+            source_url=journaler_class.absolute_url_for(pk),
+            defaults={
+                'content_type': ContentType.objects.get_for_model(journaler_class),
+                'object_id': pk,
+            }
+        )
+        for rel in journaler_peer_relations(journaler_class):
+            peers = rel.related_model.objects.filter(**{rel.field.attname: pk})
+            for field in journaler_parent_fields(rel.related_model):
+                for peer_id in peers.exclude(**{field.attname: None}).values_list(field.attname, flat=True):
+                    cls.mark(field.related_model, peer_id)
+
+    @classmethod
+    def regenerate_batch(cls, batch_size: int) -> int:
+        """
+        Regenerate the journal entries of (at most) batch_size marked journalers in a single transaction.
+        :return: The number of markers that were processed. Zero indicates that there's nothing left to do.
+        """
+        with transaction.atomic():
+            markers = list(cls.objects.select_for_update().order_by('when_marked')[:batch_size])
+            if len(markers) == 0:
+                return 0
+
+            ids_by_type = defaultdict(list)  # type: Dict[ContentType, List[int]]
+            for marker in markers:
+                ids_by_type[marker.content_type].append(marker.object_id)
+
+            stale_urls = set(m.source_url for m in markers)
+            journalers = []  # type: List[Journaler]
+            for content_type, ids in ids_by_type.items():
+                journaler_class = content_type.model_class()
+                links = journaler_class.link_names_of_relevant_children()
+                for journaler in journaler_class.objects.filter(pk__in=ids).prefetch_related(*links):
+                    if journaler.frozen_in_journal:
+                        stale_urls.discard(journaler.get_absolute_url())
+                    else:
+                        journalers.append(journaler)
+
+            # Journalers that no longer exist just lose their entries.
+            old_first_days = DailyAccountBalance.first_days_for(stale_urls)
+            JournalEntry.objects.filter(source_url__in=stale_urls).delete()
+            for journaler in journalers:
+                journaler.create_journalentry()
+            Journaler.save_je_batch()
+            JournalLiner.save_jeli_batch()
+            new_first_days = DailyAccountBalance.first_days_for(stale_urls)
+            DailyAccountBalance.rebuild_from(DailyAccountBalance.merge_first_days(old_first_days, new_first_days))
+
+            cls.objects.filter(pk__in=[m.pk for m in markers]).delete()
+            return len(markers)
+
+    def __str__(self):
+        return self.source_url
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # BUDGET
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -764,6 +1188,10 @@ class ReceivableInvoice(make_InvoiceBase(recv_invoice_help)):
             total += lineitem.amount
         return total
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related('receivableinvoicelineitem_set')
+
     def __str__(self):
         return "${} owed to us by {} as of {}".format(
             self.amount,
@@ -821,6 +1249,10 @@ class PayableInvoice(make_InvoiceBase(payable_invoice_help)):
             total += lineitem.amount
         return total
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related('payableinvoicelineitem_set')
+
     def __str__(self):
         return "${} owed to {} as of {}".format(
             self.amount,
@@ -1071,28 +1503,31 @@ class Sale(Journaler):
         unique_together = ('payment_method', 'ctrlid')
         verbose_name = "Income transaction"
 
-    def checksum(self) -> Decimal:
+    @classmethod
+    def line_item_links(cls) -> List[str]:
         """
-        :return: The sum total of all expense line items. Should match self.amount.
+        The names of the sale's related sets that hold line items. This is determined generically because
+        the 'books' app doesn't know which models in other apps will point back to a sale.
         """
-        total = Decimal(0.0)
-
-        # This is coded generically because the 'books' app doesn't know which models in other
-        # apps will point back to a sale. So it looks for fields like "sale_price" and "qty_sold"
-        # in all related models.
-
         # This is the new way to get_all_related_objects
         # per https://docs.djangoproject.com/en/1.10/ref/models/meta/
         related_objects = [
-            f for f in self._meta.get_fields()
+            f for f in cls._meta.get_fields()
               if (f.one_to_many or f.one_to_one)
               and f.auto_created
               and not f.concrete
         ]
         link_names = [rel.get_accessor_name() for rel in related_objects]
-        for link_name in link_names:
-            if link_name in ['salenote_set', 'receivableinvoicereference_set']: continue
-            # TODO: Can a select_related or prefetch_related improve performance here?
+        return [x for x in link_names if x not in ['salenote_set', 'receivableinvoicereference_set']]
+
+    def checksum(self) -> Decimal:
+        """
+        :return: The sum total of all expense line items. Should match self.amount.
+        """
+        total = Decimal(0.0)
+
+        # This looks for fields like "sale_price" and "qty_sold" in all the line item models.
+        for link_name in self.line_item_links():
             line_items = getattr(self, link_name).all()
             for line_item in line_items:
                 line_total = Decimal(0.0)
@@ -1121,6 +1556,10 @@ class Sale(Journaler):
         if self.payment_method == self.PAID_BY_CASH and self.method_detail > "":
             raise ValidationError(_("Cash payments shouldn't have detail. Cash is cash."))
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related(*cls.line_item_links(), 'receivableinvoicereference_set__invoice')
+
     def dbcheck(self):
         sum = self.checksum()
         checksum_matches = sum == self.total_paid_by_customer \
@@ -1530,6 +1969,10 @@ class Donation(models.Model):
                 if self.donator_acct.email=="" and self.donator_email=="":
                     raise ValidationError(_("No email address for receipt. Please fill the 'donator email' field."))
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related('donateditem_set')
+
     def dbcheck(self):
         if len(self.donateditem_set.all()) < 1:
             raise ValidationError(_("Every phyisical donation must include at least one line item."))
@@ -1628,6 +2071,10 @@ class ExpenseClaim(Journaler):
     def __str__(self):
         return "${} for {}".format(self.amount, self.claimant)
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related('expenselineitem_set')
+
     def dbcheck(self):
         if self.amount != self.checksum():
             raise ValidationError(_("Total of line items must match amount of claim."))
@@ -1789,6 +2236,14 @@ class ExpenseTransaction(Journaler):
             total += payable.portion if payable.portion is not None else payable.invoice.amount
         return total
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related(
+            'expenselineitem_set',
+            'expenseclaimreference_set__claim',
+            'payableinvoicereference_set__invoice',
+        )
+
     def dbcheck(self):
         if  self.amount_paid != self.checksum():
             raise ValidationError(_("Total of line items must match amount of transaction."))
@@ -1855,6 +2310,8 @@ class ExpenseClaimReference(models.Model, JournalLiner):
     claim = models.ForeignKey(ExpenseClaim, null=False, blank=False,
         on_delete=models.CASCADE,  # Delete this relation if the claim is deleted.
         help_text="The claim that is paid by the expense transaction.")
+    # 'not_part_of', below, indicates that this Reference is not part of the referenced Claim.
+    claim.is_not_parent = True
 
     portion = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True, default=None,
         help_text="Leave blank unless you're only paying a portion of the claim.")
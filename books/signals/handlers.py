@@ -2,11 +2,16 @@
 # Standard
 
 # Third Party
-from django.db.models.signals import pre_save
+from django.apps import apps
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 # Local
-from books.models import Sale, MonetaryDonation, Campaign
+from books.models import (
+    Sale, MonetaryDonation, Campaign,
+    Account, AccountClosure,
+    Journaler, JournalerDirtyMarker, journaler_parent_fields,
+)
 
 __author__ = 'Adrian'
 
@@ -38,3 +43,51 @@ def link_donation_to_campaign(sender, **kwargs):
     except Campaign.DoesNotExist:
         pass
 
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# ACCOUNT
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=Account)
+def rebuild_account_closure(sender, **kwargs):
+    # Also runs for fixture loading, since there's no other time to build the closure for loaded accounts.
+    AccountClosure.rebuild()
+    Account.clear_tree_cache()
+
+
+@receiver(post_delete, sender=Account)
+def clear_account_tree_cache(sender, **kwargs):
+    # The account's closure rows cascade. It can't have subaccounts, since parent is PROTECTed.
+    Account.clear_tree_cache()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# JOURNALERS AND THEIR CHILDREN
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# No sender is specified for post_save because journalers and their children are found in several apps.
+# Deletes are connected below, one model at a time, since Django can't do a fast delete of any model that
+# has a post_delete receiver, e.g. of journal entries or account balances.
+@receiver(post_save)
+def mark_journal_dirty(sender, **kwargs):
+    if kwargs.get('raw', False):
+        # Fixture loading. A full journal rebuild will be required anyway.
+        return
+    instance = kwargs.get('instance')
+    if isinstance(instance, Journaler):
+        JournalerDirtyMarker.mark(type(instance), instance.pk)
+    for field in journaler_parent_fields(type(instance)):
+        # Using the id instead of the related object because the parent might have been deleted.
+        parent_id = getattr(instance, field.attname)
+        if parent_id is not None:
+            JournalerDirtyMarker.mark(field.related_model, parent_id)
+
+
+def connect_journal_deletes() -> None:
+    for model in apps.get_models(include_auto_created=True):
+        if issubclass(model, Journaler) or len(journaler_parent_fields(model)) > 0:
+            post_delete.connect(mark_journal_dirty, sender=model)
+
+
+connect_journal_deletes()
@@ -1,19 +1,29 @@
 
 # Standard
+import random
 from decimal import Decimal
 from datetime import date
 
 # Third Party
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.core.cache import caches
+from django.contrib.auth.models import User
+from django.urls import reverse
+from rest_framework.test import APIClient
 
 # Local
 from books.models import (
     MonetaryDonation, Sale,
-    JournalEntry, JournalEntryLineItem,
-    Account
+    JournalEntry, JournalEntryLineItem, JournalerDirtyMarker,
+    Account, AccountClosure, DailyAccountBalance, set_batch_sink,
+    ACCOUNT_TREE_CACHE_ALIAS, ACCOUNT_TREE_GENERATION_KEY,
 )
+from books.serializers import SaleSerializer
+from books.batchsinks import BulkCreateSink, PostgresCopySink
+from books.fitting import count_crossings, fit_offset
+from books.timeseries import cumulative_series
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
@@ -34,6 +44,60 @@ class TestMonetaryDonation(TestCase):
         self.assertTrue(sum, 100)
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestBulkUpsert(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser("etl", "etl@example.com", "pw"))
+        self.url = reverse("book:sale-bulk-upsert")
+
+    def serialized_sale(self, ctrlid: str, total: int) -> dict:
+        sale = Sale(sale_date=date(2019, 1, 1), payment_method=Sale.PAID_BY_SQUARE, total_paid_by_customer=total, ctrlid=ctrlid)
+        return dict(SaleSerializer(sale).data)
+
+    def test_outcomes(self):
+        Sale.objects.create(sale_date=date(2019, 1, 1), payment_method=Sale.PAID_BY_SQUARE, total_paid_by_customer=10, ctrlid="SQ:same")
+        Sale.objects.create(sale_date=date(2019, 1, 1), payment_method=Sale.PAID_BY_SQUARE, total_paid_by_customer=10, ctrlid="SQ:changed")
+        Sale.objects.create(sale_date=date(2019, 1, 1), payment_method=Sale.PAID_BY_SQUARE, total_paid_by_customer=10, ctrlid="SQ:protected", protected=True)
+
+        bad = self.serialized_sale("SQ:bad", 10)
+        bad['total_paid_by_customer'] = "not a number"
+        items = [
+            self.serialized_sale("SQ:new", 20),
+            self.serialized_sale("SQ:same", 10),
+            self.serialized_sale("SQ:changed", 30),
+            self.serialized_sale("SQ:protected", 40),
+            bad,
+        ]
+        response = self.client.post(self.url, items, format='json')
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['outcome'] for r in results], ["+", "=", "U", "P", "E"])
+        self.assertEqual([r['ctrlid'] for r in results], [item['ctrlid'] for item in items])
+        self.assertIn('total_paid_by_customer', results[4]['data'])
+
+        self.assertEqual(Sale.objects.get(ctrlid="SQ:new").pk, results[0]['data']['id'])
+        self.assertEqual(Sale.objects.get(ctrlid="SQ:changed").total_paid_by_customer, 30)
+        self.assertEqual(Sale.objects.get(ctrlid="SQ:protected").total_paid_by_customer, 10)
+        self.assertFalse(Sale.objects.filter(ctrlid="SQ:bad").exists())
+
+        # Sending the same items again changes nothing.
+        response = self.client.post(self.url, items[:4], format='json')
+        self.assertEqual([r['outcome'] for r in response.json()['results']], ["=", "=", "=", "P"])
+
+    def test_repeated_ctrlid(self):
+        items = [self.serialized_sale("SQ:twice", 20), self.serialized_sale("SQ:twice", 30)]
+        response = self.client.post(self.url, items, format='json')
+        self.assertEqual([r['outcome'] for r in response.json()['results']], ["+", "U"])
+        self.assertEqual(Sale.objects.get(ctrlid="SQ:twice").total_paid_by_customer, 30)
+
+    def test_rejects_non_list(self):
+        response = self.client.post(self.url, {'ctrlid': "SQ:x"}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
 
 class TestJournalEntries(TestCase):
@@ -120,3 +184,217 @@ class TestJournalEntries(TestCase):
     def test_generate(self):
         # TODO: generatejournal should have a test mode that raises exceptions?
         call_command("generatejournal")
+        call_command("generatejournal", "--full")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestIncrementalJournal(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.sale = Sale.objects.create(total_paid_by_customer=100)
+        self.mdon = MonetaryDonation.objects.create(sale=self.sale, amount=100)
+        self.url = self.sale.get_absolute_url()
+
+    def test_changes_are_marked(self):
+        self.assertTrue(JournalerDirtyMarker.objects.filter(source_url=self.url).exists())
+
+    def test_only_marked_are_regenerated(self):
+        call_command("generatejournal")
+        self.assertFalse(JournalerDirtyMarker.objects.exists())
+        self.assertEqual(JournalEntry.objects.filter(source_url=self.url).count(), 1)
+
+        self.mdon.amount = 50
+        self.mdon.save()
+        self.sale.total_paid_by_customer = 50
+        self.sale.save()
+        call_command("generatejournal")
+        jes = JournalEntry.objects.filter(source_url=self.url)
+        self.assertEqual(jes.count(), 1)
+        debits, credits = jes[0].debit_and_credit_totals()
+        self.assertEqual(debits, Decimal("50.00"))
+        self.assertEqual(credits, Decimal("50.00"))
+
+    def test_deleted_journaler_loses_entries(self):
+        call_command("generatejournal")
+        self.sale.delete()
+        call_command("generatejournal")
+        self.assertFalse(JournalEntry.objects.filter(source_url=self.url).exists())
+
+    def test_daily_balances_are_patched(self):
+        earlier_sale = Sale.objects.create(total_paid_by_customer=10, sale_date=date(2018, 1, 1))
+        MonetaryDonation.objects.create(sale=earlier_sale, amount=10)
+        call_command("generatejournal", "--full")
+        cash = DailyAccountBalance.objects.get(account_id=1, day=self.sale.sale_date)
+        self.assertEqual(cash.increase, Decimal("100.00"))
+        self.assertEqual(cash.balance, Decimal("110.00"))
+
+        # Changing the earlier sale must also change the balance on later days.
+        earlier_sale.total_paid_by_customer = 20
+        earlier_sale.save()
+        call_command("generatejournal")
+        cash = DailyAccountBalance.objects.get(account_id=1, day=self.sale.sale_date)
+        self.assertEqual(cash.balance, Decimal("120.00"))
+
+        self.sale.delete()
+        call_command("generatejournal")
+        self.assertFalse(DailyAccountBalance.objects.filter(day=self.sale.sale_date).exists())
+        self.assertEqual(DailyAccountBalance.objects.get(account_id=1).balance, Decimal("20.00"))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestBatchSinks(TestCase):
+
+    fixtures = ['test_data']
+
+    def tearDown(self):
+        set_batch_sink(None)
+
+    def journal_using(self, sink):
+        set_batch_sink(sink)
+        call_command("generatejournal", "--full")
+        return sorted(JournalEntryLineItem.objects.values_list(
+            'journal_entry__source_url', 'journal_entry__when', 'account', 'action', 'amount', 'description'))
+
+    def test_copy_matches_bulk_create(self):
+        sale = Sale.objects.create(total_paid_by_customer=Decimal("10.10"), payer_name='Say "cheese",\nplease')
+        MonetaryDonation.objects.create(sale=sale, amount=Decimal("10.10"))
+        bulk = self.journal_using(BulkCreateSink())
+        copy = self.journal_using(PostgresCopySink())
+        self.assertEqual(len(bulk), 2)
+        self.assertEqual(bulk, copy)
+        call_command("benchjournalsinks", "--entries", "10")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestAccountHierarchy(TestCase):
+
+    def setUp(self):
+        def acct(name, parent=None):
+            return Account.objects.create(name=name, parent=parent,
+                category=Account.CAT_ASSET, type=Account.TYPE_DEBIT, description=name)
+        self.root = acct("Root")
+        self.b = acct("B", self.root)
+        self.a = acct("A", self.root)
+        self.a1 = acct("A1", self.a)
+
+    def test_closure(self):
+        links = AccountClosure.objects.filter(descendant=self.a1)
+        self.assertEqual(
+            sorted(links.values_list('ancestor_id', 'depth')),
+            sorted([(self.a1.id, 0), (self.a.id, 1), (self.root.id, 2)])
+        )
+        self.a1.parent = self.b
+        self.a1.save()
+        self.assertEqual(
+            set(AccountClosure.objects.filter(ancestor=self.b).values_list('descendant_id', flat=True)),
+            {self.b.id, self.a1.id}
+        )
+
+    def test_lookups(self):
+        self.assertEqual(Account.descendants_of(self.root), [self.a, self.a1, self.b])
+        self.assertEqual(Account.ancestors_of(self.a1), [self.a, self.root])
+        self.assertTrue(self.a1.is_subaccount_of(self.root))
+        self.assertFalse(self.a1.is_subaccount_of(self.b))
+        with self.assertNumQueries(0):
+            Account.descendants_of(self.a)
+            self.assertEqual(self.b.subaccounts, [])
+
+    def test_tree(self):
+        with self.assertNumQueries(2):  # The tree's generation, from the shared cache, and the accounts.
+            tree = [a for a in Account.tree() if a.id in (self.root.id, self.a.id, self.a1.id, self.b.id)]
+        self.assertEqual(tree, [self.root, self.a, self.a1, self.b])
+        self.assertEqual([a.depth for a in tree], [0, 1, 2, 1])
+
+    def test_change_in_another_process(self):
+        self.assertFalse(self.a1.is_subaccount_of(self.b))
+        # Like a save in another process, which doesn't clear this process's cache but does start a new generation.
+        Account.objects.filter(pk=self.a1.pk).update(parent=self.b)
+        caches[ACCOUNT_TREE_CACHE_ALIAS].set(ACCOUNT_TREE_GENERATION_KEY, "another", None)
+        Account.tree_cache_checked = float('-inf')  # Pretend ACCOUNT_TREE_CHECK_SECONDS have passed.
+        self.assertTrue(self.a1.is_subaccount_of(self.b))
+        self.assertFalse(self.a1.is_subaccount_of(self.a))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestOffsetFitting(TestCase):
+
+    @staticmethod
+    def slow_crossings(bank, cash, offset):
+        crossings = 0
+        r = [b-(c+offset) for b, c in zip(bank, cash)]
+        for i in range(1, len(r)):
+            if r[i-1] != 0 and r[i] != 0 and (r[i-1] > 0) != (r[i] > 0):
+                crossings += 1
+        return crossings
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.cash = [1000.0*rand.random() for _ in range(300)]
+        self.bank = [c + 1234 + rand.gauss(0, 200) for c in self.cash]
+
+    def test_count_crossings(self):
+        offsets = [0, 1000, 1234, 1500, 5000]
+        expected = [self.slow_crossings(self.bank, self.cash, o) for o in offsets]
+        self.assertEqual(list(count_crossings(self.bank, self.cash, offsets)), expected)
+        self.assertEqual(expected[0], 0)
+        self.assertGreater(expected[2], 0)
+
+    def test_fit_offset(self):
+        self.assertAlmostEqual(fit_offset(self.bank, self.cash), 1234, delta=50)
+        self.assertIsNone(fit_offset(self.bank, self.cash, lo=5000, hi=6000, step=100))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestTimeSeries(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        for day, amount in [(date(2018, 1, 1), 10), (date(2018, 1, 20), 5), (date(2018, 2, 3), 1)]:
+            sale = Sale.objects.create(total_paid_by_customer=amount, sale_date=day)
+            MonetaryDonation.objects.create(sale=sale, amount=amount)
+        call_command("generatejournal", "--full")
+
+    def test_buckets(self):
+        start, end = date(2018, 1, 1), date(2018, 12, 31)
+        rev = {Account.CAT_REVENUE: 1.0}
+        self.assertEqual(
+            cumulative_series(rev, start, end),
+            {'dates': ['2018-01-01', '2018-01-20', '2018-02-03'], 'values': [10.0, 15.0, 16.0]}
+        )
+        self.assertEqual(
+            cumulative_series(rev, start, end, "month"),
+            {'dates': ['2018-01-01', '2018-02-01'], 'values': [15.0, 16.0]}
+        )
+        self.assertEqual(cumulative_series({Account.CAT_REVENUE: -2.0}, start, end, "week")['values'], [-20.0, -30.0, -32.0])
+        with self.assertRaises(ValueError):
+            cumulative_series(rev, start, end, "year")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestParallelJournal(TransactionTestCase):
+    # Worker processes use their own db connections, so test data must actually be committed.
+
+    fixtures = ['test_data']
+
+    def test_parallel_matches_serial(self):
+        for amount in range(1, 11):
+            sale = Sale.objects.create(total_paid_by_customer=amount, ctrlid="PAR{}".format(amount))
+            MonetaryDonation.objects.create(sale=sale, amount=amount)
+
+        call_command("generatejournal", "--full")
+        serial = sorted(JournalEntry.objects.values_list('source_url', 'journalentrylineitem__amount'))
+
+        call_command("generatejournal", "--full", "--workers", "2")
+        parallel = sorted(JournalEntry.objects.values_list('source_url', 'journalentrylineitem__amount'))
+
+        self.assertEqual(len(serial), 20)
+        self.assertEqual(serial, parallel)
@@ -0,0 +1,57 @@
+# Standard
+from datetime import date
+from decimal import Decimal
+from typing import Dict, List, Union
+
+# Third Party
+from django.db.models import Case, When, Sum, Value, F, Window, DecimalField
+from django.db.models.functions import Trunc
+
+# Local
+from books.models import DailyAccountBalance
+
+__author__ = 'Adrian'
+
+BUCKET_DAY = "day"
+BUCKET_WEEK = "week"
+BUCKET_MONTH = "month"
+BUCKETS = [BUCKET_DAY, BUCKET_WEEK, BUCKET_MONTH]
+
+# A column oriented series, i.e. {'dates': [iso date strings], 'values': [floats]}
+Series = Dict[str, List[Union[str, float]]]
+
+
+def cumulative_series(category_factors: Dict[str, float], start: date, end: date, bucket: str = BUCKET_DAY) -> Series:
+    """
+    The running total, from start to end, of the activity in accounts of the given categories.
+    Each category's activity is multiplied by its factor, e.g. {CAT_REVENUE: 1.0, CAT_EXPENSE: -1.0} gives net income.
+    There's one point per bucket (day, week, or month) with activity, dated at the start of the bucket.
+    The aggregation is done by the database, so only the points of the series are loaded.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError("Bucket must be one of {}".format(", ".join(BUCKETS)))
+
+    # As before, a line item's amount counts regardless of its action.
+    amount = Case(
+        *[When(account__category=cat, then=(F('increase')+F('decrease'))*Value(Decimal(str(factor))))
+          for cat, factor in category_factors.items()],
+        default=Value(0),
+        output_field=DecimalField()
+    )
+    # The rollup already sums line items per account and day. The window's default frame includes all rows in
+    # the same period, so every row in a period gets the same running total and DISTINCT reduces them to one.
+    rows = DailyAccountBalance.objects.filter(
+        account__category__in=list(category_factors.keys()),
+        day__gte=start,
+        day__lte=end,
+    ).annotate(
+        period=Trunc('day', bucket),
+    ).annotate(
+        running=Window(Sum(amount), order_by=F('period').asc()),
+    ).values_list('period', 'running').distinct().order_by('period')
+
+    series = {'dates': [], 'values': []}  # type: Series
+    for period_start, running in rows:
+        series['dates'].append(period_start.isoformat())
+        series['values'].append(float(running))
+    return series
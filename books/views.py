@@ -18,19 +18,23 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import settings
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.db.models import Sum, F
 import requests
-from numpy import array
 
 
 # Local
+from abutils.restapi import BulkUpsertMixin
 from .models import (
     Account, ACCT_ASSET_CASH,
     BankAccount, BankAccountBalance,
     Sale, SaleNote, Note,
     MonetaryDonation,
     OtherItem, OtherItemType,
-    Journaler, JournalEntry, JournalEntryLineItem
+    Journaler, JournalEntry, JournalEntryLineItem,
+    DailyAccountBalance,
 )
+from .fitting import fit_offset
+from .timeseries import cumulative_series, BUCKETS, BUCKET_DAY
 from .serializers import (
     SaleSerializer, SaleNoteSerializer,
     MonetaryDonationSerializer,
@@ -117,7 +121,7 @@ def _shift(amount:float, pts:Iterator[DatedFloat]) -> Iterator[DatedFloat]:
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = SALE REST API
 
-class SaleViewSet(viewsets.ModelViewSet):  # Django REST Framework
+class SaleViewSet(BulkUpsertMixin, viewsets.ModelViewSet):  # Django REST Framework
     queryset = Sale.objects.all().order_by('-sale_date')
     serializer_class = SaleSerializer
     filter_fields = {'payment_method', 'ctrlid'}
@@ -128,7 +132,7 @@ class SaleNoteViewSet(viewsets.ModelViewSet):  # Django REST Framework
     serializer_class = SaleNoteSerializer
 
 
-class OtherItemViewSet(viewsets.ModelViewSet):  # Django REST Framework
+class OtherItemViewSet(BulkUpsertMixin, viewsets.ModelViewSet):  # Django REST Framework
     queryset = OtherItem.objects.all()
     serializer_class = OtherItemSerializer
     filter_fields = {'ctrlid'}
@@ -140,7 +144,7 @@ class OtherItemTypeViewSet(viewsets.ModelViewSet):  # Django REST Framework
     filter_fields = {'name'}
 
 
-class MonetaryDonationViewSet(viewsets.ModelViewSet):  # Django REST Framework
+class MonetaryDonationViewSet(BulkUpsertMixin, viewsets.ModelViewSet):  # Django REST Framework
     """
     API endpoint that allows monetary donations to be viewed or edited.
     """
@@ -174,31 +178,25 @@ def revenues_and_expenses_from_journal(request):
     if not request.user.member.is_tagged_with("Director"):
         return HttpResponse("This page is for Directors only.")
 
+    bucket = request.GET.get('bucket', BUCKET_DAY)
+    if bucket not in BUCKETS:
+        return HttpResponse("Bucket must be one of {}.".format(", ".join(BUCKETS)), status=400)
+
     start = date(2015, 1, 1)
     end = date.today()
 
-    def get_data(category, factor) -> List:
-        data = []
-        for jeli in JournalEntryLineItem.objects.filter(
-          account__category=category,
-          journal_entry__when__gte=start,
-          journal_entry__when__lte=end).prefetch_related('journal_entry'):  # type: JournalEntryLineItem
-            pt = (jeli.journal_entry.when.isoformat(), factor * float(jeli.amount))
-            data.append(pt)
-        return data
-
-    rev = get_data(Account.CAT_REVENUE, 1.0)
-    exp = get_data(Account.CAT_EXPENSE, -1.0)
-
-    net = rev+exp
-    acc_rev_vs_time = _acc(rev)
-    acc_exp_vs_time = _acc(exp)
-    acc_net_vs_time = _acc(net)
+    rev = Account.CAT_REVENUE
+    exp = Account.CAT_EXPENSE
+    series = {
+        'net': cumulative_series({rev: 1.0, exp: -1.0}, start, end, bucket),
+        'rev': cumulative_series({rev: 1.0}, start, end, bucket),
+        'exp': cumulative_series({exp: -1.0}, start, end, bucket),
+    }
 
     params = {
-        'net': acc_net_vs_time,
-        'rev': acc_rev_vs_time,
-        'exp': acc_exp_vs_time,
+        'series': json.dumps(series),
+        'bucket': bucket,
+        'buckets': BUCKETS,
     }
     return render(request, 'books/cumulative-rev-exp-chart.html', params)
 
@@ -206,29 +204,13 @@ def revenues_and_expenses_from_journal(request):
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 def get_cash_pts(start: date, end:date) -> List[DatedFloat]:
-    root_cash_acct = Account.get(ACCT_ASSET_CASH)
-    cash_accts = filter(
-        lambda x: x.is_subaccount_of(root_cash_acct) or x == root_cash_acct,
-        Account.objects.all()
-    ) # type: List[Account]
-    cash_acct_ids = map(
-        lambda x: x.id,
-        cash_accts
-    ) # type: List[int]
-
-    cash_jelis = JournalEntryLineItem.objects.filter(
-      account_id__in=cash_acct_ids,
-      journal_entry__when__gte=start,
-      journal_entry__when__lte=end
-    ).prefetch_related('journal_entry')
-
-    cash_deltas = []
-    for jeli in cash_jelis:  # type: JournalEntryLineItem
-        if jeli.action == JournalEntryLineItem.ACTION_BALANCE_DECREASE:
-            pt = (jeli.journal_entry.when, -1.0*float(jeli.amount))
-        else:
-            pt = (jeli.journal_entry.when, 1.0*float(jeli.amount))
-        cash_deltas.append(pt)
+    cash_days = DailyAccountBalance.objects.filter(
+      account__ancestor_links__ancestor_id=ACCT_ASSET_CASH,
+      day__gte=start,
+      day__lte=end
+    ).values('day').annotate(change=Sum(F('increase')-F('decrease')))
+
+    cash_deltas = [(row['day'], float(row['change'])) for row in cash_days]
     cash_pts = list(_fill(_acc(cash_deltas)))
     return cash_pts
 
@@ -268,34 +250,13 @@ def cashonhand_vs_time_chart(request):
     n = min(len(bank_pts), len(cash_pts))
     assert cash_pts[0][0] == bank_pts[0][0]
     assert cash_pts[n-1][0] == bank_pts[n-1][0]
-    bs = array([y for [x, y] in bank_pts[0:n]])
-    cs = array([y for [x, y] in cash_pts[0:n]])
-
-    optimal_offset = None
-
-    # This method uses least squares to find a fit between books and bank:
-    # sumofsq_min = None
-    # for i in range(n):
-    #     offset = bs[i]-cs[i]
-    #     residuals = (bs - (cs + offset))
-    #     sumofsq = (sum(residuals*residuals))
-    #     if sumofsq_min is None or sumofsq < sumofsq_min:
-    #         sumofsq_min = sumofsq
-    #         optimal_offset = offset
-
-    # This method uses crossing count to find a fit between books and bank:
-    crossings_max = 0
-    for offset in range(-50000, 50000, 100):
-        crossings = 0
-        r = (bs - (cs + offset))  # residuals
-        for i in range(1, n):
-            if r[i-1] == 0 or r[i] == 0:
-                continue
-            if r[i-1]/abs(r[i-1]) != r[i]/abs(r[i]):
-                crossings += 1
-        if crossings > crossings_max:
-            crossings_max = crossings
-            optimal_offset = offset
+    bs = [y for [x, y] in bank_pts[0:n]]
+    cs = [y for [x, y] in cash_pts[0:n]]
+
+    # Least squares was also tried, but the crossing count gives a better fit between books and bank.
+    optimal_offset = fit_offset(bs, cs)
+    if optimal_offset is None:
+        optimal_offset = 0.0
 
     params = {
         'cash': _shift(optimal_offset, cash_pts),
@@ -345,27 +306,14 @@ def squareup_webhook(request):
 @login_required
 def account_browser(request: HttpRequest):
 
-    def flatten_and_label(accts: List[Account]) -> List[Account]:
-        result = []
-        for acct in accts:
-            result.append(acct)
-            subaccts = list(acct.account_set.all())
-            for acct in flatten_and_label(subaccts):
-                result.append(acct)
-        return result
-
-    asset_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_ASSET))  # type: List[Account]
-    expense_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_EXPENSE))  # type: List[Account]
-    liability_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_LIABILITY))  # type: List[Account]
-    equity_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_EQUITY))  # type: List[Account]
-    revenue_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_REVENUE))  # type: List[Account]
+    accts = Account.tree()  # type: List[Account]
 
     params = {
-        'asset_accts': flatten_and_label(asset_root_accts),
-        'expense_accts': flatten_and_label(expense_root_accts),
-        'liability_accts': flatten_and_label(liability_root_accts),
-        'equity_accts': flatten_and_label(equity_root_accts),
-        'revenue_accts': flatten_and_label(revenue_root_accts),
+        'asset_accts': [a for a in accts if a.category == Account.CAT_ASSET],
+        'expense_accts': [a for a in accts if a.category == Account.CAT_EXPENSE],
+        'liability_accts': [a for a in accts if a.category == Account.CAT_LIABILITY],
+        'equity_accts': [a for a in accts if a.category == Account.CAT_EQUITY],
+        'revenue_accts': [a for a in accts if a.category == Account.CAT_REVENUE],
     }
 
     return render(request, 'books/account-browser.html', params)
@@ -428,20 +376,19 @@ def account_history(
         account=account_pk,
         journal_entry__when__gte=begin_date,
         journal_entry__when__lte=end_date,
-    ))
+    ).select_related('journal_entry').order_by('journal_entry__when'))
 
-    jelis.sort(key=lambda x: x.journal_entry.when)
+    totals = DailyAccountBalance.objects.filter(
+        account=account_pk,
+        day__gte=begin_date,
+        day__lte=end_date,
+    ).aggregate(increase_total=Sum('increase'), decrease_total=Sum('decrease'))
+    decrease_total = totals['decrease_total'] or Decimal("0.00")
+    increase_total = totals['increase_total'] or Decimal("0.00")
 
-    decrease_total = Decimal("0.00")
-    increase_total = Decimal("0.00")
     for jeli in jelis:  # type: JournalEntryLineItem
         je = jeli.journal_entry  # type: JournalEntry
-        if jeli.action == jeli.ACTION_BALANCE_INCREASE:
-            increase_total += jeli.amount
-            jeli.sign = 1
-        else:
-            decrease_total += jeli.amount
-            jeli.sign = -1
+        jeli.sign = 1 if jeli.action == jeli.ACTION_BALANCE_INCREASE else -1
         # DB contains abs URLs pointing to production, so I'll add relative urls.
         je.relative_source_url = urlsplit(je.source_url).path
 
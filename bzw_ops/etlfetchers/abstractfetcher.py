@@ -1,26 +1,38 @@
 # Standard
 import sys
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, timedelta
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar
 
 import abc
 # Third Party
 from django.db.models import Model
 from requests import Session
+from requests.adapters import HTTPAdapter
 from rest_framework.test import APIRequestFactory
 
 # Local
+from abutils.restapi import OUTCOME_ERROR
 import books.models as bm
 import books.serializers as bs
 import members.models as mm
 import members.restapi.serializers as ms
+from bzw_ops.etlfetchers.checkpoints import Checkpoint, CheckpointStore
 
+K = TypeVar('K')  # Identifies a page of source data, e.g. a date window or a cursor.
+P = TypeVar('P')  # A page of source data.
 
-def has_new_data(older, newer):
-    for newkey, newval in newer.items():
-        if newkey in ['id', 'protected']: continue
-        if newval is None: continue
-        if newkey not in older: return True
-        elif older[newkey] != newer[newkey]: return True
-    return False
+
+def keepalive_session(pool_size: int) -> Session:
+    """A session that keeps up to pool_size connections open to each host, so worker threads can share it."""
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class AbstractFetcher(object):
@@ -57,80 +69,220 @@ class AbstractFetcher(object):
         "DISCOVER": "Disc"
     }
 
-    djangosession = Session()
+    djangosession = keepalive_session(16)  # Shared by the upsert workers of all fetchers.
 
     progress_count = 0
     progress_per_row = 50
+    progress_lock = threading.Lock()  # Upsert workers report progress concurrently.
 
     django_auth_headers = None
 
+    serializer_context = None  # Shared by all fetchers, created when first needed.
+
+    upsert_batch_size = 250
+    upsert_buffers = None  # type: Optional[Dict[Type[Model], List[dict]]]
+
+    # Concurrency. Fetchers can set their own and the etl command can override them.
+    page_workers = 4  # Threads fetching the source's pages ahead of the one being transformed.
+    upsert_workers = 4  # Threads sending batches of buffered upserts.
+    max_pending_batches = 8  # buffered_upsert() waits while this many batches are waiting to be sent or being sent.
+
+    _loader = None  # type: Optional[ThreadPoolExecutor]
+    _loader_slots = None  # type: Optional[threading.BoundedSemaphore]
+    _in_flight = None  # type: Optional[List[Future]]
+    _pending_checkpoints = None  # type: Optional[deque]  # Of (futures, checkpoint) waiting for the futures.
+    _rejected = False  # True once the website has rejected an item. No checkpoints are recorded after that.
+
+    # Set by the etl command. See start_date().
+    checkpoints = None  # type: Optional[CheckpointStore]
+    since = None  # type: Optional[date]
+    full = False
+    overlap = timedelta(days=7)
+
     @abc.abstractmethod
     def fetch(self):
         """Extract, transform, and load data."""
         raise NotImplementedError("fetch() is not implemented")
 
     def _fetch_complete(self):
+        self.flush_upserts()
+        if self._loader is not None:
+            self._loader.shutdown()
+            self._loader = None
         if self.progress_count % self.progress_per_row != 0:
             print("")
 
+    def prefetched(self, fetch_page: Callable[[K], P], keys: Iterable[K]) -> Iterator[Tuple[K, P]]:
+        """
+        Yields (key, fetch_page(key)) for each of the keys, in order. While the caller transforms a page,
+        the next page_workers pages are fetched by a pool of threads. Use when the keys are known in advance.
+        """
+        keys = iter(keys)
+        with ThreadPoolExecutor(max_workers=max(self.page_workers, 1)) as pool:
+            pending = deque((key, pool.submit(fetch_page, key)) for key in islice(keys, max(self.page_workers, 1)))
+            while len(pending) > 0:
+                key, future = pending.popleft()
+                page = future.result()
+                for next_key in islice(keys, 1):
+                    pending.append((next_key, pool.submit(fetch_page, next_key)))
+                yield key, page
+
+    def chained(self, fetch_page: Callable[[K], P], first_key: K, next_key: Callable[[P], Optional[K]]) \
+            -> Iterator[Tuple[K, P]]:
+        """
+        Yields (key, page) for a source whose pages each say where the next one is, starting with first_key and
+        ending when next_key() returns None. The next page is fetched while the caller transforms the current one.
+        """
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            key, future = first_key, pool.submit(fetch_page, first_key)
+            while future is not None:
+                page = future.result()
+                following = next_key(page)
+                this_key, key = key, following
+                future = None if following is None else pool.submit(fetch_page, following)
+                yield this_key, page
+
+    @property
+    def name(self) -> str:
+        """The fetcher's module name, e.g. "square". Checkpoints are recorded under it."""
+        return type(self).__module__.split(".")[-1]
+
+    def _checkpoint(self, account: str) -> Checkpoint:
+        """The account's checkpoint, unless this run ignores them."""
+        if self.checkpoints is None or self.full or self.since is not None:
+            return Checkpoint(None, None)
+        return self.checkpoints.get(self.name, account)
+
+    def start_date(self, account: str, origin: date) -> date:
+        """
+        The date from which to fetch the account's data. origin is the earliest date the source has data for.
+        Normally this is the account's watermark, less the overlap in case the source was late to report
+        something. It's origin for a full resync or if there's no watermark yet, and the since date if given.
+        """
+        if self.since is not None:
+            return self.since
+        watermark = self._checkpoint(account).watermark
+        if watermark is None:
+            return origin
+        return max(watermark - self.overlap, origin)
+
+    def resume_cursor(self, account: str) -> Any:
+        """Where the account's last walk through the source's pages left off, if it was interrupted."""
+        return self._checkpoint(account).cursor
+
+    def save_checkpoint(self, account: str, watermark: Optional[date] = None, cursor: Any = None) -> None:
+        """
+        Record progress on the account. It's recorded once everything upserted so far has been sent, so the
+        checkpoint never gets ahead of what the website has, but the fetcher doesn't wait for that.
+        Runs with a since date don't record checkpoints since they may have skipped data.
+        """
+        if self.checkpoints is None or self.since is not None:
+            return
+        self._send_buffered()
+        if self._pending_checkpoints is None:
+            self._pending_checkpoints = deque()
+        self._pending_checkpoints.append((list(self._in_flight or []), (account, watermark, cursor)))
+        self._record_checkpoints()
+
+    def _record_checkpoints(self) -> None:
+        """
+        Record the pending checkpoints, in order, whose upserts have all been sent. Once the website rejects an
+        item, i.e. its outcome is "E", no more are recorded, so that the next run fetches the item again.
+        """
+        pending = self._pending_checkpoints or deque()
+        while len(pending) > 0 and all(future.done() for future in pending[0][0]):
+            futures, (account, watermark, cursor) = pending.popleft()
+            for future in futures:
+                self._note_results(future.result())  # Don't record progress past a batch that failed.
+            if self._rejected:
+                continue
+            self.checkpoints.put(self.name, account, watermark, cursor)
+
+    def _note_results(self, results: List[dict]) -> None:
+        if not self._rejected and any(result['outcome'] == OUTCOME_ERROR for result in results):
+            self._rejected = True
+            print("\nThe website rejected an item, so progress won't be recorded and the next run will retry it.")
+
     def _massage_sale(self, sale):
         if len(sale.payer_email) > 40:
             sale.payer_email = ""
 
-    def upsert(self, item: Model) -> dict:
-
+    def _serialize(self, item: Model) -> dict:
         if type(item) == bm.Sale: self._massage_sale(item)
+        # The serializers require a Django or DjangoRestFramework "Request" as context.
+        # see http://stackoverflow.com/questions/10277748/how-to-get-request-object-in-django-unit-testing
+        if self.serializer_context is None:
+            AbstractFetcher.serializer_context = {
+                'request': APIRequestFactory().get('/', SERVER_NAME=self.SERVERNAME, secure=True)
+            }
+        return dict(self.SERIALIZERS[type(item)](item, context=self.serializer_context).data)
 
-        url = self.URLBASE + self.URLS[type(item)]
-        serializer = self.SERIALIZERS[type(item)]
-
-        # See if the item has previously been sent:
-        get_params = {'ctrlid': item.ctrlid}
-        response = self.djangosession.get(url, params=get_params, headers=self.django_auth_headers)
+    def _bulk_upsert(self, model: Type[Model], srcdata: List[dict]) -> List[dict]:
+        """Send the serialized items to the website's bulk upsert endpoint. Returns the result for each."""
+        url = self.URLBASE + self.URLS[model] + "bulk-upsert/"
+        response = self.djangosession.post(url, json=srcdata, headers=self.django_auth_headers)
         if response.status_code >= 300:
             raise AssertionError("Unexpected status code from Django: "+str(response.status_code))
-        matchcount = int(response.json()['count'])
-        if matchcount == 0:
-            id = None
-        elif matchcount == 1:
-            djangodata = response.json()['results'][0]
-            id = int(djangodata['id'])
-        else:
-            # Else case is an assertion that matchcount is 0 or 1.
-            raise AssertionError("Too many matches for %s with ctrlid %s" % (str(type(item)), item.ctrlid))
+        results = response.json()['results']
+        with self.progress_lock:
+            for result in results:
+                print(result['outcome'], end='')  # Progress indicator
+                self.progress_count += 1
+                if self.progress_count % self.progress_per_row == 0:
+                    print(" {}".format(self.progress_count))
+            sys.stdout.flush()
+        return results
 
-        # Creating srcdata is complicated by the fact that the API is now using HyperlinkedIdentityField
-        # It requires a Django or DjangoRestFramework "Request" as context.
-        # see http://stackoverflow.com/questions/10277748/how-to-get-request-object-in-django-unit-testing
-        context = {'request':APIRequestFactory().get('/', SERVER_NAME=self.SERVERNAME, secure=True)}
-        srcdata = serializer(item, context=context).data
-
-        # Either POST or PUT depending on whether it already exists
-        if id is None:
-            # The information is not yet on the website, so add it.
-            response = self.djangosession.post(url, srcdata, headers=self.django_auth_headers)
-            djangodata = response.json()
-            progchar = "+"  # Added
-        else:
-            #srcdata.update({'id': djangodata['id'], 'protected': False})  # So subset comparison can be made.
-            if djangodata['protected']:
-                progchar = "P"  # Protected, so will leave it alone.
-            elif has_new_data(djangodata, srcdata):
-                update_url = "{}{}/".format(url, id)
-                response = self.djangosession.put(update_url, srcdata, headers=self.django_auth_headers)
-                progchar = "U"  # Change detected so updated.
-            else:
-                progchar = "="  # Equal so no add or update required. Will leave it alone.
-        if response.status_code >= 300:
-            progchar = "E"  # Error
+    def _send_later(self, model: Type[Model], srcdata: List[dict]) -> None:
+        """Have an upsert worker send the batch. Waits if too many batches are already waiting to be sent."""
+        if self._loader is None:
+            self._loader = ThreadPoolExecutor(max_workers=max(self.upsert_workers, 1))
+            self._loader_slots = threading.BoundedSemaphore(max(self.max_pending_batches, 1))
+            self._in_flight = []
+        slots = self._loader_slots
+        slots.acquire()
+        future = self._loader.submit(self._bulk_upsert, model, srcdata)
+        future.add_done_callback(lambda _: slots.release())
+        # Raise any failure as soon as it's noticed rather than when the fetch completes.
+        for done in [f for f in self._in_flight if f.done()]:
+            done.result()
+        self._in_flight = [f for f in self._in_flight if not f.done()] + [future]
+
+    def upsert(self, item: Model) -> dict:
+        """
+        Add the item to the website, or update it if it's there and isn't protected. Returns the website's data for
+        the item, or the errors if it couldn't be stored. Use buffered_upsert() if the result isn't needed.
+        """
+        results = self._bulk_upsert(type(item), [self._serialize(item)])
+        self._note_results(results)
+        return results[0]['data']
+
+    def buffered_upsert(self, item: Model) -> None:
+        """
+        Like upsert(), but items are sent in batches by the upsert workers while the fetcher carries on.
+        Anything still buffered is sent by _fetch_complete().
+        """
+        if self.upsert_buffers is None:
+            self.upsert_buffers = defaultdict(list)
+        buffer = self.upsert_buffers[type(item)]
+        buffer.append(self._serialize(item))
+        if len(buffer) >= self.upsert_batch_size:
+            self._send_later(type(item), buffer)
+            self.upsert_buffers[type(item)] = []
 
-        print(progchar, end='')  # Progress indicator
-        self.progress_count += 1
-        if self.progress_count % self.progress_per_row == 0:
-            print(" {}".format(self.progress_count))
-        sys.stdout.flush()
+    def _send_buffered(self) -> None:
+        for model, buffer in list((self.upsert_buffers or {}).items()):
+            if len(buffer) > 0:
+                self._send_later(model, buffer)
+                self.upsert_buffers[model] = []
 
-        return djangodata
+    def flush_upserts(self) -> None:
+        """Send everything that's buffered and wait until it has all been sent."""
+        self._send_buffered()
+        for future in self._in_flight or []:
+            future.result()
+        self._in_flight = []
+        self._record_checkpoints()
 
     def _get_id(self, url: str, filter: dict) -> dict:
         response = self.djangosession.get(self.URLBASE+url, params=filter, headers=self.django_auth_headers)
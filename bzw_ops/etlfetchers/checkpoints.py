@@ -0,0 +1,58 @@
+# Standard
+import json
+import os
+import threading
+from datetime import date, datetime
+from typing import Any, NamedTuple, Optional
+
+# Third Party
+
+# Local
+
+__author__ = 'Adrian'
+
+# The ETL runs on a machine other than the web server, so its progress is kept in a local file.
+DEFAULT_PATH = os.getenv('BZWOPS_ETL_STATE_FILE', os.path.expanduser("~/.bzwops-etl-checkpoints.json"))
+
+
+class Checkpoint(NamedTuple):
+    watermark: Optional[date]  # Everything dated before this has been fetched.
+    cursor: Any  # Where an interrupted walk through the source's pages left off, in the source's own terms.
+
+
+class CheckpointStore(object):
+    """Each fetcher's progress, per account, in a JSON file. The file is rewritten after every change."""
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()  # Fetchers run concurrently.
+        self._state = {}  # type: dict
+        if os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+
+    def get(self, fetcher: str, account: str) -> Checkpoint:
+        with self._lock:
+            entry = dict(self._state.get(fetcher, {}).get(account, {}))
+        watermark = entry.get('watermark')
+        return Checkpoint(
+            None if watermark is None else date.fromisoformat(watermark),
+            entry.get('cursor'),
+        )
+
+    def put(self, fetcher: str, account: str, watermark: Optional[date] = None, cursor: Any = None) -> None:
+        """Record progress. A watermark of None leaves the existing one alone. A cursor of None clears it."""
+        with self._lock:
+            entry = self._state.setdefault(fetcher, {}).setdefault(account, {})
+            if watermark is not None:
+                entry['watermark'] = watermark.isoformat()
+            entry['cursor'] = cursor
+            entry['updated'] = datetime.now().isoformat(timespec='seconds')
+            self._save()
+
+    def _save(self) -> None:
+        # Write a new file and swap it in, so an interrupted run can't leave a truncated one behind.
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -3,6 +3,7 @@
 import sys
 from decimal import Decimal
 from datetime import datetime, date
+from typing import Optional, Tuple
 
 # Third Party
 from dateutil.parser import parse
@@ -20,6 +21,10 @@ from xis.xerocraft_org_utils.paypalscraper import PaypalScraper
 # Note: This class must be named Fetcher in order for dynamic load to find it.
 class Fetcher(AbstractFetcher):
 
+    PAYMENTS_ACCOUNT = "payments"  # Checkpoints for billing agreements are kept under "agreement:<id>".
+    PAYMENTS_ORIGIN = date(2015, 3, 6)
+    AGREEMENTS_ORIGIN = date(2016, 1, 1)
+
     # TODO: Prices should be factored out in to something that's available to all fetchers.
     prices = {
         1: Decimal(50.00),
@@ -44,13 +49,13 @@ class Fetcher(AbstractFetcher):
         mship.start_date = sale.sale_date
         mship.end_date = mship.start_date + relativedelta(months=months, days=-1)
         mship.sale_price = Decimal(primary_membership_price)
-        self.upsert(mship)
+        self.buffered_upsert(mship)
 
         for f in range(1, fam_count+1):
             mship.membership_type = Membership.MT_FAMILY
             mship.ctrlid = "{}:{}".format(sale.ctrlid, f)
             mship.sale_price = Decimal(months*10.00)
-            self.upsert(mship)
+            self.buffered_upsert(mship)
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
     # ONE-TIME PAYMENTS created up by Xerocraft.org (for class donations, fees)
@@ -62,7 +67,7 @@ class Fetcher(AbstractFetcher):
         don.sale = sale
         don.amount = sale.total_paid_by_customer
         # TODO: Add earmark
-        self.upsert(don)
+        self.buffered_upsert(don)
 
     def _process_non_recurring_membership_item(self, sale: Sale, description: str):
         """ Takes a sale and a descripton like MSHIP_06_MONTH and creates a membership """
@@ -84,7 +89,7 @@ class Fetcher(AbstractFetcher):
         other.sale = sale
         other.sale_price = sale.total_paid_by_customer
         other.qty_sold = 1
-        self.upsert(other)
+        self.buffered_upsert(other)
 
     PAYMENTS_TO_IGNORE = [
         'PAY-83R23166VG575420MK7EIF3Y',  # A test by Kyle that doesn't seem to match other refund cases.
@@ -214,8 +219,16 @@ class Fetcher(AbstractFetcher):
 
         self._member_and_family(sale, 1)
 
-    def _process_agreement(self, agreement: sdk.BillingAgreement):
-        transactions = agreement.search_transactions("2016-01-01", date.today().isoformat())
+    def _agreement_account(self, agreement_id: str) -> str:
+        return "agreement:{}".format(agreement_id)
+
+    def _fetch_agreement(self, agreement_id: str) -> Tuple[sdk.BillingAgreement, dict]:
+        agreement = sdk.BillingAgreement.find(agreement_id)
+        start = self.start_date(self._agreement_account(agreement_id), self.AGREEMENTS_ORIGIN)
+        transactions = agreement.search_transactions(start.isoformat(), date.today().isoformat())
+        return agreement, transactions
+
+    def _process_agreement(self, agreement: sdk.BillingAgreement, transactions: dict):
         for transaction in transactions['agreement_transaction_list']:
             stat = transaction["status"]
             if stat == 'Created':
@@ -252,26 +265,35 @@ class Fetcher(AbstractFetcher):
     def fetch(self):
 
         # Process billing agreements that were set up by the xerocraft.org website:
+        today = date.today()
         scraper = PaypalScraper()
         agreement_ids = scraper.scrape_agreement_ids()
-        for agreement_id in agreement_ids:
-            agreement = sdk.BillingAgreement.find(agreement_id)
-            self._process_agreement(agreement)
-
-        # Process all other payments:
-        next_id = None
-        while True:
-            hist_params = {"count": 20}
-            if next_id is not None:
-                hist_params["start_id"] = next_id
-            else:
-                hist_params["start_time"] = "2015-03-06T11:00:00Z"
-            payment_history = sdk.Payment.all(hist_params)
-            payments = payment_history.payments
-            for payment in payments:
+        for agreement_id, (agreement, transactions) in self.prefetched(self._fetch_agreement, agreement_ids):
+            self._process_agreement(agreement, transactions)
+            self.save_checkpoint(self._agreement_account(agreement_id), watermark=today)
+
+        # Process all other payments. They're listed newest first, so the watermark can't advance until
+        # the walk through the pages is complete. Until then, the cursor records how far it got.
+        cursor = self.resume_cursor(self.PAYMENTS_ACCOUNT)
+        if cursor is None:
+            start = self.start_date(self.PAYMENTS_ACCOUNT, self.PAYMENTS_ORIGIN)
+            cursor = {
+                'began': today.isoformat(),
+                'start_time': "{}T00:00:00Z".format(start.isoformat()),
+                'start_id': None,
+            }
+
+        def fetch_page(start_id: Optional[str]):
+            hist_params = {"count": 20, "start_time": cursor['start_time']}
+            if start_id is not None:
+                hist_params["start_id"] = start_id
+            return sdk.Payment.all(hist_params)
+
+        for _, payment_history in self.chained(fetch_page, cursor['start_id'], lambda page: page.next_id):
+            for payment in payment_history.payments:
                 self._process_payment(payment)
-            next_id = payment_history.next_id
-            if next_id is None:
-                break
+            if payment_history.next_id is not None:
+                self.save_checkpoint(self.PAYMENTS_ACCOUNT, cursor=dict(cursor, start_id=payment_history.next_id))
+        self.save_checkpoint(self.PAYMENTS_ACCOUNT, watermark=date.fromisoformat(cursor['began']))
 
         self._fetch_complete()
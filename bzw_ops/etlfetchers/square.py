@@ -3,6 +3,7 @@
 from decimal import Decimal
 from datetime import date
 from time import sleep
+from typing import Optional
 
 # Third Party
 import requests
@@ -23,6 +24,10 @@ class Fetcher(AbstractFetcher):
 
     squaresession = requests.Session()
 
+    ORIGIN = date(2015, 12, 1)  # The earliest date fetched. See REVIEW in fetch().
+
+    page_workers = 2  # Square limits the request rate.
+
     def month_in_str(self, str):
         str = str.lower()
         if "january"     in str: return 1  # TODO: Payment for Jan year X+1 in Dec year X
@@ -83,7 +88,7 @@ class Fetcher(AbstractFetcher):
             mship.end_date = mship.start_date + relativedelta(**{dur_unit:dur_amt, "days":-1})
             mship.sale_price = Decimal(item['gross_sales_money']['amount']) / Decimal(quantity * 100.0)
             mship.sale_price -= Decimal(10.00) * Decimal(family)
-            self.upsert(mship)
+            self.buffered_upsert(mship)
 
             for f in range(family):
                 fam = Membership()
@@ -93,7 +98,7 @@ class Fetcher(AbstractFetcher):
                 fam.start_date      = mship.start_date
                 fam.end_date        = mship.end_date
                 fam.ctrlid          = "{}:{}".format(mship.ctrlid, f)
-                self.upsert(fam)
+                self.buffered_upsert(fam)
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
     # PROCESS DONATION ITEM
@@ -107,7 +112,7 @@ class Fetcher(AbstractFetcher):
             don.ctrlid = "{}:{}:{}".format(sale['ctrlid'], item_num, n)
             don.sale = Sale(id=sale['id'])
             don.amount = Decimal(item["gross_sales_money"]["amount"]) / Decimal(quantity * 100.0)
-            self.upsert(don)
+            self.buffered_upsert(don)
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
     # PROCESS GIFTCARD ITEM
@@ -121,7 +126,7 @@ class Fetcher(AbstractFetcher):
             cardref.ctrlid = "{}:{}:{}".format(sale['ctrlid'], item_num, n)
             cardref.sale = Sale(id=sale['id'])
             cardref.sale_price = Decimal(item["net_sales_money"]["amount"]) / Decimal(quantity * 100.0)
-            self.upsert(cardref)
+            self.buffered_upsert(cardref)
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
     # PROCESS OTHER ITEM
@@ -204,7 +209,7 @@ class Fetcher(AbstractFetcher):
         other.qty_sold = int(float(item['quantity']))
         other.ctrlid = "{}:{}".format(sale['ctrlid'], item_num)
 
-        self.upsert(other)
+        self.buffered_upsert(other)
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
     # PROCESS ITEMS
@@ -335,7 +340,7 @@ class Fetcher(AbstractFetcher):
         mship.start_date = date(2014, 12, 12)
         mship.end_date = date(2015, 6, 11)
         mship.sale_price = 225.00
-        self.upsert(mship)
+        self.buffered_upsert(mship)
 
     def _special_case_0JFN0loJ0kcy8DXCvuDVwwMF(self, sale):
         # Verify: This was erroneously entered as a donation but was really a work-trade payment.
@@ -347,7 +352,7 @@ class Fetcher(AbstractFetcher):
         mship.start_date = date(2015, 12, 1)
         mship.end_date = date(2015, 12, 31)
         mship.sale_price = 10.00
-        self.upsert(mship)
+        self.buffered_upsert(mship)
 
     def _special_case_7cQ69ctaeYok1Ry3KOTFbyMF(self, sale):
         mship = Membership()
@@ -357,7 +362,7 @@ class Fetcher(AbstractFetcher):
         mship.start_date = date(2016, 4, 5)
         mship.end_date = date(2015, 4, 18)
         mship.sale_price = 25.00
-        self.upsert(mship)
+        self.buffered_upsert(mship)
 
 
     SALES_TO_SKIP = [
@@ -367,6 +372,13 @@ class Fetcher(AbstractFetcher):
         "CGvCOYS9VFEVgKlr6fP4KQB",  # Fully refunded. This was an accidental cash purchase. Redid it as credit.
     ]
 
+    def _is_skipped(self, payment) -> bool:
+        if payment['tender'][0]['type'] == "NO_SALE":
+            return True
+        if payment['id'] in self.SALES_TO_SKIP:
+            return True
+        return len(payment["tender"]) != 1
+
     def _process_payments(self, payments):
 
         for payment in payments:
@@ -377,18 +389,14 @@ class Fetcher(AbstractFetcher):
             #      and payment.refunds[0].payment_id == payment.id
             #      and payment.refunds[0].type == "FULL"
 
-            if payment['tender'][0]['type'] == "NO_SALE":
-                continue
-
-            if payment['id'] in self.SALES_TO_SKIP: continue
-
-            if len(payment["tender"]) != 1:
-                print("Code doesn't handle multiple tenders as in {}. Skipping.".format(payment['id']))
+            if self._is_skipped(payment):
+                if len(payment["tender"]) != 1:
+                    print("Code doesn't handle multiple tenders as in {}. Skipping.".format(payment['id']))
                 continue
 
             sale = Sale()
             sale.sale_date = parse(payment["created_at"]).date()
-            sale.payer_name = self.get_name_from_receipt(payment['receipt_url'])
+            sale.payer_name = payment['receipt_name']
             sale.payer_email = ""  # Annoyingly, not provided by Square.
             sale.payment_method = Sale.PAID_BY_SQUARE
             sale.method_detail = self._get_tender_type(payment)
@@ -430,9 +438,10 @@ class Fetcher(AbstractFetcher):
     # INIT & ABSTRACT METHODS
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
-    def __init__(self):
-        merchant_id = input("Square Merchant ID: ")
-        rest_token = input("Square Token: ")
+    def __init__(self, merchant_id: Optional[str] = None, rest_token: Optional[str] = None):
+        # Asks for whatever isn't given.
+        if merchant_id is None: merchant_id = input("Square Merchant ID: ")
+        if rest_token is None: rest_token = input("Square Token: ")
         if len(merchant_id) + len(rest_token) == 0:
             self.skip = True
         else:
@@ -455,11 +464,7 @@ class Fetcher(AbstractFetcher):
 
         payments_url = "https://connect.squareup.com/v1/{}/payments".format(self.merchant_id)
 
-        # REVIEW: In code below, startdate 2013-12-01 and 1 month windows didn't get newer sales.
-        # REVIEW: Don't know why but starting at 2015-12-01 and using 2 week windows does work.
-        window_start = date(2015, 12, 1)  # date(2013, 12, 1)
-        while window_start <= date.today():
-            window_start = window_start + relativedelta(weeks=+1)
+        def fetch_window(window_start: date) -> list:
             window_end = window_start + relativedelta(weeks=+1)
             get_data = {
                 'begin_time': window_start.isoformat(),
@@ -476,7 +481,23 @@ class Fetcher(AbstractFetcher):
                         response = None
                 except requests.exceptions.ConnectionError:
                     print("!", end='')
-
             payments = response.json()
+            # Names are only available from the receipt pages, which are also fetched ahead.
+            for payment in payments:
+                if not self._is_skipped(payment):
+                    payment['receipt_name'] = self.get_name_from_receipt(payment['receipt_url'])
+            return payments
+
+        # REVIEW: In code below, startdate 2013-12-01 and 1 month windows didn't get newer sales.
+        # REVIEW: Don't know why but starting at 2015-12-01 and using 2 week windows does work.
+        today = date.today()
+        window_starts = []
+        window_start = self.start_date(self.merchant_id, self.ORIGIN)
+        while window_start <= today:
+            window_starts.append(window_start)
+            window_start = window_start + relativedelta(weeks=+1)
+
+        for window_start, payments in self.prefetched(fetch_window, window_starts):
             self._process_payments(payments)
+            self.save_checkpoint(self.merchant_id, watermark=min(window_start + relativedelta(weeks=+1), today))
         self._fetch_complete()
\ No newline at end of file
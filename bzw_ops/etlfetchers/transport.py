@@ -0,0 +1,218 @@
+# Standard
+import base64
+import gzip
+import hashlib
+import json
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses as REASONS
+from typing import Deque, Dict, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Third Party
+from django.db import connection
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from rest_framework.test import APIClient
+
+# Local
+from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher
+
+__author__ = 'Adrian'
+
+# These describe the body as it was sent over the wire, which isn't how it's recorded.
+UNRECORDED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'set-cookie'}
+
+
+class UnrecordedRequest(Exception):
+    """A request was made while replaying and the cassette has no (more) responses for it."""
+    pass
+
+
+def request_key(request: PreparedRequest) -> str:
+    """
+    Identifies a request for replay: its method, its URL with the query parameters in a standard order, and a
+    digest of its body. Headers aren't included, so credentials don't matter when replaying.
+    """
+    parts = urlsplit(request.url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    url = urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode()
+    return "{} {} {}".format(request.method, url, hashlib.sha1(body).hexdigest())
+
+
+class Exchange(NamedTuple):
+    """A request, identified by its key, and the response it got."""
+    key: str
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+    @classmethod
+    def of(cls, key: str, status: int, headers: dict, body: bytes) -> 'Exchange':
+        headers = {name: value for name, value in headers.items() if name.lower() not in UNRECORDED_HEADERS}
+        return cls(key, status, headers, body)
+
+    def response(self, request: PreparedRequest) -> Response:
+        response = Response()
+        response.status_code = self.status
+        response.reason = REASONS.get(self.status, "")
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = self.body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        return response
+
+    def as_json(self) -> dict:
+        data = {'key': self.key, 'status': self.status, 'headers': self.headers}
+        try:
+            data['text'] = self.body.decode()
+        except UnicodeDecodeError:
+            data['base64'] = base64.b64encode(self.body).decode()
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Exchange':
+        body = data['text'].encode() if 'text' in data else base64.b64decode(data['base64'])
+        return cls(data['key'], data['status'], data['headers'], body)
+
+
+class Cassette(object):
+    """
+    Recorded exchanges, kept in a gzipped file with one JSON exchange per line. When replaying, the responses
+    to repeats of a request are given in the order they were recorded.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path  # None for a cassette that's only kept in memory, e.g. a synthetic one.
+        self._lock = threading.Lock()  # Fetchers and their workers make requests concurrently.
+        self._exchanges = defaultdict(deque)  # type: Dict[str, Deque[Exchange]]
+        self._count = 0
+
+    @classmethod
+    def load(cls, path: str) -> 'Cassette':
+        cassette = cls(path)
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                cassette.add(Exchange.from_json(json.loads(line)))
+        return cassette
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, exchange: Exchange) -> None:
+        with self._lock:
+            self._exchanges[exchange.key].append(exchange)
+            self._count += 1
+
+    def take(self, key: str) -> Exchange:
+        """The next recorded response to the request. Each is only given once."""
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                raise UnrecordedRequest(key)
+            self._count -= 1
+            return exchanges.popleft()
+
+    def save(self) -> None:
+        with self._lock:
+            with gzip.open(self.path, "wt") as f:
+                for exchanges in self._exchanges.values():
+                    for exchange in exchanges:
+                        f.write(json.dumps(exchange.as_json(), sort_keys=True) + "\n")
+
+
+class DjangoStandIn(object):
+    """
+    Answers requests for the website in-process, with its REST API views and the configured database,
+    e.g. a test database. Requests are handled one at a time on the stand-in's own thread, like a single server
+    process, and are authenticated as the given user whatever credentials they carry.
+    """
+
+    def __init__(self, user, host: str = AbstractFetcher.SERVERNAME):
+        self.host = host
+        self.user = user
+        self._server = ThreadPoolExecutor(max_workers=1)
+        self._client = None  # type: Optional[APIClient]  # Only used on the server thread.
+
+    def handles(self, request: PreparedRequest) -> bool:
+        return urlsplit(request.url).netloc == self.host
+
+    def exchange(self, key: str, request: PreparedRequest) -> Exchange:
+        return self._server.submit(self._handle, key, request).result()
+
+    def _handle(self, key: str, request: PreparedRequest) -> Exchange:
+        if self._client is None:
+            self._client = APIClient()
+            self._client.force_authenticate(self.user)
+        parts = urlsplit(request.url)
+        path = parts.path if parts.query == "" else "{}?{}".format(parts.path, parts.query)
+        response = self._client.generic(
+            request.method, path,
+            data=request.body or "",
+            content_type=request.headers.get('Content-Type', "application/octet-stream"),
+            secure=True,
+            HTTP_HOST=self.host,
+            HTTP_ACCEPT=request.headers.get('Accept', "application/json"),
+        )
+        return Exchange.of(key, response.status_code, dict(response.items()), response.content)
+
+    def close(self) -> None:
+        """Closes the server thread's database connection, e.g. so that the database can be dropped."""
+        self._server.submit(lambda: connection.close()).result()
+        self._server.shutdown()
+
+
+class Transport(object):
+    """
+    While in effect, every request made with the requests library, by the fetchers or the SDKs they use, goes
+    through this. Requests for the website go to the stand-in, if there is one. Other requests are answered from
+    the replay cassette, if there is one, or else are sent for real. Everything that isn't replayed is added to
+    the record cassette, if there is one, which is saved at the end.
+    """
+
+    _original_send = None
+
+    def __init__(self, record: Optional[Cassette] = None, replay: Optional[Cassette] = None,
+                 stand_in: Optional[DjangoStandIn] = None):
+        self.record = record
+        self.replay = replay
+        self.stand_in = stand_in
+
+    def __enter__(self) -> 'Transport':
+        if Transport._original_send is not None:
+            raise RuntimeError("Another transport is already in effect.")
+        original_send = Transport._original_send = HTTPAdapter.send
+
+        def send(adapter, request, *args, **kwargs):
+            return self._send(original_send, adapter, request, *args, **kwargs)
+
+        HTTPAdapter.send = send
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        HTTPAdapter.send = Transport._original_send
+        Transport._original_send = None
+        if self.record is not None:
+            self.record.save()
+
+    def _send(self, original_send, adapter, request: PreparedRequest, *args, **kwargs) -> Response:
+        key = request_key(request)
+        if self.stand_in is not None and self.stand_in.handles(request):
+            exchange = self.stand_in.exchange(key, request)
+            response = exchange.response(request)
+        elif self.replay is not None:
+            return self.replay.take(key).response(request)
+        else:
+            response = original_send(adapter, request, *args, **kwargs)
+            exchange = Exchange.of(key, response.status_code, dict(response.headers), response.content)
+        if self.record is not None:
+            self.record.add(exchange)
+        return response
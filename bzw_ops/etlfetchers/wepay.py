@@ -41,7 +41,7 @@ class Fetcher(AbstractFetcher):
         if checkout['fee_payer'] == 'payer': don.amount -= sale.processing_fee
         if earmark is not None:
             don.earmark = earmark
-        self.upsert(don)
+        self.buffered_upsert(don)
 
     def _process_membership_sale(self, sale, checkout, months, family):
 
@@ -53,7 +53,7 @@ class Fetcher(AbstractFetcher):
         mship.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, checkout['checkout_id'])
         mship.start_date = sale.sale_date
         mship.end_date = mship.start_date + relativedelta(months=months, days=-1)
-        self.upsert(mship)
+        self.buffered_upsert(mship)
 
         for n in range(family):
             fam = Membership()
@@ -63,7 +63,7 @@ class Fetcher(AbstractFetcher):
             fam.start_date      = mship.start_date
             fam.end_date        = mship.end_date
             fam.ctrlid          = "{}:{}:{}".format(self.CTRLID_PREFIX, mship.ctrlid, n)
-            self.upsert(fam)
+            self.buffered_upsert(fam)
 
     def _process_checkouts(self, checkouts):
         assert len(checkouts) < self.limit
@@ -139,9 +139,7 @@ class Fetcher(AbstractFetcher):
     def _process_checkout_data(self, account):
         URL = "https://wepayapi.com/v2/checkout/find"
 
-        window_start = date(2013, 12, 1)
-        while window_start < date.today():
-            window_start = window_start + relativedelta(months=+1)
+        def fetch_window(window_start: date) -> dict:
             window_end = window_start + relativedelta(months=+1)
             post_data = {
                 'account_id': account,
@@ -150,7 +148,15 @@ class Fetcher(AbstractFetcher):
                 'limit': str(self.limit)
             }
             response = self.session.post(URL, post_data, headers=self.auth_headers)
-            checkouts = response.json()
+            return response.json()
+
+        window_starts = []
+        window_start = date(2013, 12, 1)
+        while window_start < date.today():
+            window_start = window_start + relativedelta(months=+1)
+            window_starts.append(window_start)
+
+        for window_start, checkouts in self.prefetched(fetch_window, window_starts):
             if "error" in checkouts:
                 print("\nCheckouts for acct {}: {}".format(account, checkouts))
                 return
@@ -194,7 +200,7 @@ class Fetcher(AbstractFetcher):
             mship.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, charge['subscription_charge_id'])
             mship.start_date = sale.sale_date
             mship.end_date = mship.start_date + relativedelta(months=1, days=-1)
-            self.upsert(mship)
+            self.buffered_upsert(mship)
 
             for n in range(family):
                 fam = Membership()
@@ -204,7 +210,7 @@ class Fetcher(AbstractFetcher):
                 fam.start_date      = mship.start_date
                 fam.end_date        = mship.end_date
                 fam.ctrlid          = "{}:{}:{}".format(self.CTRLID_PREFIX, mship.ctrlid, n)
-                self.upsert(fam)
+                self.buffered_upsert(fam)
 
     def _process_subscriptions(self, subscriptions, family_count):
         for subscription in subscriptions:
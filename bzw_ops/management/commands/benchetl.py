@@ -0,0 +1,155 @@
+# Standard
+import json
+import random
+import time
+from datetime import date, timedelta
+from typing import List, Tuple
+
+# Third party
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from requests import Request
+
+# Local
+from books.models import Account, Sale, MonetaryDonation, OtherItem, OtherItemType, \
+    ACCT_ASSET_CASH, ACCT_REVENUE_DONATION
+from bzw_ops.etlfetchers import square
+from bzw_ops.etlfetchers.transport import Cassette, DjangoStandIn, Exchange, Transport, request_key
+from members.models import Membership, MembershipGiftCardReference
+
+__author__ = 'adrian'
+
+MERCHANT_ID = "SYNTHETIC"
+
+# (Item name, price in cents, modifier) covering each kind of item the Square fetcher upserts.
+SYNTHETIC_ITEMS = [
+    ("One Month Membership", 5000, "Just myself"),
+    ("One Month Membership", 6000, "1 Add'l Family Member"),
+    ("Donation", 2500, None),
+    ("1 Month Gift Card", 5000, None),
+    ("Soda", 100, None),
+]
+
+
+class Command(BaseCommand):
+
+    help = "Times the complete Square ETL against a synthetic payment history, using a new test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--weeks', type=int, default=104,
+            help="The number of weeks of synthetic payment history, ending today.")
+        parser.add_argument('--payments-per-week', type=int, default=50,
+            help="The number of synthetic payments in each week.")
+        parser.add_argument('--page-workers', type=int, default=None,
+            help="Threads that fetch source pages ahead. Defaults to the fetcher's own setting.")
+        parser.add_argument('--upsert-workers', type=int, default=None,
+            help="Threads that send upserts. Defaults to the fetcher's own setting.")
+        parser.add_argument('--max-pending-batches', type=int, default=None,
+            help="Batches of upserts that can be waiting before the fetcher pauses. Defaults to the fetcher's own setting.")
+
+    @staticmethod
+    def synthetic_payment(rand: random.Random, n: int, day: date) -> dict:
+        itemizations = []
+        for name, price, modifier in rand.sample(SYNTHETIC_ITEMS, rand.randint(1, 3)):
+            itemizations.append({
+                'name': name,
+                'quantity': "1.00000000",
+                'gross_sales_money': {'amount': price},
+                'net_sales_money': {'amount': price},
+                'modifiers': [] if modifier is None else [{'name': modifier}],
+            })
+        total = sum(item['gross_sales_money']['amount'] for item in itemizations)
+        return {
+            'id': "SYN{:07d}".format(n),
+            'created_at': "{}T18:00:00Z".format(day.isoformat()),
+            'receipt_url': "https://squareup.com/receipt/preview/SYN{:07d}".format(n),
+            'tender': [{
+                'type': "CREDIT_CARD",
+                'card_brand': rand.choice(["VISA", "MASTER_CARD", "AMERICAN_EXPRESS", "DISCOVER"]),
+                'total_money': {'amount': total},
+            }],
+            'processing_fee_money': {'amount': -round(total * 0.0275)},
+            'itemizations': itemizations,
+        }
+
+    @staticmethod
+    def synthetic_history(since: date, payments_per_week: int) -> Tuple[Cassette, int]:
+        """
+        Square's responses to the fetcher's requests for the weekly windows from since through today,
+        as the fetcher makes them. Also returns the number of payments.
+        """
+        rand = random.Random(0)  # Same history for every run.
+        cassette = Cassette()
+        payments_url = "https://connect.squareup.com/v1/{}/payments".format(MERCHANT_ID)
+        today = date.today()
+        window_start = since
+        n = 0
+        while window_start <= today:
+            window_end = window_start + timedelta(weeks=1)
+            payments = []  # type: List[dict]
+            for _ in range(payments_per_week):
+                n += 1
+                payment = Command.synthetic_payment(rand, n, window_start + timedelta(days=rand.randrange(7)))
+                receipt = Request('GET', payment['receipt_url']).prepare()
+                html = "<html><body><div class='name_on_card'>SYNTHETIC BUYER {}</div></body></html>".format(n)
+                cassette.add(Exchange.of(request_key(receipt), 200, {'Content-Type': "text/html"}, html.encode()))
+                payments.append(payment)
+            params = {'begin_time': window_start.isoformat(), 'end_time': window_end.isoformat(), 'limit': "200"}
+            page = Request('GET', payments_url, params=params).prepare()
+            body = json.dumps(payments).encode()
+            cassette.add(Exchange.of(request_key(page), 200, {'Content-Type': "application/json"}, body))
+            window_start = window_end
+        return cassette, n
+
+    def bench(self, options) -> None:
+        # The website's side of the ETL needs these. Other item types and donations default to these accounts.
+        for pk, name, category, type in [
+            (ACCT_ASSET_CASH, "Cash", Account.CAT_ASSET, Account.TYPE_DEBIT),
+            (ACCT_REVENUE_DONATION, "Donations", Account.CAT_REVENUE, Account.TYPE_CREDIT),
+        ]:
+            Account.objects.create(id=pk, name=name, category=category, type=type,
+                description="Synthetic account for benchmarking.")
+        OtherItemType.objects.create(name="Food/Drink", description="Synthetic item type for benchmarking.")
+        user = User.objects.create_superuser("benchetl", "benchetl@example.com", None)
+
+        since = date.today() - timedelta(weeks=options['weeks'])
+        cassette, payment_count = Command.synthetic_history(since, options['payments_per_week'])
+
+        fetcher = square.Fetcher(merchant_id=MERCHANT_ID, rest_token="synthetic")
+        fetcher.since = since
+        for option in ['page_workers', 'upsert_workers', 'max_pending_batches']:
+            if options[option] is not None:
+                setattr(fetcher, option, options[option])
+
+        stand_in = DjangoStandIn(user)
+        start = time.perf_counter()
+        try:
+            with Transport(replay=cassette, stand_in=stand_in):
+                fetcher.fetch()
+        finally:
+            stand_in.close()
+        seconds = time.perf_counter() - start
+
+        counts = [(model.__name__, model.objects.count()) for model in
+            [Sale, Membership, MonetaryDonation, MembershipGiftCardReference, OtherItem]]
+        item_count = sum(count for _, count in counts)
+        print("\n{} payments in {} weeks".format(payment_count, options['weeks']))
+        for name, count in counts:
+            print("   {:28} {:8}".format(name, count))
+        print("   {:28} {:8.2f} s {:10.1f} payments/s {:10.1f} items/s".format(
+            "Elapsed", seconds, payment_count / seconds, item_count / seconds))
+
+    def handle(self, *args, **options):
+
+        if options['weeks'] < 1 or options['payments_per_week'] < 1:
+            raise CommandError("There must be at least one week and one payment per week.")
+
+        # Everything is written to a new test database, which is dropped at the end.
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.bench(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        print("\nDone.\n")
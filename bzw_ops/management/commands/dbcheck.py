@@ -1,77 +1,163 @@
-
 # Standard
-
-import unittest
-import sys
+import os
 import multiprocessing as mp
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 # Third Party
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.apps import apps
 from django.core.exceptions import ValidationError
 from django.db import connection
+from django.db.models import Model
+from django.utils import timezone
 
 # Local
+from bzw_ops.models import DbCheckChange, DbCheckRun, checked_models, recorded_models
 
 
 __author__ = 'adrian'
-NUM_CORE = 4
+
+# A chunk is an inclusive range of primary keys, (model label, first pk, last pk, pks). If pks isn't None,
+# only those objects in the range are checked.
+Chunk = Tuple[str, Any, Any, Optional[List[Any]]]
 
 
 class Command(BaseCommand):
 
     help = "Runs validation for each model in the database."
 
-    def handle(self, **options):
-        suite = unittest.TestLoader().loadTestsFromTestCase(DbCheck)
-        unittest.TextTestRunner().run(suite)
-
+    def add_arguments(self, parser):
+        parser.add_argument('--cores', type=int, default=os.cpu_count() or 1,
+            help="The number of worker processes. With 1, everything is checked in this process.")
+        parser.add_argument('--chunk-size', type=int, default=500,
+            help="The number of objects sent to a worker at a time.")
+        parser.add_argument('--changed-since-last', action="store_true", default=False,
+            help="Only check the objects that changed since the last run started, and the objects that refer to them.")
 
-def test_object(modelname_and_obj) -> List[str]:
-    modelname, obj = modelname_and_obj
-    #if type(obj).__name__ != "JournalEntry": return []
+    def handle(self, **options):
+        if options['cores'] < 1 or options['chunk_size'] < 1:
+            raise CommandError("There must be at least one core and at least one object per chunk.")
+
+        # Changes are recorded as they're made, so anything that changes after this is left to the next run.
+        started = timezone.now()
+        last_run = DbCheckRun.objects.order_by('-when_started').first()
+        changed = None  # type: Optional[Dict[str, Set[Any]]]
+        if options['changed_since_last']:
+            if last_run is None:
+                self.stdout.write("There's no previous run, so everything will be checked.")
+            else:
+                self.stdout.write("Checking changes since {}.".format(last_run.when_started))
+                changed = DbCheckChange.changed_since(last_run.when_started)
+
+        chunks, obj_counts = plan_chunks(options['chunk_size'], changed)
+        problem_count = 0
+        model_problems = {label: 0 for label in obj_counts}
+        chunks_left = {label: 0 for label in obj_counts}
+        for label, _, _, _ in chunks:
+            chunks_left[label] += 1
+
+        for label, count in obj_counts.items():
+            if count == 0 and changed is None:
+                self.report(label, count, 0)
+
+        # Results stream back as workers finish chunks, so progress is reported per model as each completes.
+        for label, obj_problems in run_chunks(chunks, options['cores']):
+            for problem in obj_problems:
+                self.stdout.write("   " + problem)  # Reported as they're found.
+            problem_count += len(obj_problems)
+            model_problems[label] += len(obj_problems)
+            chunks_left[label] -= 1
+            if chunks_left[label] == 0:
+                self.report(label, obj_counts[label], model_problems[label])
+
+        if problem_count > 0:
+            self.stdout.write("DBCheck found {} issues, listed above.".format(problem_count))
+
+        DbCheckRun.objects.create(
+            when_started=started,
+            when_finished=timezone.now(),
+            incremental=changed is not None,
+            object_count=sum(obj_counts.values()),
+            problem_count=problem_count,
+        )
+        # The next run checks the changes since this one started. Those from before the previous run started
+        # aren't needed anymore. Keeping a run's worth of older ones leaves room for changes that were
+        # committed a little after they were recorded.
+        if last_run is not None:
+            DbCheckChange.objects.filter(when_changed__lt=last_run.when_started).delete()
+
+    def report(self, label: str, obj_count: int, problem_count: int) -> None:
+        self.stdout.write("   {}, {} objs, {} problems".format(label, obj_count, problem_count))
+        self.stdout.flush()
+
+
+def plan_chunks(chunk_size: int, changed: Optional[Dict[str, Set[Any]]] = None) \
+        -> Tuple[List[Chunk], Dict[str, int]]:
+    """
+    Splits every model's objects into chunks of primary keys. Also returns the number of objects per model.
+    If changed is given, only the objects it lists, by model label, are included, except for the models whose
+    changes aren't recorded.
+    """
+    chunks = []  # type: List[Chunk]
+    obj_counts = {}  # type: Dict[str, int]
+    for model in checked_models():
+        label = model._meta.label
+        objs = model.objects.all()
+        incremental = changed is not None and model in recorded_models()  # Unrecorded models are checked in full.
+        if incremental:
+            objs = objs.filter(pk__in=changed.get(label, set()))  # Deleted objects drop out here.
+        obj_counts[label] = 0
+        for pks in pk_chunks(objs.order_by('pk').values_list('pk', flat=True).iterator(), chunk_size):
+            chunks.append((label, pks[0], pks[-1], pks if incremental else None))
+            obj_counts[label] += len(pks)
+    return chunks, obj_counts
+
+
+def pk_chunks(pks: Iterable[Any], chunk_size: int) -> Iterator[List[Any]]:
+    chunk = []  # type: List[Any]
+    for pk in pks:
+        chunk.append(pk)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def run_chunks(chunks: List[Chunk], cores: int) -> Iterator[Tuple[str, List[str]]]:
+    """Checks the chunks, yielding (model label, problems) for each as it's done, in no particular order."""
+    if cores == 1:
+        yield from map(check_chunk, chunks)
+        return
+    # The workers are forked, so the connection is closed first to keep them from sharing it.
+    # Each worker opens its own when it first needs one. Nothing here uses the database from now on.
+    connection.close()
+    with mp.Pool(cores) as pool:
+        yield from pool.imap_unordered(check_chunk, chunks)
+
+
+def check_chunk(chunk: Chunk) -> Tuple[str, List[str]]:
+    label, first_pk, last_pk, pks = chunk
+    model = apps.get_model(label)
+    in_chunk = {'pk__gte': first_pk, 'pk__lte': last_pk}
+    if pks is not None:
+        in_chunk['pk__in'] = pks
+    if hasattr(model, "objs_for_dbcheck"):
+        # The model's queryset prefetches whatever its dbcheck() uses. Django can't prefetch for iterator(),
+        # but a chunk is small enough to load at once.
+        objs = iter(model.objs_for_dbcheck().filter(**in_chunk))
+    else:
+        objs = model.objects.filter(**in_chunk).iterator()
+    problems = []  # type: List[str]
+    for obj in objs:
+        problems.extend(test_object(model.__name__, obj))
+    return label, problems
+
+
+def test_object(modelname: str, obj: Model) -> List[str]:
     try:
         obj.full_clean()
         if hasattr(obj, "dbcheck"): obj.dbcheck()
         return []
     except ValidationError as e:
         return ["{} #{}, {} {}".format(modelname, obj.pk, obj, e.messages)]
-
-
-class DbCheck(unittest.TestCase):
-
-    def test_models(self):
-        problems = []
-        total_err_count = 0
-
-        connection.close()
-        pool = mp.Pool(NUM_CORE)
-
-        # TODO: Get list of apps from settings module.
-        for appname in ['books', 'inventory', 'members', 'modelmailer', 'soda', 'tasks', 'bzw_ops', 'xis']:
-            print(appname)
-            app = apps.get_app_config(appname)
-            for modelname, model in app.models.items():
-                total_obj_count = model.objects.count()
-                model_info_str = "   {}, {} objs".format(modelname, total_obj_count)
-                print(model_info_str, end="")
-                sys.stdout.flush()
-                objs = model.objects.all()  # TODO: Call model.objs_for_dbcheck() instead, if it exists.
-                model_problems = pool.map(
-                    test_object,
-                    ((modelname, obj) for obj in objs)
-                )
-                model_err_count = 0
-                for obj_problems in model_problems:
-                    problems.extend(obj_problems)
-                    total_err_count += len(obj_problems)
-                    model_err_count += len(obj_problems)
-
-                print(", {} problems".format(model_err_count))
-
-        if total_err_count > 0:
-            print("DBCheck found the following issues:")
-            for problem in problems:
-                print("   "+problem)
-            sys.stdout.flush()
@@ -1,12 +1,16 @@
 
 # Standard
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 
 # Third-party
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 
 # Local
-
+from bzw_ops.etlfetchers.checkpoints import CheckpointStore, DEFAULT_PATH
+from bzw_ops.etlfetchers.transport import Cassette, Transport
 
 __author__ = 'adrian'
 
@@ -17,8 +21,45 @@ class Command(BaseCommand):
 
     auth_headers = None
 
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat, default=None,
+            help="Fetch everything from this date (YYYY-MM-DD), ignoring and not updating checkpoints.")
+        parser.add_argument('--full', action="store_true", default=False,
+            help="Fetch everything each source has, ignoring checkpoints, and record new ones.")
+        parser.add_argument('--overlap-days', type=int, default=7,
+            help="Resume this many days before each checkpoint, in case a source was late to report something.")
+        parser.add_argument('--state-file', default=DEFAULT_PATH,
+            help="The file that holds the checkpoints.")
+        parser.add_argument('--parallel-fetchers', type=int, default=4,
+            help="The number of fetchers that run at the same time.")
+        parser.add_argument('--page-workers', type=int, default=None,
+            help="Threads per fetcher that fetch source pages ahead. Defaults to each fetcher's own setting.")
+        parser.add_argument('--upsert-workers', type=int, default=None,
+            help="Threads per fetcher that send upserts. Defaults to each fetcher's own setting.")
+        parser.add_argument('--max-pending-batches', type=int, default=None,
+            help="Batches of upserts a fetcher can have waiting before it pauses. Defaults to each fetcher's own setting.")
+        parser.add_argument('--record', default=None, metavar="CASSETTE",
+            help="Record every HTTP exchange to this file, e.g. for replaying later.")
+        parser.add_argument('--replay', default=None, metavar="CASSETTE",
+            help="Answer HTTP requests from this recording instead of sending them. The run must make the same "
+                 "requests as the recorded one, e.g. with the same --since, on the same day.")
+
+    @staticmethod
+    def run_fetcher(fetcher) -> None:
+        print("\nProcessing {}".format(str(fetcher)))
+        try:
+            fetcher.fetch()
+        finally:
+            connection.close()  # This thread's connection, if the fetcher used the database.
+
     def handle(self, *args, **options):
 
+        if options['since'] is not None and options['full']:
+            raise CommandError("Specify at most one of --since and --full.")
+        if options['record'] is not None and options['replay'] is not None:
+            raise CommandError("Specify at most one of --record and --replay.")
+        checkpoints = CheckpointStore(options['state_file'])
+
         print("")
 
         rest_token = input("REST API token: ")
@@ -33,10 +74,26 @@ class Command(BaseCommand):
         fetchers = [getattr(x, 'Fetcher') for x in fetchers]
         fetchers = [x() for x in fetchers]
 
+        active = []
         for fetcher in fetchers:
             if fetcher.skip:
                 print("\nSkipping {}".format(str(fetcher)))
-            else:
-                print("\nProcessing {}".format(str(fetcher)))
-                fetcher.django_auth_headers = {'Authorization': "Token " + rest_token}
-                fetcher.fetch()
+                continue
+            fetcher.django_auth_headers = {'Authorization': "Token " + rest_token}
+            fetcher.checkpoints = checkpoints
+            fetcher.since = options['since']
+            fetcher.full = options['full']
+            fetcher.overlap = timedelta(days=options['overlap_days'])
+            for option in ['page_workers', 'upsert_workers', 'max_pending_batches']:
+                if options[option] is not None:
+                    setattr(fetcher, option, options[option])
+            active.append(fetcher)
+
+        # The fetchers spend most of their time waiting on the network, so they run concurrently.
+        record = None if options['record'] is None else Cassette(options['record'])
+        replay = None if options['replay'] is None else Cassette.load(options['replay'])
+        with Transport(record=record, replay=replay):
+            with ThreadPoolExecutor(max_workers=max(options['parallel_fetchers'], 1)) as pool:
+                futures = [pool.submit(self.run_fetcher, fetcher) for fetcher in active]
+                for future in futures:
+                    future.result()
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.18 on 2026-10-18 06:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('bzw_ops', '0002_auto_20171003_1201'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DbCheckRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('when_started', models.DateTimeField(help_text='The time at which the run started.')),
+                ('when_finished', models.DateTimeField(help_text='The time at which the run finished.')),
+                ('incremental', models.BooleanField(default=False, help_text='True if only the objects that changed since the previous run were checked.')),
+                ('object_count', models.PositiveIntegerField(help_text='The number of objects checked.')),
+                ('problem_count', models.PositiveIntegerField(help_text='The number of problems found.')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DbCheckChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField(help_text='The id of the object that changed.')),
+                ('when_changed', models.DateTimeField(auto_now_add=True, db_index=True, help_text='The time at which the object changed.')),
+                ('content_type', models.ForeignKey(help_text='The type of the object that changed.', on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+    ]
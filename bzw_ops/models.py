@@ -3,9 +3,14 @@
 # Standard
 from decimal import Decimal
 from datetime import datetime, date, time
+from collections import defaultdict
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 # Third-party
-from django.db import models
+from django.apps import apps
+from django.db import connection, models, transaction
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from nptime import nptime
 
@@ -14,7 +19,7 @@ from abutils.time import (
     days_of_week_str,
     duration_single_unit_str,
     ordinals_of_month_str,
-    matches_weekday_of_month_pattern,
+    WeekdayOfMonthPatternMixin,
     currently_in_timespan
 )
 
@@ -41,7 +46,7 @@ class TimeBlockType(models.Model):
                 raise ValidationError(msg)
 
 
-class TimeBlock(models.Model):
+class TimeBlock(WeekdayOfMonthPatternMixin, models.Model):
 
     start_time = models.TimeField(null=True, blank=True,
         help_text="The time at which the time block begins.")
@@ -70,7 +75,7 @@ class TimeBlock(models.Model):
 
     @property
     def is_now(self) -> bool:
-        if not matches_weekday_of_month_pattern(self, date.today()):
+        if not self.weekday_of_month_pattern.matches(date.today()):
             return False
         return currently_in_timespan(self.start_time, self.duration)
 
@@ -84,4 +89,220 @@ class TimeBlock(models.Model):
         ords = ordinals_of_month_str(self)  # type: str
         days = days_of_week_str(self)  # type: str
         dur = duration_single_unit_str(self.duration)  # type: str
-        return "{} / {} at {} for {}".format(ords, days, self.start_time, dur)
\ No newline at end of file
+        return "{} / {} at {} for {}".format(ords, days, self.start_time, dur)
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# DB CHECK
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+# TODO: Get list of apps from settings module.
+DBCHECK_APPS = ['books', 'inventory', 'members', 'modelmailer', 'soda', 'tasks', 'bzw_ops', 'xis']
+
+# Derived or cache tables. Changes to them aren't recorded, so incremental runs check all of them.
+UNRECORDED_MODELS = ['books.DailyAccountBalance', 'books.AccountClosure', 'books.JournalerDirtyMarker', 'modelmailer.OutboundEmail']
+
+_checked_models = None  # type: Optional[List[type]]
+_recorded_models = None  # type: Optional[List[type]]
+_dbcheck_dependents = None  # type: Optional[Dict[type, List[Tuple[type, str]]]]
+_dbcheck_reads = None  # type: Optional[Set[type]]
+
+
+def checked_models() -> List[type]:
+    """The models that the "dbcheck" command validates, which is every model in DBCHECK_APPS except its own."""
+    global _checked_models
+    if _checked_models is None:
+        _checked_models = [
+            model
+            for appname in DBCHECK_APPS
+            for model in apps.get_app_config(appname).get_models(include_auto_created=True)
+            if model not in [DbCheckChange, DbCheckRun]
+        ]
+    return _checked_models
+
+
+def recorded_models() -> List[type]:
+    """The checked models whose changes are recorded for "dbcheck --changed-since-last"."""
+    global _recorded_models
+    if _recorded_models is None:
+        _recorded_models = [model for model in checked_models() if model._meta.label not in UNRECORDED_MODELS]
+    return _recorded_models
+
+
+def _related_field(model: type, accessor: str):
+    """The relation that's reached from instances of model through the given attribute, e.g. "foo_set"."""
+    for field in model._meta.get_fields():
+        if field.is_relation and (field.get_accessor_name() if field.auto_created and not field.concrete else field.name) == accessor:
+            return field
+    raise ValueError("{} has no relation named {}.".format(model.__name__, accessor))
+
+
+def dbcheck_dependents() -> Dict[type, List[Tuple[type, str]]]:
+    """
+    For each model, the models whose dbcheck() reads its objects through other objects, along with the lookup
+    from them to it, e.g. {ExpenseClaim: [(ExpenseTransaction, "expenseclaimreference__claim")]}. These are found by
+    following the paths that each model's objs_for_dbcheck() prefetches. The first step of a path that leads to
+    the model's own children isn't included, since a child that changes is already recorded along with its parent.
+    """
+    global _dbcheck_dependents, _dbcheck_reads
+    if _dbcheck_dependents is None:
+        dependents = defaultdict(list)  # type: Dict[type, List[Tuple[type, str]]]
+        reads = set()  # type: Set[type]
+        for model in checked_models():
+            if not hasattr(model, "objs_for_dbcheck"):
+                continue
+            for lookup in model.objs_for_dbcheck()._prefetch_related_lookups:
+                path = getattr(lookup, 'prefetch_through', lookup)  # Either a string or a Prefetch.
+                related, query_names = model, []  # type: type, List[str]
+                for step, accessor in enumerate(path.split("__")):
+                    field = _related_field(related, accessor)
+                    related = field.related_model
+                    query_names.append(field.name)
+                    reads.add(related)
+                    if step == 0 and (field.one_to_many or field.one_to_one) and field.auto_created and not field.concrete:
+                        continue
+                    dependents[related].append((model, "__".join(query_names)))
+        _dbcheck_dependents = dict(dependents)
+        _dbcheck_reads = reads
+    return _dbcheck_dependents
+
+
+def dbcheck_reads() -> Set[type]:
+    """
+    The models whose objects are read by the dbcheck() of other objects, per the paths that objs_for_dbcheck()
+    prefetches. Deleting one of these can change the result of another object's dbcheck().
+    """
+    dbcheck_dependents()
+    return _dbcheck_reads
+
+
+class _PendingDeletes(object):
+    """The objects referred to by objects deleted in the current transaction, to be recorded when it commits."""
+
+    def __init__(self):
+        self.changed = set()  # type: Set[Tuple[type, Any]]
+
+    def is_registered(self) -> bool:
+        # Django forgets the callbacks of a transaction that's rolled back.
+        return any(entry[1] == self.flush for entry in connection.run_on_commit)
+
+    def flush(self) -> None:
+        if getattr(_deleted, 'pending', None) is self:
+            _deleted.pending = None
+        DbCheckChange.save_changes(self.changed)
+
+
+_deleted = threading.local()
+
+
+class DbCheckChange(models.Model):
+    """
+    Records that an object was saved or deleted, so that "dbcheck --changed-since-last" can validate just the
+    objects that changed since its last run. Changes are recorded by signal handlers. Code that writes recorded
+    objects in bulk, which doesn't send post_save, must send objects_saved_in_bulk for them.
+    """
+
+    content_type = models.ForeignKey(ContentType, null=False, blank=False,
+        on_delete=models.CASCADE,
+        help_text="The type of the object that changed.")
+
+    object_id = models.PositiveIntegerField(null=False, blank=False,
+        help_text="The id of the object that changed.")
+
+    when_changed = models.DateTimeField(auto_now_add=True, db_index=True,
+        help_text="The time at which the object changed.")
+
+    @classmethod
+    def record(cls, obj: models.Model) -> None:
+        """
+        Record that the object changed, along with the objects it refers to and the objects that read it through
+        others, since their dbcheck() may look at it.
+        """
+        cls.record_all([obj])
+
+    @classmethod
+    def record_all(cls, objs: Iterable[models.Model]) -> None:
+        """Same as record(), for many objects at once, e.g. ones written by bulk_create."""
+        recorded = recorded_models()
+        changed = set()  # type: Set[Tuple[type, Any]]
+        by_model = defaultdict(set)  # type: Dict[type, Set[Any]]
+        for obj in objs:
+            if type(obj) not in recorded:
+                continue
+            changed.add((type(obj), obj.pk))
+            by_model[type(obj)].add(obj.pk)
+            changed.update(cls._parents(obj))
+        for model, pks in by_model.items():
+            for dependent, lookup in dbcheck_dependents().get(model, []):
+                for pk in dependent.objects.filter(**{lookup + "__in": pks}).values_list('pk', flat=True).distinct():
+                    changed.add((dependent, pk))
+        cls.save_changes(changed)
+
+    @classmethod
+    def record_deleted(cls, obj: models.Model) -> None:
+        """
+        Record that the object was deleted. It drops out of the check by itself, so only the objects it refers to
+        are recorded. That's done in bulk once the deleting transaction commits, since a delete can cascade to
+        many objects.
+        """
+        pending = getattr(_deleted, 'pending', None)  # type: Optional[_PendingDeletes]
+        is_new = pending is None or not pending.is_registered()
+        if is_new:
+            pending = _deleted.pending = _PendingDeletes()
+        pending.changed.update(cls._parents(obj))
+        if is_new:
+            transaction.on_commit(pending.flush)  # Runs right away if there's no transaction.
+
+    @staticmethod
+    def _parents(obj: models.Model) -> Iterator[Tuple[type, Any]]:
+        """The (model, pk) of each recorded object that obj refers to."""
+        recorded = recorded_models()
+        deferred = obj.get_deferred_fields()
+        for field in obj._meta.concrete_fields:
+            if not field.is_relation or field.related_model not in recorded or field.attname in deferred:
+                continue
+            # Using the id instead of the related object because the parent might have been deleted.
+            parent_id = getattr(obj, field.attname)
+            if parent_id is not None:
+                yield field.related_model, parent_id
+
+    @classmethod
+    def save_changes(cls, changed: Iterable[Tuple[type, Any]]) -> None:
+        cls.objects.bulk_create([
+            cls(content_type=ContentType.objects.get_for_model(model), object_id=pk)
+            for model, pk in changed
+        ], batch_size=1000)
+
+    @classmethod
+    def changed_since(cls, when: datetime) -> Dict[str, Set[int]]:
+        """The ids of the objects that changed at or after the given time, by model label."""
+        changed = defaultdict(set)  # type: Dict[str, Set[int]]
+        for ct_id, object_id in cls.objects.filter(when_changed__gte=when).values_list('content_type', 'object_id').distinct():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            if model is not None:
+                changed[model._meta.label].add(object_id)
+        return changed
+
+    def __str__(self):
+        return "{} #{} changed at {}".format(self.content_type, self.object_id, self.when_changed)
+
+
+class DbCheckRun(models.Model):
+    """A completed run of the "dbcheck" command."""
+
+    when_started = models.DateTimeField(null=False, blank=False,
+        help_text="The time at which the run started.")
+
+    when_finished = models.DateTimeField(null=False, blank=False,
+        help_text="The time at which the run finished.")
+
+    incremental = models.BooleanField(default=False,
+        help_text="True if only the objects that changed since the previous run were checked.")
+
+    object_count = models.PositiveIntegerField(null=False, blank=False,
+        help_text="The number of objects checked.")
+
+    problem_count = models.PositiveIntegerField(null=False, blank=False,
+        help_text="The number of problems found.")
+
+    def __str__(self):
+        return "DB check at {}, {} problems".format(self.when_started, self.problem_count)
@@ -216,6 +216,38 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # RFID access decisions. These are kept in the database, so the invalidations done by signal handlers and
+    # prewarmaccess are seen by every process on every dyno, including one-off dynos. A revoked member mustn't
+    # keep getting in. The table is made by "createcachetable" in the release phase.
+    'access': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bzwops_access_cache',
+        'TIMEOUT': 24*60*60,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    # Generations that tell every process on every dyno that its copy of something, e.g. the show schedule,
+    # is out of date. Kept in the database, apart from the other caches, so they're never culled with their entries.
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bzwops_shared_cache',
+        'TIMEOUT': None,
+    },
+    # Serialized iCalendar feeds. The file based cache is shared by all processes on a host.
+    'feeds': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('BZWOPS_FEED_CACHE_DIR', os.path.join(BASE_DIR, '.feed-cache')),
+        'TIMEOUT': 24*60*60,
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -426,11 +458,17 @@ BZWOPS_CONFIG = {
 
 BZWOPS_MEMBERS_CONFIG = {
     # Configuration specific to the "members" app.
+    'ACCESS_CACHE': "access",  # The cache, in CACHES, for RFID access decisions.
+    # Visit events are saved in batches this often. None saves each as it's logged.
+    'VISIT_EVENT_FLUSH_SECONDS': None if TESTING else 2.0,
+    # If saves keep failing, at most this many visit events wait in memory. Beyond that, they're saved as they're logged.
+    'VISIT_EVENT_MAX_PENDING': 5000,
 }
 
 BZWOPS_TASKS_CONFIG = {
     # Configuration specific to the "tasks" app.
-    'USER_VOLUNTEER': "adrianb"  # The Volunteer Coordinator's username.
+    'USER_VOLUNTEER': "adrianb",  # The Volunteer Coordinator's username.
+    'FEED_CACHE': "feeds",  # The cache, in CACHES, for iCalendar feeds.
 }
 
 BZWOPS_INVENTORY_CONFIG = {
@@ -441,6 +479,7 @@ BZWOPS_BOOKS_CONFIG = {
     # Configuration specific to the "books" app.
     'SQUAREUP_LOCATION_ID': os.getenv('SQUAREUP_LOCATION_ID', None),
     'SQUAREUP_APIV1_TOKEN': os.getenv('SQUAREUP_APIV1_TOKEN', None),
+    'ACCOUNT_TREE_CACHE': "shared",  # The cache, in CACHES, for the account tree's generation. Shared by all processes.
 }
 
 BZWOPS_SODA_CONFIG = {
@@ -451,3 +490,16 @@ BZWOPS_SODA_CONFIG = {
     'MQTT_PW': os.getenv('CLOUDMQTT_PW', None),
     'MQTT_TOPIC': "xerocraft/soda/vend"
 }
+
+BZWOPS_KMKR_CONFIG = {
+    # Configuration specific to the "kmkr" app.
+    'SCHEDULE_CACHE': "shared",  # The cache, in CACHES, for the show schedule's generation. Shared by all processes.
+}
+
+BZWOPS_MODELMAILER_CONFIG = {
+    # Configuration specific to the "modelmailer" app, which also holds the outbox for all outbound email.
+    'OUTBOX_WORKERS': 4,  # Messages are sent by this many threads, each with its own backend connection.
+    'OUTBOX_BATCH_SIZE': 200,  # Messages are taken from the outbox this many at a time.
+    'OUTBOX_MAX_ATTEMPTS': 6,  # A message is marked as failed after this many failed attempts.
+    'OUTBOX_RETRY_SECONDS': 300,  # Delay before the first retry. It doubles after each failed attempt.
+}
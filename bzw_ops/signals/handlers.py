@@ -2,13 +2,55 @@
 import logging
 
 # Third Party
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
 # Local
+from abutils.signals import objects_saved_in_bulk
+from bzw_ops.models import DbCheckChange, dbcheck_reads, recorded_models
+from members.signals import visit_events_saved
 
 __author__ = 'Adrian'
 
 logger = logging.getLogger("bezewy-ops")
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DB CHECK
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# No sender is specified because the recorded models are found in several apps.
+@receiver(post_save)
+def record_dbcheck_change(sender, **kwargs):
+    if kwargs.get('raw', False):
+        # Fixture loading. A full check will be required anyway.
+        return
+    if sender in recorded_models():
+        DbCheckChange.record(kwargs.get('instance'))
+
+
+# Only connected to the models that other objects' dbcheck() reads, since Django can't do a fast delete
+# of a model that has a post_delete receiver. Deleting anything else can't affect the check.
+def record_dbcheck_delete(sender, **kwargs):
+    DbCheckChange.record_deleted(kwargs.get('instance'))
+
+
+def connect_dbcheck_deletes() -> None:
+    for model in recorded_models():
+        if model in dbcheck_reads():
+            post_delete.connect(record_dbcheck_delete, sender=model)
+
+
+connect_dbcheck_deletes()
+
+
+@receiver(objects_saved_in_bulk)
+def record_dbcheck_bulk_changes(sender, **kwargs):
+    if sender in recorded_models():
+        DbCheckChange.record_all(kwargs.get('objs'))
+
+
+@receiver(visit_events_saved)
+def record_dbcheck_visit_events(sender, **kwargs):
+    if sender in recorded_models():
+        DbCheckChange.record_all(kwargs.get('visits'))
@@ -1,12 +1,31 @@
 
 # Standard
+import os
+from io import StringIO
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
 
 # Third Party
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib import admin
+from django.contrib.auth.models import User
+from requests import Session
 from django.core.management import call_command
 
 # Local
+from books.models import (
+    Account, Sale, MonetaryDonation, OtherItem, OtherItemType, ACCT_ASSET_CASH, ACCT_REVENUE_DONATION,
+    JournalEntry, JournalEntryLineItem, DailyAccountBalance, ExpenseClaim, ExpenseTransaction, ExpenseClaimReference,
+)
+from bzw_ops.etlfetchers import square
+from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher
+from bzw_ops.etlfetchers.checkpoints import CheckpointStore
+from bzw_ops.etlfetchers.transport import Cassette, DjangoStandIn, Transport, UnrecordedRequest
+from bzw_ops.management.commands.benchetl import Command as BenchEtl
+from bzw_ops.models import DbCheckRun
+from members.models import Membership
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -73,6 +92,309 @@ class TestAdminConfig(TestCase):
                         check_fieldname(fieldname, model_class, admin_obj)
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class TestEtlCheckpoints(TestCase):
+
+    class Fetcher(AbstractFetcher):
+        def fetch(self):
+            pass
+
+    ORIGIN = date(2015, 1, 1)
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "checkpoints.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def fetcher(self, **kwargs) -> AbstractFetcher:
+        fetcher = self.Fetcher()
+        fetcher.checkpoints = CheckpointStore(self.path)
+        for name, value in kwargs.items():
+            setattr(fetcher, name, value)
+        return fetcher
+
+    def test_resume(self):
+        fetcher = self.fetcher()
+        self.assertEqual(fetcher.start_date("acct", self.ORIGIN), self.ORIGIN)
+        fetcher.save_checkpoint("acct", cursor={'page': 2})
+        fetcher.save_checkpoint("other", watermark=date(2015, 1, 3))
+
+        # A later run, with a new store, resumes where this one left off.
+        fetcher = self.fetcher()
+        self.assertEqual(fetcher.resume_cursor("acct"), {'page': 2})
+        fetcher.save_checkpoint("acct", watermark=date(2019, 6, 30))
+        fetcher = self.fetcher(overlap=timedelta(days=10))
+        self.assertEqual(fetcher.start_date("acct", self.ORIGIN), date(2019, 6, 20))
+        self.assertIsNone(fetcher.resume_cursor("acct"))
+        self.assertEqual(fetcher.start_date("other", self.ORIGIN), self.ORIGIN)  # The overlap doesn't go before origin.
+
+    def test_since_and_full(self):
+        self.fetcher().save_checkpoint("acct", watermark=date(2019, 6, 30), cursor="x")
+
+        fetcher = self.fetcher(since=date(2018, 1, 1))
+        self.assertEqual(fetcher.start_date("acct", self.ORIGIN), date(2018, 1, 1))
+        self.assertIsNone(fetcher.resume_cursor("acct"))
+        fetcher.save_checkpoint("acct", watermark=date(2018, 2, 1))  # Ignored, since data may have been skipped.
+
+        fetcher = self.fetcher(full=True)
+        self.assertEqual(fetcher.start_date("acct", self.ORIGIN), self.ORIGIN)
+        self.assertIsNone(fetcher.resume_cursor("acct"))
+
+        fetcher = self.fetcher()
+        self.assertEqual(fetcher.resume_cursor("acct"), "x")
+        self.assertEqual(fetcher.start_date("acct", self.ORIGIN), date(2019, 6, 23))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class TestEtlPipeline(TestCase):
+
+    class Fetcher(AbstractFetcher):
+        """Sends upserts nowhere, slowly."""
+
+        upsert_batch_size = 3
+        upsert_workers = 2
+        max_pending_batches = 2
+
+        def __init__(self):
+            self.sent = []
+            self.lock = threading.Lock()
+
+        def fetch(self):
+            pass
+
+        def _serialize(self, item):
+            return {'ctrlid': item.ctrlid}
+
+        def _bulk_upsert(self, model, srcdata):
+            time.sleep(0.02)
+            with self.lock:
+                self.sent += [data['ctrlid'] for data in srcdata]
+            return [
+                {'ctrlid': data['ctrlid'], 'outcome': "E" if data['ctrlid'].endswith("bad") else "+", 'data': data}
+                for data in srcdata
+            ]
+
+    def test_prefetched_and_chained(self):
+        fetcher = self.Fetcher()
+        fetched = []
+
+        def fetch_page(key):
+            fetched.append(key)
+            time.sleep(0.01 * (5-key))  # Later pages arrive first.
+            return key * 10
+
+        self.assertEqual(list(fetcher.prefetched(fetch_page, range(5))), [(k, k*10) for k in range(5)])
+        self.assertEqual(sorted(fetched), list(range(5)))
+
+        pages = {None: ("a", 1), 1: ("b", 2), 2: ("c", None)}
+        chained = fetcher.chained(lambda key: pages[key], None, lambda page: page[1])
+        self.assertEqual([page[0] for _, page in chained], ["a", "b", "c"])
+
+    def test_buffered_upserts_and_checkpoints(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            fetcher = self.Fetcher()
+            fetcher.checkpoints = CheckpointStore(os.path.join(dirname, "checkpoints.json"))
+            ctrlids = ["M:{}".format(n) for n in range(20)]
+            for ctrlid in ctrlids[:10]:
+                fetcher.buffered_upsert(Membership(ctrlid=ctrlid))
+            fetcher.save_checkpoint("acct", watermark=date(2019, 1, 10))
+            for ctrlid in ctrlids[10:]:
+                fetcher.buffered_upsert(Membership(ctrlid=ctrlid))
+            fetcher._fetch_complete()
+
+            self.assertEqual(sorted(fetcher.sent), sorted(ctrlids))
+            self.assertEqual(fetcher.checkpoints.get(fetcher.name, "acct").watermark, date(2019, 1, 10))
+
+    def test_checkpoint_waits_for_upserts(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            fetcher = self.Fetcher()
+            fetcher.checkpoints = CheckpointStore(os.path.join(dirname, "checkpoints.json"))
+            release = threading.Event()
+            send = fetcher._bulk_upsert
+            fetcher._bulk_upsert = lambda model, srcdata: release.wait() and send(model, srcdata)
+
+            fetcher.buffered_upsert(Membership(ctrlid="M:1"))
+            fetcher.save_checkpoint("acct", watermark=date(2019, 1, 10))
+            self.assertIsNone(fetcher.checkpoints.get(fetcher.name, "acct").watermark)  # M:1 hasn't been sent.
+            release.set()
+            fetcher.flush_upserts()
+            self.assertEqual(fetcher.sent, ["M:1"])
+            self.assertEqual(fetcher.checkpoints.get(fetcher.name, "acct").watermark, date(2019, 1, 10))
+
+    def test_rejected_item_holds_checkpoint(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            fetcher = self.Fetcher()
+            fetcher.checkpoints = CheckpointStore(os.path.join(dirname, "checkpoints.json"))
+            for ctrlid in ["M:1", "M:bad", "M:2"]:
+                fetcher.buffered_upsert(Membership(ctrlid=ctrlid))
+            fetcher.save_checkpoint("acct", watermark=date(2019, 1, 10))
+            fetcher.buffered_upsert(Membership(ctrlid="M:3"))
+            fetcher.save_checkpoint("acct", watermark=date(2019, 1, 20))
+            fetcher._fetch_complete()
+            self.assertEqual(sorted(fetcher.sent), ["M:1", "M:2", "M:3", "M:bad"])
+            # The next run starts where the last good one did, so M:bad is fetched and sent again.
+            self.assertIsNone(fetcher.checkpoints.get(fetcher.name, "acct").watermark)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+# The stand-in handles requests on its own thread, with its own database connection, so these tests commit.
+class TestEtlTransport(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser("etl", "etl@example.com", "pw")
+        self.stand_in = DjangoStandIn(self.user)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.stand_in.close()
+        self.dir.cleanup()
+
+    def test_record_and_replay(self):
+        path = os.path.join(self.dir.name, "cassette.json.gz")
+        sales_url = AbstractFetcher.URLBASE + AbstractFetcher.URLS[Sale]
+        sale = {'sale_date': "2019-01-01", 'payment_method': Sale.PAID_BY_SQUARE, 'total_paid_by_customer': "20.00", 'ctrlid': "SQ:1"}
+        session = Session()
+
+        with Transport(record=Cassette(path), stand_in=self.stand_in):
+            recorded = [
+                session.post(sales_url + "bulk-upsert/", json=[sale]),
+                session.get(sales_url, params={'ctrlid': "SQ:1"}),
+            ]
+        self.assertEqual(recorded[0].json()['results'][0]['outcome'], "+")
+        self.assertEqual(recorded[1].json()['count'], 1)
+
+        # Replaying doesn't touch the website, so the sale isn't added again.
+        Sale.objects.all().delete()
+        with Transport(replay=Cassette.load(path)):
+            replayed = [
+                session.get(sales_url, params={'ctrlid': "SQ:1"}),
+                session.post(sales_url + "bulk-upsert/", json=[sale]),
+            ]
+            self.assertRaises(UnrecordedRequest, session.get, sales_url, params={'ctrlid': "SQ:2"})
+        self.assertEqual([r.json() for r in replayed], [recorded[1].json(), recorded[0].json()])
+        self.assertEqual(Sale.objects.count(), 0)
+
+    def test_synthetic_square_history(self):
+        Account.objects.create(id=ACCT_ASSET_CASH, name="Cash", category=Account.CAT_ASSET, type=Account.TYPE_DEBIT, description="Cash")
+        Account.objects.create(id=ACCT_REVENUE_DONATION, name="Donations", category=Account.CAT_REVENUE, type=Account.TYPE_CREDIT, description="Donations")
+        OtherItemType.objects.create(name="Food/Drink", description="Food/Drink")
+        since = date.today() - timedelta(weeks=2)
+        cassette, payment_count = BenchEtl.synthetic_history(since, 5)
+
+        fetcher = square.Fetcher(merchant_id="SYNTHETIC", rest_token="synthetic")
+        fetcher.since = since
+        fetcher.upsert_batch_size = 4
+        with Transport(replay=cassette, stand_in=self.stand_in):
+            fetcher.fetch()
+
+        self.assertEqual(len(cassette), 0)  # Every synthetic response was asked for.
+        self.assertEqual(Sale.objects.count(), payment_count)
+        self.assertEqual(Sale.objects.filter(payer_name="SYNTHETIC BUYER 1").count(), 1)
+        self.assertTrue(OtherItem.objects.filter(type__name="Food/Drink").exists())
+        self.assertTrue(MonetaryDonation.objects.exists())
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+# Workers have their own database connections, so these tests commit.
+class TestDbCheck(TransactionTestCase):
+
+    def setUp(self):
+        for n in range(4):
+            Sale.objects.create(sale_date=date(2019, 1, 1), payment_method=Sale.PAID_BY_CASH, total_paid_by_customer=0, ctrlid="C:{}".format(n))
+        self.bad = Sale.objects.create(sale_date=date(2019, 1, 1), payment_method=Sale.PAID_BY_CASH, total_paid_by_customer=10, ctrlid="C:bad")
+
+    def dbcheck(self, **options) -> str:
+        out = StringIO()
+        call_command('dbcheck', stdout=out, **options)
+        return out.getvalue()
+
+    def test_in_process(self):
+        out = self.dbcheck(cores=1, chunk_size=2)
+        self.assertIn("books.Sale, 5 objs, 1 problems", out)
+        self.assertIn("Sale #{}, ".format(self.bad.pk), out)
+        self.assertIn("DBCheck found 1 issues", out)
+
+    def test_workers(self):
+        out = self.dbcheck(cores=2, chunk_size=2)
+        self.assertIn("books.Sale, 5 objs, 1 problems", out)
+        self.assertIn("Sale #{}, ".format(self.bad.pk), out)
+
+    def test_changed_since_last(self):
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertIn("everything will be checked", out)
+        self.assertIn("books.Sale, 5 objs, 1 problems", out)
+
+        # Only the new sale and the one that the new membership is part of are checked now.
+        new_bad = Sale.objects.create(sale_date=date(2019, 1, 2), payment_method=Sale.PAID_BY_CASH, total_paid_by_customer=20, ctrlid="C:newbad")
+        parent = Sale.objects.get(ctrlid="C:0")
+        Membership.objects.create(sale=parent, sale_price=0, start_date=date(2019, 1, 1), end_date=date(2019, 1, 31))
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertIn("books.Sale, 2 objs, 1 problems", out)
+        self.assertIn("Sale #{}, ".format(new_bad.pk), out)
+        self.assertNotIn("Sale #{}, ".format(self.bad.pk), out)
+        self.assertIn("members.Membership, 1 objs, 0 problems", out)
+        self.assertNotIn("books.Account,", out)  # Nothing changed, so it isn't mentioned.
+
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertNotIn("books.Sale,", out)
+        self.assertEqual(DbCheckRun.objects.filter(incremental=True).count(), 2)
+
+        # A deleted membership isn't checked, but the sale it was part of is.
+        Membership.objects.filter(sale=parent).delete()
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertIn("books.Sale, 1 objs, 0 problems", out)
+        self.assertNotIn("members.Membership,", out)
+
+    def test_bulk_delete(self):
+        self.dbcheck(cores=1, changed_since_last=True)
+        acct = Account.objects.create(name="Cash", category=Account.CAT_ASSET, type=Account.TYPE_DEBIT, description="Cash")
+        DailyAccountBalance.objects.bulk_create([
+            DailyAccountBalance(account=acct, day=date(2019, 1, 1) + timedelta(days=n), increase=0, decrease=0, balance=0)
+            for n in range(500)
+        ])
+        # Nothing's recorded for derived tables, so Django can delete them without loading them.
+        with self.assertNumQueries(1):
+            DailyAccountBalance.objects.filter(day__gte=date(2019, 1, 1) + timedelta(days=250)).delete()
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertIn("books.DailyAccountBalance, 250 objs, 0 problems", out)  # Unrecorded models are checked in full.
+
+    def test_bulk_writes(self):
+        # Journal entries are written in bulk, without the signals that usually record changes.
+        for pk, name, category, type in [
+            (ACCT_ASSET_CASH, "Cash", Account.CAT_ASSET, Account.TYPE_DEBIT),
+            (ACCT_REVENUE_DONATION, "Donations", Account.CAT_REVENUE, Account.TYPE_CREDIT),
+        ]:
+            Account.objects.create(id=pk, name=name, category=category, type=type, description=name)
+        sale = Sale.objects.create(sale_date=date(2019, 1, 3), payment_method=Sale.PAID_BY_CASH, total_paid_by_customer=10, ctrlid="C:donation")
+        MonetaryDonation.objects.create(sale=sale, amount=10)
+        self.dbcheck(cores=1, changed_since_last=True)
+
+        call_command("generatejournal")
+        self.assertGreater(JournalEntry.objects.count(), 0)
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertIn("books.JournalEntry, {} objs, 1 problems".format(JournalEntry.objects.count()), out)  # The bad sale's.
+        self.assertIn("books.JournalEntryLineItem, {} objs, 0 problems".format(JournalEntryLineItem.objects.count()), out)
+
+    def test_indirect_readers(self):
+        # A transaction's dbcheck() reads the amounts of the claims it pays, through ExpenseClaimReferences.
+        claim = ExpenseClaim.objects.create(amount=10)
+        exp = ExpenseTransaction.objects.create(amount_paid=10)
+        ExpenseClaimReference.objects.create(exp=exp, claim=claim)
+        self.dbcheck(cores=1, changed_since_last=True)
+
+        claim.amount = 20
+        claim.save()
+        out = self.dbcheck(cores=1, changed_since_last=True)
+        self.assertIn("books.ExpenseTransaction, 1 objs, 1 problems", out)
+        self.assertIn("ExpenseTransaction #{}, ".format(exp.pk), out)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 # class TestProductionDatabase(TestCase):
@@ -109,7 +109,7 @@ class Show (models.Model):
         return None
 
 
-class ShowTime(models.Model):
+class ShowTime(abtime.WeekdayOfMonthPatternMixin, models.Model):
 
     show = models.ForeignKey(Show, null=False, blank=False,
         on_delete=models.CASCADE,
@@ -165,7 +165,7 @@ class ShowTime(models.Model):
     def last(self) -> bool: return False
 
     def covers(self, dt: datetime) -> bool:
-        day_match = abtime.matches_weekday_of_month_pattern(self, dt.date())
+        day_match = self.weekday_of_month_pattern.matches(dt.date())
         time_match = abtime.time_in_timespan(
             dt.time(),
             self.start_time,
@@ -224,7 +224,7 @@ class UnderwritingQuote(models.Model):
         return best_match
 
 
-class UnderwritingBroadcastSchedule (models.Model):  # TODO: Rename to UnderwritingScheduleLineItem?
+class UnderwritingBroadcastSchedule (abtime.WeekdayOfMonthPatternMixin, models.Model):  # TODO: Rename to UnderwritingScheduleLineItem?
 
     # TODO: Rename agreement -> quote
     agreement = models.ForeignKey(UnderwritingQuote, null=False, blank=False,
@@ -252,6 +252,7 @@ class UnderwritingBroadcastSchedule (models.Model):  # TODO: Rename to Underwrit
     saturdays = models.BooleanField(default=False, verbose_name="Sat")
 
     # Some dynamic code (in other modules) requires these aliases:
+    @property
     def first(self) -> bool: return False
     @property
     def second(self) -> bool: return False
@@ -263,13 +264,7 @@ class UnderwritingBroadcastSchedule (models.Model):  # TODO: Rename to Underwrit
     def every(self) -> bool: return True
 
     def covers_weekday(self, wd: int):
-        return (wd == 0 and self.mondays) \
-         or (wd == 1 and self.tuesdays) \
-         or (wd == 2 and self.wednesdays) \
-         or (wd == 3 and self.thursdays) \
-         or (wd == 4 and self.fridays) \
-         or (wd == 5 and self.saturdays) \
-         or (wd == 6 and self.sundays)
+        return bool((self.weekday_of_month_pattern.weekdays >> wd) & 1)
 
     def __str__(self):
         return "{} @ {}".format(abtime.days_of_week_str(self), self.time)
@@ -0,0 +1,171 @@
+# Standard
+import hashlib
+import threading
+import time as systime
+import uuid
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+# Third Party
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+# Local
+from kmkr.models import PlayLogEntry, Track
+import kmkr.schedule as schedule
+
+__author__ = 'Adrian'
+
+_CONFIG = getattr(settings, 'BZWOPS_KMKR_CONFIG', {})
+
+# The name of the cache, in settings.CACHES, that holds the generation of the play log.
+# It should be shared by all processes so that a play logged by one of them is seen by the others.
+NOW_PLAYING_CACHE_ALIAS = _CONFIG.get('SCHEDULE_CACHE', 'default')
+
+# Clients are told to check again within this long, even if nothing is expected to change before then.
+POLL_SECONDS = _CONFIG.get('NOW_PLAYING_POLL_SECONDS', 25)
+
+# Requests check for changes at most this often. The check is shared by all the requests in a process
+# and only uses the database if a play has been logged, so this is cheap.
+CHECK_SECONDS = 1.0
+
+# The next play is usually logged moments after a track runs out, so clients are told to check again this soon.
+OVERDUE_SECONDS = 5
+
+GENERATION_KEY = "kmkr-now-playing-generation"
+
+# The latest play is reloaded at least this often, in case it was logged without the generation changing,
+# e.g. when the cache was unavailable.
+MAX_AGE_SECONDS = 60
+
+
+def show_data(airing: Optional[schedule.Airing], localnow: datetime) -> Optional[dict]:
+    if airing is None:
+        return None
+    show = airing.show  # type: schedule.ScheduledShow
+    time_remaining = airing.start+show.duration - localnow  # type: timedelta
+    return {
+        'title': show.title,
+        'hosts': show.hosts,
+        'start_time': airing.start,
+        'duration': str(show.duration),
+        'description': show.description,
+        'remaining_seconds': round(time_remaining.total_seconds(), 1),
+        'active': show.active
+    }
+
+
+def track_data(ple: Optional[PlayLogEntry], localnow: datetime) -> Optional[dict]:
+    if ple is None:
+        return None
+    time_remaining = (ple.start + ple.duration) - localnow  # type: timedelta
+    return {
+        'title': ple.title,
+        'artist': ple.artist,
+        'radiodj_id': int(ple.track.radiodj_id) if ple.track is not None else -1,
+        'track_type': int(ple.track.track_type) if ple.track is not None else Track.TYPE_MUSIC,
+        'start_datetime': ple.start,
+        'duration_seconds': round(ple.duration.total_seconds(), 1),
+        'remaining_seconds': round(time_remaining.total_seconds(), 1)
+    }
+
+
+def latest_play() -> Optional[PlayLogEntry]:
+    return PlayLogEntry.objects.select_related('track', 'non_library_track').order_by('-start').first()
+
+
+class NowPlaying(NamedTuple):
+    """
+    What's on the air. The version is derived from the show airing and the latest play, so it's the same in
+    every process and only changes when one of them does.
+    """
+    version: str
+    airing: Optional[schedule.Airing]
+    play: Optional[PlayLogEntry]
+
+    @classmethod
+    def of(cls, airing: Optional[schedule.Airing], play: Optional[PlayLogEntry]) -> 'NowPlaying':
+        key = "{}:{}:{}".format(
+            "" if airing is None else "{}@{}".format(airing.show.pk, airing.start.isoformat()),
+            "" if play is None else play.pk,
+            "" if play is None else play.start.isoformat(),
+        )
+        return cls(hashlib.md5(key.encode()).hexdigest()[:16], airing, play)
+
+    def seconds_to_change(self, localnow: datetime) -> float:
+        """
+        Seconds from localnow until this is next expected to change, i.e. until the latest track runs out or
+        a show starts or ends. A play can be logged early, e.g. when a track is skipped, so this is only a hint.
+        """
+        seconds = schedule.get_index().seconds_to_boundary(localnow)  # type: float
+        if self.play is not None:
+            track_remaining = ((self.play.start + self.play.duration) - localnow).total_seconds()
+            if track_remaining > 0:
+                seconds = min(seconds, track_remaining)
+            elif track_remaining > -POLL_SECONDS:
+                seconds = min(seconds, OVERDUE_SECONDS)
+        return seconds
+
+    def as_dict(self, localnow: datetime) -> dict:
+        """Same as the now_playing GET response, plus the version. Remaining times are as of localnow."""
+        return {
+            'version': self.version,
+            'show': show_data(self.airing, localnow),
+            'track': track_data(self.play, localnow),
+        }
+
+
+def _cache():
+    return caches[NOW_PLAYING_CACHE_ALIAS]
+
+
+def _generation() -> Optional[str]:
+    return _cache().get(GENERATION_KEY)
+
+
+class Broadcaster(object):
+    """
+    Keeps one copy of what's on the air for all the requests in a process, refreshed at most every CHECK_SECONDS.
+    What's on the air changes when a play is logged, in this process or another, or when a show boundary passes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None  # type: Optional[NowPlaying]
+        self._generation = None  # type: Optional[str]
+        self._checked = float('-inf')  # type: float
+        self._loaded = float('-inf')  # type: float
+
+    def _refresh(self) -> None:
+        """Must be called with the lock held."""
+        if self._current is not None and systime.monotonic() - self._checked < CHECK_SECONDS:
+            return
+        self._checked = systime.monotonic()
+        play = None if self._current is None else self._current.play
+        generation = _generation()
+        if self._current is None or generation != self._generation or self._checked - self._loaded > MAX_AGE_SECONDS:
+            play = latest_play()
+            self._generation = generation
+            self._loaded = self._checked
+        airing = schedule.get_index().airing_at(timezone.localtime(timezone.now()))
+        self._current = NowPlaying.of(airing, play)
+
+    def current(self) -> NowPlaying:
+        with self._lock:
+            self._refresh()
+            return self._current
+
+    def publish(self) -> None:
+        """A play was logged. Tells every process, including this one, to reload it."""
+        _cache().set(GENERATION_KEY, uuid.uuid4().hex, None)
+        with self._lock:
+            self._checked = float('-inf')
+
+
+broadcaster = Broadcaster()
+
+
+def publish() -> None:
+    """Called once a new play log entry has been committed."""
+    broadcaster.publish()
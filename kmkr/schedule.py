@@ -0,0 +1,170 @@
+# Standard
+import time as systime
+import uuid
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+from typing import List, NamedTuple, Optional
+
+# Third Party
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+# Local
+from abutils.time import WeekdayOfMonthPattern
+from kmkr.models import ShowTime
+
+__author__ = 'Adrian'
+
+# The name of the cache, in settings.CACHES, that holds the schedule's generation.
+# It should be shared by all processes so that a change made by one of them is seen by the others.
+SCHEDULE_CACHE_ALIAS = getattr(settings, 'BZWOPS_KMKR_CONFIG', {}).get('SCHEDULE_CACHE', 'default')
+
+# Every index is labeled with the generation it was built from, so changing it invalidates all of them.
+GENERATION_KEY = "kmkr-schedule-generation"
+
+# An index is rebuilt at least this often, in case a change was made without sending signals (e.g. by update()).
+MAX_AGE_SECONDS = 15*60
+
+# The generation is checked at most this often, since the index is used by every now-playing request.
+CHECK_SECONDS = 1.0
+
+WEEK_SECONDS = 7*24*60*60
+DAY_SECONDS = 24*60*60
+
+
+class ScheduledShow(NamedTuple):
+    """What now_playing reports about a show, as of when the index was built."""
+    pk: int
+    title: str
+    description: str
+    duration: timedelta
+    active: bool
+    hosts: List[str]  # Monikers
+
+
+class Airing(NamedTuple):
+    show: ScheduledShow
+    start: datetime  # Local time at which this airing began.
+
+
+class _Slot(NamedTuple):
+    """A weekly airing of a show, in seconds since Monday 00:00. Start is negative if the airing began the week before."""
+    start: int
+    end: int
+    start_time: time
+    pattern: WeekdayOfMonthPattern  # Decides which weeks the slot airs in.
+    show: ScheduledShow
+
+
+def _secs(t: time) -> int:
+    return t.hour*60*60 + t.minute*60 + t.second
+
+
+class ScheduleIndex(object):
+    """
+    The weekly show schedule as a sorted list of boundaries, in seconds since Monday 00:00, that divides the week
+    into segments. Each segment lists the slots that cover all of it, usually none or one, so finding the show
+    on at a given time is a binary search followed by a weekday-of-month check of the few slots found.
+    """
+
+    def __init__(self, slots: List[_Slot], generation: Optional[str] = None):
+        self.generation = generation
+        self.built = systime.time()
+        bounds = {0, WEEK_SECONDS}
+        for slot in slots:
+            bounds.add(max(slot.start, 0))
+            bounds.add(min(slot.end, WEEK_SECONDS))
+        self.boundaries = sorted(bounds)  # type: List[int]
+        self.segments = [
+            [slot for slot in slots if slot.start <= seg_start and slot.end >= seg_end]
+            for seg_start, seg_end in zip(self.boundaries, self.boundaries[1:])
+        ]  # type: List[List[_Slot]]
+
+    @classmethod
+    def build(cls, generation: Optional[str] = None) -> 'ScheduleIndex':
+        """Build the index from the database."""
+        shows = {}
+        slots = []  # type: List[_Slot]
+        showtimes = ShowTime.objects.select_related('show').prefetch_related('show__hosts').order_by('show_id', 'pk')
+        for showtime in showtimes:  # type: ShowTime
+            show = showtime.show
+            if show.pk not in shows:
+                shows[show.pk] = ScheduledShow(
+                    show.pk, show.title, show.description, show.duration, show.active,
+                    [host.moniker for host in show.hosts.all()]
+                )
+            duration = min(int(show.duration.total_seconds()), WEEK_SECONDS)
+            if duration <= 0:
+                continue
+            pattern = showtime.weekday_of_month_pattern
+            for weekday in range(7):
+                if not (pattern.weekdays >> weekday) & 1:
+                    continue
+                start = weekday*DAY_SECONDS + _secs(showtime.start_time)
+                slots.append(_Slot(start, start+duration, showtime.start_time, pattern, shows[show.pk]))
+                if start+duration > WEEK_SECONDS:
+                    # The part that spills into the next week is also at the start of this one.
+                    slots.append(_Slot(start-WEEK_SECONDS, start+duration-WEEK_SECONDS, showtime.start_time, pattern, shows[show.pk]))
+        return cls(slots, generation)
+
+    def seconds_to_boundary(self, localdt: datetime) -> int:
+        """Seconds from the given local time until the next time that a show might start or end."""
+        t = localdt.weekday()*DAY_SECONDS + _secs(localdt.time())
+        return self.boundaries[bisect_right(self.boundaries, t)] - t
+
+    def airing_at(self, localdt: datetime) -> Optional[Airing]:
+        """The airing in progress at the given local time, if any. Doesn't use the database."""
+        t = localdt.weekday()*DAY_SECONDS + _secs(localdt.time())
+        segment = self.segments[bisect_right(self.boundaries, t) - 1]
+        for slot in segment:
+            start_date = (localdt - timedelta(seconds=t-slot.start)).date()
+            if slot.pattern.matches(start_date):
+                start = timezone.make_aware(datetime.combine(start_date, slot.start_time), timezone.get_current_timezone())
+                return Airing(slot.show, start)
+        return None
+
+
+_index = None  # type: Optional[ScheduleIndex]
+_checked = float('-inf')  # type: float
+
+
+def _cache():
+    return caches[SCHEDULE_CACHE_ALIAS]
+
+
+def _generation() -> str:
+    generation = _cache().get(GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        _cache().set(GENERATION_KEY, generation, None)
+    return generation
+
+
+def invalidate() -> None:
+    """Invalidate the index in every process. Called when shows, show times, or hosts change."""
+    global _index
+    _index = None
+
+    def new_generation():
+        _cache().set(GENERATION_KEY, uuid.uuid4().hex, None)
+    new_generation()
+    # Another process might rebuild from the old data before the change commits, so do it again afterwards.
+    transaction.on_commit(new_generation)
+
+
+def get_index() -> ScheduleIndex:
+    """The index for this process, rebuilt if the schedule has changed since it was built."""
+    global _index, _checked
+    index = _index
+    stale = index is None or systime.time() - index.built > MAX_AGE_SECONDS
+    if not stale and systime.monotonic() - _checked < CHECK_SECONDS:
+        return index
+    _checked = systime.monotonic()
+    generation = _generation()
+    if stale or index.generation != generation:
+        index = ScheduleIndex.build(generation)
+        _index = index
+    return index
+
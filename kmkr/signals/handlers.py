@@ -4,11 +4,12 @@ from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 
 # Third Party
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.urls import reverse
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.utils.timezone import localtime
 
@@ -16,9 +17,11 @@ from django.utils.timezone import localtime
 from members.models import Member
 from tasks.models import Play
 from kmkr.models import (
-    Track, PlayLogEntry, Show,
+    Track, PlayLogEntry, Show, ShowTime, OnAirPersonality,
     UnderwritingDeal, UnderwritingBroadcastLog
 )
+import kmkr.schedule as schedule
+import kmkr.nowplaying as nowplaying
 import members.notifications as notifications
 
 __author__ = 'Adrian'
@@ -67,6 +70,13 @@ def log_underwriter_broadcasts(sender, **kwargs):
         logger.error("kmkr.signal.handlers: %s", str(e))
 
 
+@receiver(post_save, sender=PlayLogEntry)
+def publish_now_playing(sender, **kwargs):
+    """Wake the now-playing stream's listeners once the new entry can be read by other connections."""
+    unused(sender)
+    transaction.on_commit(nowplaying.publish)
+
+
 @receiver(post_save, sender=PlayLogEntry)
 def time_accounting_for_recorded_broadcast(sender, **kwargs):
     unused(sender)
@@ -99,3 +109,15 @@ def time_accounting_for_recorded_broadcast(sender, **kwargs):
     except Exception as e:
         logger.error(e.with_traceback())
 
+
+@receiver(post_save, sender=Show)
+@receiver(post_delete, sender=Show)
+@receiver(post_save, sender=ShowTime)
+@receiver(post_delete, sender=ShowTime)
+@receiver(post_save, sender=OnAirPersonality)
+@receiver(post_delete, sender=OnAirPersonality)
+@receiver(m2m_changed, sender=Show.hosts.through)
+def invalidate_schedule(sender, **kwargs):
+    """now_playing answers from an in-memory index of the schedule, which must be rebuilt when it changes."""
+    unused(sender)
+    schedule.invalidate()
@@ -13,6 +13,7 @@ from freezegun import freeze_time
 from .models import (
     PlayLogEntry, Track, Show, ShowTime, OnAirPersonality
 )
+from . import schedule, nowplaying
 
 
 class TestNowPlaying(TestCase):
@@ -103,6 +104,141 @@ class TestNowPlaying(TestCase):
             json = response.json()
             self.assertIsNone(json['show'])
 
+    def test_schedule_index(self):
+
+        host = OnAirPersonality.objects.create(member=User.objects.create(username="bob").member, moniker="Bobcat")
+        weekly = Show.objects.create(title="Weekly", description="Every Tuesday", duration=timedelta(hours=2))
+        weekly.hosts.add(host)
+        ShowTime.objects.create(show=weekly, tuesdays=True, start_time=time(9, 0, 0))
+        monthly = Show.objects.create(title="Monthly", description="1st and 3rd Fridays", duration=timedelta(minutes=30))
+        ShowTime.objects.create(show=monthly, fridays=True, every=False, first=True, third=True, start_time=time(20, 0, 0))
+        late = Show.objects.create(title="Late", description="Sunday into Monday", duration=timedelta(hours=3))
+        ShowTime.objects.create(show=late, sundays=True, start_time=time(23, 0, 0))
+
+        def on_air(dt: datetime):
+            airing = schedule.get_index().airing_at(dt)
+            return None if airing is None else airing.show.title
+
+        local = lambda *args: timezone.make_aware(datetime(*args), self.tz)
+        schedule.get_index()
+        with self.assertNumQueries(0):
+            self.assertEqual(on_air(local(2018, 7, 10, 9, 0)), "Weekly")  # Tuesday
+            self.assertEqual(on_air(local(2018, 7, 10, 10, 59)), "Weekly")
+            self.assertIsNone(on_air(local(2018, 7, 10, 11, 0)))
+            self.assertEqual(on_air(local(2018, 7, 6, 20, 15)), "Monthly")  # 1st Friday
+            self.assertIsNone(on_air(local(2018, 7, 13, 20, 15)))  # 2nd Friday
+            self.assertEqual(on_air(local(2018, 7, 20, 20, 15)), "Monthly")  # 3rd Friday
+            self.assertEqual(on_air(local(2018, 7, 8, 23, 30)), "Late")  # Sunday
+            self.assertEqual(on_air(local(2018, 7, 9, 1, 30)), "Late")  # Monday, in the next week of the index
+            self.assertIsNone(on_air(local(2018, 7, 9, 2, 0)))
+
+        # Airings that cross midnight began the day before.
+        airing = schedule.get_index().airing_at(local(2018, 7, 9, 1, 30))
+        self.assertEqual(airing.start, local(2018, 7, 8, 23, 0))
+
+        # Agrees with the shows' own notion of what's on, where they can tell.
+        for hour in range(0, 7*24, 3):
+            dt = local(2018, 7, 2) + timedelta(hours=hour, minutes=15)
+            with freeze_time(dt):
+                current = Show.current_show()
+            if dt.hour >= 2:  # Show.current_show() doesn't see airings that began the day before.
+                self.assertEqual(on_air(dt), None if current is None else current.title)
+
+        # Changes to the schedule are picked up.
+        weekly.hosts.add(OnAirPersonality.objects.create(member=User.objects.create(username="sue").member, moniker="Sue"))
+        ShowTime.objects.create(show=weekly, thursdays=True, start_time=time(9, 0, 0))
+        with freeze_time(local(2018, 7, 12, 9, 30)):
+            json = Client().get(self.url).json()
+            self.assertEqual(json['show']['title'], "Weekly")
+            self.assertEqual(sorted(json['show']['hosts']), ["Bobcat", "Sue"])
+            self.assertEqual(json['show']['remaining_seconds'], 90*60)
+
+    def test_stream(self):
+
+        nowplaying.broadcaster = nowplaying.Broadcaster()  # Don't see state left by other tests.
+        client = Client()
+        stream_url = reverse('kmkr:now-playing-stream')
+
+        show = Show.objects.create(title="Bob's Show", description="Bob talks about stuff", duration=timedelta(hours=1))
+        ShowTime.objects.create(show=show, mondays=True, start_time=time(14, 00, 00))
+        before = timezone.make_aware(datetime(2018, 7, 9, 13, 50, 00), self.tz)  # A Monday
+
+        with freeze_time(before):
+            response = client.get(stream_url)
+            json = response.json()
+            self.assertIsNone(json['show'])
+            self.assertIsNone(json['track'])
+            version = json['version']
+
+            # Nothing is expected to change before the show starts, so check again at the most after POLL_SECONDS.
+            self.assertEqual(response['Retry-After'], str(nowplaying.POLL_SECONDS))
+            self.assertEqual(json['retry_seconds'], nowplaying.POLL_SECONDS)
+            self.assertEqual(client.get(stream_url, {'wait': 5})['Retry-After'], "5")
+            self.assertEqual(client.get(stream_url, {'wait': 0})['Retry-After'], "1")
+
+            # A client that has the current version isn't sent it again, but is still told when to check again.
+            for response in [client.get(stream_url, {'version': version}), client.get(stream_url, HTTP_IF_NONE_MATCH=response['ETag'])]:
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b"")
+                self.assertEqual(response['Retry-After'], str(nowplaying.POLL_SECONDS))
+
+            # A wait that isn't a number of seconds is the default wait.
+            for wait in ["nan", "inf", "-inf", "soon"]:
+                response = client.get(stream_url, {'wait': wait})
+                self.assertEqual(response['Retry-After'], str(nowplaying.POLL_SECONDS))
+                self.assertEqual(response.json()['version'], version)
+
+            # Logging a track is a change. Entries are published once committed, which doesn't happen in this test.
+            client.post(self.url, self.data1)
+            nowplaying.publish()
+            with self.assertNumQueries(2):  # The generation, from the shared cache, and the latest play.
+                response = client.get(stream_url, {'version': version})
+            self.assertEqual(response.status_code, 200)
+            json = response.json()
+            self.assertNotEqual(json['version'], version)
+            self.assertEqual(json['track']['title'], self.data1['TITLE'])
+            version = json['version']
+
+            # Requests share the result instead of querying again.
+            with self.assertNumQueries(0):
+                self.assertEqual(client.get(stream_url).json()['version'], version)
+
+        # Check again when the track ends, and soon after if the next one hasn't been logged yet.
+        with freeze_time(before + timedelta(minutes=3, seconds=20)):
+            self.assertEqual(client.get(stream_url)['Retry-After'], "13")
+        with freeze_time(before + timedelta(minutes=3, seconds=40)):
+            self.assertEqual(client.get(stream_url)['Retry-After'], str(nowplaying.OVERDUE_SECONDS))
+
+        # Check again when the show starts.
+        with freeze_time(before + timedelta(minutes=9, seconds=50)):
+            self.assertEqual(client.get(stream_url)['Retry-After'], "10")
+
+        # The show starting is a change.
+        with freeze_time(before + timedelta(minutes=10, seconds=30)):
+            nowplaying.broadcaster = nowplaying.Broadcaster()  # Pretend CHECK_SECONDS have passed.
+            json = client.get(stream_url, {'version': version}).json()
+            self.assertNotEqual(json['version'], version)
+            self.assertEqual(json['show']['title'], show.title)
+            self.assertEqual(json['show']['remaining_seconds'], 59.5*60)
+            self.assertEqual(json['track']['title'], self.data1['TITLE'])
+
+    def test_stream_max_age(self):
+
+        nowplaying.broadcaster = nowplaying.Broadcaster()  # Don't see state left by other tests.
+        client = Client()
+        stream_url = reverse('kmkr:now-playing-stream')
+        start = timezone.make_aware(datetime(2018, 7, 9, 13, 50, 00), self.tz)
+
+        with freeze_time(start):
+            version = client.get(stream_url).json()['version']
+            # Like a play logged by a process whose change to the generation wasn't seen.
+            client.post(self.url, self.data1)
+        with freeze_time(start + timedelta(seconds=nowplaying.MAX_AGE_SECONDS/2)):
+            self.assertEqual(client.get(stream_url).json()['version'], version)
+        with freeze_time(start + timedelta(seconds=nowplaying.MAX_AGE_SECONDS+1)):
+            json = client.get(stream_url).json()
+            self.assertNotEqual(json['version'], version)
+            self.assertEqual(json['track']['title'], self.data1['TITLE'])
 
 class TestPlayTimeDeduction(TestCase):
 
@@ -19,6 +19,10 @@ urlpatterns = [
         views.now_playing,
         name='now-playing'),
 
+    url(r'^now-playing/stream/$',
+        views.now_playing_stream,
+        name='now-playing-stream'),
+
     url(r'^now-playing-fbapp/$',
         views.now_playing_fbapp,
         name='now-playing-fbapp'),
@@ -1,11 +1,13 @@
 
 # Standard
+import math
 from logging import getLogger
-from datetime import timedelta, time, datetime
+from typing import Optional
 
 # Third Party
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified
 from django.utils import timezone
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import ensure_csrf_cookie
@@ -13,7 +15,8 @@ from django.shortcuts import render
 from django.conf import settings
 
 # Local
-from .models import PlayLogEntry, Track, Show, ShowTime
+from .models import PlayLogEntry, Track
+from . import schedule, nowplaying
 
 
 ORG_NAME = settings.BZWOPS_ORG_NAME
@@ -31,42 +34,10 @@ def now_playing(request) -> JsonResponse:
 
     if request.method == "GET":
 
-        showdata = None
-        show = Show.current_show()  # type: Show
-        if show is not None:
-            showtime = show.current_showtime()  # type: ShowTime
-            t = showtime.start_time
-            d = localnow.date()
-            show_start_datetime = timezone.make_aware(
-                datetime(d.year, d.month, d.day, t.hour, t.minute, t.second),
-                timezone.get_current_timezone()
-            )
-            time_remaining = show_start_datetime+show.duration - localnow  # type: timedelta
-            showdata = {
-                'title': show.title,
-                'hosts': [x.moniker for x in show.hosts.all()],
-                'start_time': show_start_datetime,
-                'duration': str(show.duration),
-                'description': show.description,
-                'remaining_seconds': round(time_remaining.total_seconds(), 1),
-                'active': show.active
-            }
-
-        trackdata = None
-        try:
-            ple = PlayLogEntry.objects.latest('start')  # type: PlayLogEntry
-            time_remaining = (ple.start + ple.duration) - localnow  # type: timedelta
-            trackdata = {
-                'title': ple.title,
-                'artist': ple.artist,
-                'radiodj_id': int(ple.track.radiodj_id) if ple.track is not None else -1,
-                'track_type': int(ple.track.track_type) if ple.track is not None else Track.TYPE_MUSIC,
-                'start_datetime': ple.start,
-                'duration_seconds': round(ple.duration.total_seconds(), 1),
-                'remaining_seconds': round(time_remaining.total_seconds(), 1)
-            }
-        except PlayLogEntry.DoesNotExist:
-            pass  # trackdata is already None
+        airing = schedule.get_index().airing_at(localnow)  # type: Optional[schedule.Airing]
+        ple = nowplaying.latest_play()  # type: Optional[PlayLogEntry]
+        showdata = nowplaying.show_data(airing, localnow)
+        trackdata = nowplaying.track_data(ple, localnow)
 
         return JsonResponse({'show': showdata, 'track': trackdata})
 
@@ -95,8 +66,8 @@ def now_playing(request) -> JsonResponse:
         )
 
         # TODO: This needs to be rewritten to use Broadcast.host_checked_in
-        currentshow = Show.current_show()
-        if currentshow is None:
+        airing = schedule.get_index().airing_at(localnow)  # type: Optional[schedule.Airing]
+        if airing is None:
             # Only create the play log entry if there's no show scheduled for this time.
             # Reason: KMKR leaves RadioDJ running during their live shows, but faded out.
             PlayLogEntry.objects.create(
@@ -104,11 +75,44 @@ def now_playing(request) -> JsonResponse:
                 track=track
             )
         else:
-            logger.info("Did not log {} because {} is airing.".format(track, currentshow.title))
+            logger.info("Did not log {} because {} is airing.".format(track, airing.show.title))
 
         return JsonResponse({"result": "success"})
 
 
+@require_http_methods(["GET"])
+def now_playing_stream(request) -> HttpResponse:
+    """
+    Polling version of now_playing, answered right away so that it doesn't tie up a web worker. The response
+    includes a version, which only changes when what's on the air does, and says when to check again, in its
+    Retry-After header and as retry_seconds. That's when the track ends or a show starts or ends, but no later
+    than the given wait (in seconds, at most POLL_SECONDS). A client that passes back the version it has, as
+    ?version= or in If-None-Match, gets 304 Not Modified if it's still current.
+    """
+    try:
+        wait = float(request.GET.get('wait', nowplaying.POLL_SECONDS))
+    except ValueError:
+        wait = nowplaying.POLL_SECONDS
+    if not math.isfinite(wait):
+        wait = nowplaying.POLL_SECONDS  # NaN would get past the clamp below.
+    wait = min(max(wait, 0), nowplaying.POLL_SECONDS)
+    localnow = timezone.localtime(timezone.now())
+    current = nowplaying.broadcaster.current()  # type: nowplaying.NowPlaying
+    retry_seconds = math.ceil(max(min(current.seconds_to_change(localnow), wait), nowplaying.CHECK_SECONDS))
+    etag = '"{}"'.format(current.version)
+
+    if request.GET.get('version') == current.version or etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', "")):
+        response = HttpResponseNotModified()
+    else:
+        data = current.as_dict(localnow)
+        data['retry_seconds'] = retry_seconds
+        response = JsonResponse(data)
+    response['ETag'] = etag
+    response['Cache-Control'] = "no-cache"
+    response['Retry-After'] = str(retry_seconds)
+    return response
+
+
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
 def now_playing_fbapp(request) -> HttpResponse:
@@ -0,0 +1,110 @@
+# Standard
+import hashlib
+from datetime import date
+from logging import getLogger
+from typing import NamedTuple, Optional
+
+# Third Party
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+# Local
+from members.models import Member, Membership
+
+__author__ = 'Adrian'
+
+logger = getLogger("members")
+
+# The name of the cache, in settings.CACHES, that holds the access decisions.
+ACCESS_CACHE_ALIAS = settings.BZWOPS_MEMBERS_CONFIG.get('ACCESS_CACHE', 'default')
+
+KEY_PREFIX = "access-decision:"
+
+
+class AccessDecision(NamedTuple):
+    """What the door needs to know about a card. member_pk is None if the card isn't registered."""
+    member_pk: Optional[int]
+    current: bool
+    start_date: Optional[date]  # Of the member's latest membership
+    end_date: Optional[date]  # Of the member's latest membership
+    as_of: date  # "current" is only valid on this day
+
+    @property
+    def card_registered(self) -> bool:
+        return self.member_pk is not None
+
+
+def card_md5(card_str: str) -> str:
+    return hashlib.md5(card_str.encode()).hexdigest()
+
+
+def _cache():
+    return caches[ACCESS_CACHE_ALIAS]
+
+
+def decide(member: Optional[Member]) -> AccessDecision:
+    """Make the access decision for member using the database."""
+    today = date.today()
+    if member is None:
+        return AccessDecision(None, False, None, None, today)
+    try:
+        latest = Membership.objects.filter(member=member).latest('start_date')  # type: Membership
+    except Membership.DoesNotExist:
+        return AccessDecision(member.pk, False, None, None, today)
+    return AccessDecision(member.pk, member.is_currently_paid(), latest.start_date, latest.end_date, today)
+
+
+def get_access_decision(card_str: str) -> AccessDecision:
+    """The access decision for the given card, from the cache if possible. Unregistered cards are cached, too."""
+    md5 = card_md5(card_str)
+    decision = _cache().get(KEY_PREFIX + md5)  # type: Optional[AccessDecision]
+    if decision is not None and decision.as_of == date.today():
+        return decision
+    try:
+        member = Member.objects.get(membership_card_md5=md5)
+    except Member.DoesNotExist:
+        member = None
+    decision = decide(member)
+    _cache().set(KEY_PREFIX + md5, decision)
+    return decision
+
+
+def invalidate_card_md5(md5: Optional[str]) -> None:
+    if md5 is None or md5 == "":
+        return
+    key = KEY_PREFIX + md5
+    _cache().delete(key)
+    # Another process might cache the old decision before the change commits, so delete again afterwards.
+    transaction.on_commit(lambda: _cache().delete(key))
+
+
+def invalidate_member_pk(member_pk: Optional[int]) -> None:
+    if member_pk is None:
+        return
+    md5 = Member.objects.filter(pk=member_pk).values_list('membership_card_md5', flat=True).first()
+    invalidate_card_md5(md5)
+
+
+def prewarm() -> int:
+    """Cache the access decisions of all members that have cards. Returns the number cached."""
+    today = date.today()
+    members = Member.objects.exclude(membership_card_md5=None).exclude(membership_card_md5="")
+    latest = {}  # Latest membership, by member pk
+    for mship in Membership.objects.filter(member__in=members).order_by('start_date'):
+        latest[mship.member_id] = mship
+    current = set(Membership.objects.filter(
+        member__in=members, start_date__lte=today, end_date__gte=today).values_list('member_id', flat=True))
+
+    decisions = {}
+    for member_pk, md5 in members.values_list('pk', 'membership_card_md5'):
+        mship = latest.get(member_pk)
+        decisions[KEY_PREFIX + md5] = AccessDecision(
+            member_pk,
+            member_pk in current,
+            mship.start_date if mship else None,
+            mship.end_date if mship else None,
+            today
+        )
+    _cache().set_many(decisions)
+    return len(decisions)
@@ -3,6 +3,7 @@ from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
 from django.utils import timezone
 from members.models import Tagging
+import modelmailer.outbox as outbox
 import datetime
 import logging
 
@@ -32,7 +33,7 @@ class Command(BaseCommand):
         html_content = html_content_template.render(d)
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
+        outbox.enqueue(msg)
 
     def handle(self, *args, **options):
         tagging_lists = {}
@@ -55,3 +56,5 @@ class Command(BaseCommand):
             if member.email == "": continue
             logger.info("Sent email to %s regarding authorized taggings", member)
             Command.send_report(member, tagging_list)
+
+        outbox.deliver()
@@ -13,6 +13,7 @@ from freezegun import freeze_time
 
 # Local
 from members.models import Membership, VisitEvent
+import modelmailer.outbox as outbox
 
 __author__ = 'adrian'
 
@@ -89,7 +90,7 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            outbox.enqueue(msg)
 
             logger.info("Email sent to %s re bad visit.", member.username)
             pm.when_nudged = date.today()
@@ -189,6 +190,7 @@ class Command(BaseCommand):
 
         bad_visitors = self.collect_bad_visitors()
         self.process_bad_visitors(bad_visitors)
+        outbox.deliver()
 
         if test_time is not None:
             freezer.stop()
\ No newline at end of file
@@ -0,0 +1,19 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+import members.access as access
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Caches the RFID access decision for every member card. Run after midnight, since decisions are per day."
+
+    def handle(self, *args, **options):
+        print("Caching access decisions... ", end="", flush=True)
+        count = access.prewarm()
+        print("Done. Cached {} decisions.".format(count))
@@ -791,6 +791,10 @@ class GroupMembership(MembershipJournalLiner):
             # I don't know that we'll be comp'ing these.
             raise ValidationError(_("Group membership must be part of an invoice or sale."))
 
+    @classmethod
+    def objs_for_dbcheck(cls) -> models.QuerySet:
+        return cls.objects.prefetch_related('membership_set')
+
     def dbcheck(self):
         for mship in self.membership_set.all():
             if self.start_date != mship.start_date or self.end_date != mship.end_date:
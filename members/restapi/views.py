@@ -8,6 +8,7 @@ from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnl
 from rest_framework.response import Response
 
 # Local
+from abutils.restapi import BulkUpsertMixin
 import members.restapi.serializers as ser
 import members.restapi.filters as filt
 import members.restapi.permissions as perm
@@ -44,7 +45,7 @@ class MemberViewSet(viewsets.ModelViewSet):
         return Response(slizer.data)
 
 
-class MembershipViewSet(viewsets.ModelViewSet):
+class MembershipViewSet(BulkUpsertMixin, viewsets.ModelViewSet):
     """
     REST API endpoint that allows memberships to be viewed or edited.
     """
@@ -63,7 +64,7 @@ class DiscoveryMethodViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
 
 
-class MembershipGiftCardReferenceViewSet(viewsets.ModelViewSet):
+class MembershipGiftCardReferenceViewSet(BulkUpsertMixin, viewsets.ModelViewSet):
     """
     REST API endpoint that allows memberships to be viewed or edited.
     """
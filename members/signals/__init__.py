@@ -1 +1,8 @@
-__author__ = 'Adrian'
+# Third Party
+from django.dispatch import Signal
+
+__author__ = 'Adrian'
+
+# Sent after a batch of visit events is saved with bulk_create, which doesn't send post_save.
+# Receivers get "visits", a list of the saved VisitEvents.
+visit_events_saved = Signal(providing_args=["visits"])
@@ -1,9 +1,10 @@
 # Standard
 from datetime import timedelta
+from typing import Union
 import logging
 
 # Third Party
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
@@ -11,6 +12,7 @@ from django.core.exceptions import ObjectDoesNotExist
 # Local
 from members.models import Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, VisitEvent
 import members.notifications as notifications
+import members.access as access
 from abutils.utils import get_ip_address
 
 __author__ = 'Adrian'
@@ -57,6 +59,44 @@ def link_membership_to_member(sender, **kwargs):
             mship.link_to_member()
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# RFID ACCESS DECISIONS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(pre_save, sender=Member)
+def invalidate_access_for_old_card(sender, **kwargs):
+    # The member's card might be changing, in which case the decision for the old card is stale.
+    member = kwargs.get('instance')  # type: Member
+    if member.pk is not None and not kwargs.get('raw', False):
+        access.invalidate_member_pk(member.pk)
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def invalidate_access_for_member(sender, **kwargs):
+    member = kwargs.get('instance')  # type: Member
+    access.invalidate_card_md5(member.membership_card_md5)
+
+
+@receiver(pre_save, sender=Membership)
+def invalidate_access_for_old_membership_member(sender, **kwargs):
+    # The membership might be moving to a different member, in which case the old member's decision is stale.
+    mship = kwargs.get('instance')  # type: Membership
+    if mship.pk is not None and not kwargs.get('raw', False):
+        old_member_pk = Membership.objects.filter(pk=mship.pk).values_list('member_id', flat=True).first()
+        if old_member_pk != mship.member_id:
+            access.invalidate_member_pk(old_member_pk)
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+@receiver(post_save, sender=Tagging)
+@receiver(post_delete, sender=Tagging)
+def invalidate_access_for_related_member(sender, **kwargs):
+    instance = kwargs.get('instance')  # type: Union[Membership, Tagging]
+    access.invalidate_member_pk(instance.member_id)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # LOGIN (No longer of interest)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -11,6 +11,7 @@ from django.test import Client
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.core import management, mail
+from django.core.cache import caches
 from django.utils import timezone
 from django.urls import reverse
 from freezegun import freeze_time
@@ -23,6 +24,7 @@ from members.models import (
 from members.notifications import pushover_available
 from members.management.commands.membershipnudge import Command as MembershipNudgeCmd
 import members.views as views
+import members.access as access
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -339,9 +341,15 @@ class RfidEntry(TestCase):
         # This simulates requests from inside the facility.
         views.FACILITY_PUBLIC_IP = "127.0.0.1"
 
+        caches[access.ACCESS_CACHE_ALIAS].clear()
+
     def tearDown(self):
         views.FACILITY_PUBLIC_IP = settings.BZWOPS_FACILITY_PUBLIC_IP
 
+    def request_entry(self) -> dict:
+        path = reverse('memb:rfid-entry-requested', args=[self.registered_card])
+        return json.loads(self.client.get(path).content.decode())
+
     def test_ip(self):
 
         # The card number used for this test doesn't matter.
@@ -406,11 +414,54 @@ class RfidEntry(TestCase):
         self.assertIsNotNone(jr['membership_start_date'])
         self.assertIsNotNone(jr['membership_end_date'])
 
+    def test_cached_decision(self):
+        self.assertFalse(self.request_entry()['membership_current'])
+        with self.assertNumQueries(1):  # Just the lookup in the shared cache.
+            jr = self.request_entry()
+        self.assertTrue(jr['card_registered'])
+        self.assertFalse(jr['membership_current'])
+
+    def test_membership_invalidates(self):
+        self.assertFalse(self.request_entry()['membership_current'])
+        mship = Membership.objects.create(
+            member=self.memb,
+            start_date=date.today()-timedelta(days=7),
+            end_date=date.today()+timedelta(days=7),
+        )
+        self.assertTrue(self.request_entry()['membership_current'])
+        mship.delete()
+        self.assertFalse(self.request_entry()['membership_current'])
+
+    def test_card_change_invalidates(self):
+        self.assertTrue(self.request_entry()['card_registered'])
+        self.memb.membership_card_md5 = None
+        self.memb.save()
+        self.assertFalse(self.request_entry()['card_registered'])
+
+    def test_prewarm(self):
+        Membership.objects.create(
+            member=self.memb,
+            start_date=date.today()-timedelta(days=7),
+            end_date=date.today()+timedelta(days=7),
+        )
+        management.call_command("prewarmaccess")
+        with self.assertNumQueries(1):  # Just the lookup in the shared cache.
+            jr = self.request_entry()
+        self.assertTrue(jr['membership_current'])
+        self.assertEqual(jr['membership_end_date'], (date.today()+timedelta(days=7)).isoformat())
+
     def test_note_granted(self):
         path = reverse('memb:rfid-entry-granted', args=[self.registered_card])
         response = self.client.get(path)
         self.assertTrue(response.status_code == 200)
 
+    def test_granted_logs_presence(self):
+        path = reverse('memb:rfid-entry-granted', args=[self.registered_card])
+        self.client.get(path)
+        visit = VisitEvent.objects.get(who=self.memb)
+        self.assertEqual(visit.event_type, VisitEvent.EVT_PRESENT)
+        self.assertEqual(visit.method, VisitEvent.METHOD_RFID)
+
     def test_note_denied(self):
         path = reverse('memb:rfid-entry-denied', args=[self.registered_card])
         response = self.client.get(path)
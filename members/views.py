@@ -34,9 +34,12 @@ from reportlab.lib.pagesizes import letter
 
 # Local
 from members.models import Member, Tag, Tagging, VisitEvent, Membership, DiscoveryMethod
+from members.access import AccessDecision, get_access_decision
+from members.visitqueue import log_visit_event
 from members.forms import Desktop_ChooseUserForm
 from members.restapi.serializers import get_MemberSerializer
 from abutils.utils import request_is_from_host
+import modelmailer.outbox as outbox
 
 logger = getLogger("members")
 
@@ -84,7 +87,9 @@ def _log_visit_event(who_in: Union[str, Member, int], event_type, reason=None, m
     if who is None:
         return False, "No matching member found."
 
-    VisitEvent.objects.create(who=who, event_type=event_type, reason=reason, method=method)
+    if method is None:
+        method = VisitEvent.METHOD_UNKNOWN
+    log_visit_event(who=who, event_type=event_type, reason=reason, method=method)
     return True, who
 
 
@@ -303,25 +308,17 @@ def inside_facility_only(function):
 @inside_facility_only
 def rfid_entry_requested(request, rfid_cardnum):
 
-    member = Member.get_by_card_str(rfid_cardnum)
-    if member is None:
+    # The decision usually comes from the access cache, so the door doesn't wait on the database.
+    decision = get_access_decision(rfid_cardnum)  # type: AccessDecision
+    if not decision.card_registered:
         json = {'card_registered': False}
     else:
-        try:
-            latest_pm = Membership.objects.filter(member=member).latest('start_date')
-            json = {
-                'card_registered': True,
-                'membership_current': member.is_currently_paid(),
-                'membership_start_date': latest_pm.start_date,
-                'membership_end_date': latest_pm.end_date,
-            }
-        except Membership.DoesNotExist:
-            json = {
-                'card_registered': True,
-                'membership_current': False,
-                'membership_start_date': None,
-                'membership_end_date': None,
-            }
+        json = {
+            'card_registered': True,
+            'membership_current': decision.current,
+            'membership_start_date': decision.start_date,
+            'membership_end_date': decision.end_date,
+        }
     return JsonResponse(json)
 
 
@@ -329,7 +326,7 @@ def rfid_entry_requested(request, rfid_cardnum):
 def rfid_entry_granted(request, rfid_cardnum):
     member = Member.get_by_card_str(rfid_cardnum)
     if member is not None:
-        VisitEvent.objects.create(
+        log_visit_event(
             who=member,
             # RFID reads are not reliable indicators of arrival.
             # Cards are sometimes read when people walk past the reader on the way OUT.
@@ -490,7 +487,7 @@ def reception_kiosk_email_mship_buy_info(request) -> HttpResponse:
     html_content = html_content_template.render(d)
     msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    outbox.send(msg)  # If it can't be sent right now, it'll be retried later.
     return HttpResponse("Success")
 
 
@@ -0,0 +1,151 @@
+# Standard
+import atexit
+import threading
+from logging import getLogger
+from typing import List, Optional
+
+# Third Party
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, close_old_connections, connection, transaction
+
+# Local
+from members.models import VisitEvent
+from members.signals import visit_events_saved
+
+__author__ = 'Adrian'
+
+logger = getLogger("members")
+
+
+class VisitEventQueue(object):
+    """
+    A write-behind queue for visit events. Events are accepted without touching the database and a
+    background thread saves them in batches, then sends visit_events_saved for the batch. If the
+    thread isn't running (e.g. flush_seconds is None, as in tests) each event is saved as it's put.
+
+    Events that are waiting to be saved are lost if the process dies, so normally up to flush_seconds
+    worth of them. If the database is unavailable, failed batches are requeued, so the window grows
+    until max_pending events are waiting. After that, put() saves each event itself, and raises if
+    it can't, and requeued events beyond max_pending are dropped, oldest first, and logged.
+    """
+
+    def __init__(self, flush_seconds: Optional[float], max_batch: int = 500, max_pending: int = 5000):
+        self.flush_seconds = flush_seconds
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._pending = []  # type: List[VisitEvent]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.is_running or self.flush_seconds is None:
+                return
+            self._thread = threading.Thread(target=self._run, name="visit-event-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def put(self, visit: VisitEvent) -> None:
+        self.start()
+        with self._lock:
+            backlogged = len(self._pending) >= self.max_pending
+            if not backlogged:
+                self._pending.append(visit)
+            pending_count = len(self._pending)
+        if backlogged:
+            # Saves have been failing for a while. Rather than hold even more events in memory,
+            # save this one now so that the caller finds out if it can't be saved.
+            self._save([visit])
+            self._send_saved([visit])
+        elif not self.is_running:
+            # Synchronous fallback.
+            self.flush()
+        elif pending_count >= self.max_batch:
+            self._wakeup.set()
+
+    def flush(self) -> List[VisitEvent]:
+        """Save the pending events and send visit_events_saved for them. Returns the events saved."""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if len(batch) == 0:
+            return batch
+        try:
+            self._save(batch)
+        except IntegrityError:
+            # E.g. a member was deleted while their visit was waiting. Retrying won't help that visit,
+            # so the batch is saved one visit at a time and only the ones that fail are dropped.
+            batch = self._save_each(batch)
+        except DatabaseError:
+            self._requeue(batch)
+            return []
+        if len(batch) == 0:
+            return batch
+        self._send_saved(batch)
+        return batch
+
+    @staticmethod
+    def _send_saved(visits: List[VisitEvent]) -> None:
+        for receiver, result in visit_events_saved.send_robust(sender=VisitEvent, visits=visits):
+            if isinstance(result, Exception):
+                logger.error("Problem in %s: %s", getattr(receiver, '__name__', receiver), str(result))
+
+    @staticmethod
+    def _save(visits: List[VisitEvent]) -> None:
+        with transaction.atomic():
+            VisitEvent.objects.bulk_create(visits)
+            # Foreign keys are checked when the transaction commits, which is later if there's an outer one.
+            # Check them now so that a bad visit is noticed here.
+            connection.check_constraints(table_names=[VisitEvent._meta.db_table])
+
+    def _save_each(self, batch: List[VisitEvent]) -> List[VisitEvent]:
+        """Save the visits one at a time, dropping those that can't be saved. Returns the ones saved."""
+        saved = []  # type: List[VisitEvent]
+        for n, visit in enumerate(batch):
+            try:
+                self._save([visit])
+            except IntegrityError:
+                logger.exception("Dropped a visit event for member #%s.", visit.who_id)
+            except DatabaseError:
+                self._requeue(batch[n:])
+                break
+            else:
+                saved.append(visit)
+        return saved
+
+    def _requeue(self, visits: List[VisitEvent]) -> None:
+        logger.exception("Couldn't save %d visit events. Will retry.", len(visits))
+        with self._lock:
+            self._pending = visits + self._pending
+            excess = len(self._pending) - self.max_pending
+            dropped = self._pending[:max(excess, 0)]
+            del self._pending[:len(dropped)]
+        for visit in dropped:
+            logger.error("Dropped a visit event for member #%s at %s.", visit.who_id, visit.when)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Problem flushing visit events.")
+            finally:
+                close_old_connections()
+
+
+_CONFIG = settings.BZWOPS_MEMBERS_CONFIG
+visit_event_queue = VisitEventQueue(
+    _CONFIG.get('VISIT_EVENT_FLUSH_SECONDS', None),
+    max_pending=_CONFIG.get('VISIT_EVENT_MAX_PENDING', 5000),
+)
+
+
+def log_visit_event(**kwargs) -> None:
+    """Queue a new VisitEvent with the given field values. Its "when" defaults to now, not to when it's saved."""
+    visit_event_queue.put(VisitEvent(**kwargs))
@@ -2,12 +2,14 @@
 # Standard
 
 # Third Party
+from django.contrib import admin
 from django.http import HttpResponse
 from django_object_actions import DjangoObjectActions
 from django.db.models import Model
 
 # Local
 from modelmailer.mailviews import MailView
+from modelmailer.models import OutboundEmail
 
 
 class ModelMailerAdmin(DjangoObjectActions):
@@ -26,3 +28,13 @@ class ModelMailerAdmin(DjangoObjectActions):
     email_action.label = "Email"
     email_action.short_description = "View/send email representation of object."
     #change_actions = ('email_action',)
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+
+    list_display = ['pk', 'subject', 'to', 'status', 'created', 'attempts', 'next_attempt', 'sent']
+    list_filter = ['status']
+    search_fields = ['subject', 'to']
+    date_hierarchy = 'created'
+    readonly_fields = ['created', 'sent', 'attempts', 'last_error']
@@ -8,6 +8,7 @@ from django.template.loader import get_template
 from django.db.models import Model
 
 # Local
+import modelmailer.outbox as outbox
 
 _registry = {}
 
@@ -32,26 +33,38 @@ class MailView:
         html = get_template(spec['template'] + '.html').render(params)
         return html
 
-    def send(self, obj: Model):
+    def get_message(self, obj) -> EmailMultiAlternatives:
+        spec = self.get_email_spec(obj)
+        params = spec['parameters']
+        text = get_template(spec['template']+'.txt').render(params)
+        html = get_template(spec['template']+'.html').render(params)
+        msg = EmailMultiAlternatives(
+            spec['subject'],     # Subject
+            text,                # Text content
+            spec['sender'],      # From
+            spec['recipients'],  # To list
+            spec['bccs'],        # BCC list
+        )
+        msg.attach_alternative(html, "text/html")
+        self.logger.info(spec['info-for-log'])
+        return msg
+
+    def send(self, obj: Model) -> bool:
+        """
+        Put the email for obj in the outbox and try to send it right away. Returns True if it was sent.
+        If it's in the outbox but couldn't be sent now, returns False and it'll be retried later.
+        """
+        return self._put_in_outbox(obj, outbox.send)
+
+    def enqueue(self, obj: Model) -> bool:
+        """Put the email for obj in the outbox. It's sent by the next outbox.deliver(). Returns True if it was queued."""
+        return self._put_in_outbox(obj, outbox.enqueue)
+
+    def _put_in_outbox(self, obj: Model, put) -> bool:
         try:
-            spec = self.get_email_spec(obj)
-            params = spec['parameters']
-            text = get_template(spec['template']+'.txt').render(params)
-            html = get_template(spec['template']+'.html').render(params)
-            msg = EmailMultiAlternatives(
-                spec['subject'],     # Subject
-                text,                # Text content
-                spec['sender'],      # From
-                spec['recipients'],  # To list
-                spec['bccs'],        # BCC list
-            )
-            msg.attach_alternative(html, "text/html")
-            msg.send()
-            self.logger.info(spec['info-for-log'])
-            return True
+            return bool(put(self.get_message(obj)))
 
         except Exception as e:
-            # TODO: Save in DB, log error, and try again later?
             self.logger.error("Failed to send email for {} #{} using {} because: {}".format(
                 type(obj), getattr(obj, 'pk', "noPK"), type(self), str(e)
             ))
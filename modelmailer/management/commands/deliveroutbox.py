@@ -0,0 +1,21 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+import modelmailer.outbox as outbox
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Sends the email in the outbox that's due, including retries of earlier failures. Run every few minutes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=outbox.WORKERS)
+
+    def handle(self, *args, **options):
+        count = outbox.deliver(workers=options['workers'])
+        print("Sent {} email(s).".format(count))
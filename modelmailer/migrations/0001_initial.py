@@ -0,0 +1,37 @@
+# Generated by Django 2.2.18 on 2026-10-18 05:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(blank=True, help_text='The subject of the message.', max_length=255)),
+                ('from_email', models.CharField(help_text='The sender of the message.', max_length=255)),
+                ('to', models.TextField(blank=True, help_text='The recipients of the message, one per line.')),
+                ('bcc', models.TextField(blank=True, help_text='The blind copy recipients of the message, one per line.')),
+                ('body', models.TextField(blank=True, help_text='The plain text content of the message.')),
+                ('html', models.TextField(blank=True, help_text='The html content of the message, if any.')),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('S', 'Sent'), ('F', 'Failed')], default='Q', help_text='The delivery status of the message.', max_length=1)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, help_text='Date/time at which the message was queued.')),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='A queued message is sent at or after this date/time.')),
+                ('attempts', models.IntegerField(default=0, help_text='The number of failed attempts to send the message.')),
+                ('last_error', models.TextField(blank=True, help_text='The reason the last attempt failed, if it did.')),
+                ('sent', models.DateTimeField(blank=True, help_text='Date/time at which the message was sent.', null=True)),
+            ],
+            options={
+                'verbose_name': 'outbound email',
+                'ordering': ['next_attempt'],
+            },
+        ),
+    ]
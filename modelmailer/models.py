@@ -1,3 +1,92 @@
+# Standard
+from typing import List
+
+# Third Party
+from django.core.mail import EmailMultiAlternatives
 from django.db import models
+from django.utils import timezone
+
+# Local
+
+__author__ = 'Adrian'
+
+
+def _split_addrs(addrs: str) -> List[str]:
+    return [addr for addr in addrs.split("\n") if addr != ""]
+
+
+class OutboundEmail(models.Model):
+    """An email message waiting in the outbox, or a record of one that has left it."""
+
+    subject = models.CharField(max_length=255, blank=True,
+        help_text="The subject of the message.")
+
+    from_email = models.CharField(max_length=255, blank=False,
+        help_text="The sender of the message.")
+
+    to = models.TextField(blank=True,
+        help_text="The recipients of the message, one per line.")
+
+    bcc = models.TextField(blank=True,
+        help_text="The blind copy recipients of the message, one per line.")
+
+    body = models.TextField(blank=True,
+        help_text="The plain text content of the message.")
+
+    html = models.TextField(blank=True,
+        help_text="The html content of the message, if any.")
+
+    STAT_QUEUED = "Q"  # Waiting to be sent, possibly after a failed attempt.
+    STAT_SENT   = "S"  # Handed off to the email backend.
+    STAT_FAILED = "F"  # Every attempt failed, so we've given up.
+    STATUS_CHOICES = [
+        (STAT_QUEUED, "Queued"),
+        (STAT_SENT,   "Sent"),
+        (STAT_FAILED, "Failed"),
+    ]
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STAT_QUEUED,
+        help_text="The delivery status of the message.")
+
+    created = models.DateTimeField(default=timezone.now,
+        help_text="Date/time at which the message was queued.")
+
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True,
+        help_text="A queued message is sent at or after this date/time.")
+
+    attempts = models.IntegerField(default=0,
+        help_text="The number of failed attempts to send the message.")
+
+    last_error = models.TextField(blank=True,
+        help_text="The reason the last attempt failed, if it did.")
+
+    sent = models.DateTimeField(null=True, blank=True,
+        help_text="Date/time at which the message was sent.")
+
+    @classmethod
+    def from_message(cls, msg: EmailMultiAlternatives) -> 'OutboundEmail':
+        """An unsaved outbox entry for the given message. Only the html alternative is kept."""
+        html = ""
+        for content, mimetype in getattr(msg, 'alternatives', []):
+            if mimetype == "text/html":
+                html = content
+        return cls(
+            subject=msg.subject,
+            from_email=msg.from_email,
+            to="\n".join(msg.to),
+            bcc="\n".join(msg.bcc),
+            body=msg.body,
+            html=html,
+        )
+
+    def to_message(self) -> EmailMultiAlternatives:
+        msg = EmailMultiAlternatives(self.subject, self.body, self.from_email, _split_addrs(self.to), _split_addrs(self.bcc))
+        if self.html != "":
+            msg.attach_alternative(self.html, "text/html")
+        return msg
+
+    def __str__(self) -> str:
+        return "{} to {}".format(self.subject, ", ".join(_split_addrs(self.to)))
 
-# Create your models here.
+    class Meta:
+        ordering = ['next_attempt']
+        verbose_name = "outbound email"
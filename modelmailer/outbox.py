@@ -0,0 +1,134 @@
+# Standard
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Iterable, List, Optional, Tuple
+
+# Third Party
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+# Local
+from modelmailer.models import OutboundEmail
+
+__author__ = 'Adrian'
+
+logger = logging.getLogger("modelmailer")
+
+_CONFIG = getattr(settings, 'BZWOPS_MODELMAILER_CONFIG', {})
+WORKERS = _CONFIG.get('OUTBOX_WORKERS', 4)
+BATCH_SIZE = _CONFIG.get('OUTBOX_BATCH_SIZE', 200)
+MAX_ATTEMPTS = _CONFIG.get('OUTBOX_MAX_ATTEMPTS', 6)
+RETRY_SECONDS = _CONFIG.get('OUTBOX_RETRY_SECONDS', 300)
+
+# A process that takes messages from the outbox has this long to send them before others can take them.
+LEASE = timedelta(minutes=10)
+
+
+def enqueue(msg: EmailMessage) -> OutboundEmail:
+    """Put the message in the outbox. It's sent by the next call to deliver()."""
+    email = OutboundEmail.from_message(msg)
+    email.save()
+    return email
+
+
+def enqueue_many(msgs: Iterable[EmailMessage]) -> List[OutboundEmail]:
+    return OutboundEmail.objects.bulk_create([OutboundEmail.from_message(msg) for msg in msgs])
+
+
+def send(msg: EmailMessage) -> bool:
+    """
+    Put the message in the outbox and try to send it right away. Returns True if it was sent.
+    If it wasn't, it stays in the outbox and later calls to deliver() will retry it.
+    """
+    email = OutboundEmail.from_message(msg)
+    email.next_attempt = timezone.now() + LEASE  # So other processes don't take it while we send it.
+    email.save()
+    return _deliver_batch([email]) == 1
+
+
+def deliver(batch_size: int = BATCH_SIZE, workers: int = WORKERS) -> int:
+    """Send the messages in the outbox that are due, batch by batch. Returns the number sent."""
+    sent_count = 0
+    while True:
+        batch = _lease_due(batch_size)
+        if len(batch) == 0:
+            break
+        sent_count += _deliver_batch(batch, workers)
+        if len(batch) < batch_size:
+            break
+    return sent_count
+
+
+def _lease_due(limit: int) -> List[OutboundEmail]:
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(OutboundEmail.objects.select_for_update(skip_locked=True).filter(
+            status=OutboundEmail.STAT_QUEUED,
+            next_attempt__lte=now,
+        ).order_by('next_attempt', 'pk')[:limit])
+        OutboundEmail.objects.filter(pk__in=[email.pk for email in batch]).update(next_attempt=now+LEASE)
+    return batch
+
+
+def _send_chunk(msgs: List[EmailMessage]) -> List[Optional[str]]:
+    """Send the messages over one backend connection. Returns None for each one sent, else the error."""
+    results = []  # type: List[Optional[str]]
+    connection = get_connection()
+    try:
+        connection.open()
+        for msg in msgs:
+            try:
+                msg.connection = connection
+                msg.send()
+                results.append(None)
+            except Exception as e:
+                results.append(str(e) or type(e).__name__)
+    except Exception as e:
+        # Couldn't connect, so none of the remaining messages were sent.
+        results += [str(e) or type(e).__name__] * (len(msgs) - len(results))
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return results
+
+
+def _deliver_batch(batch: List[OutboundEmail], workers: int = WORKERS) -> int:
+    """
+    Send the batch from a pool of threads, each with its own backend connection, and record the outcomes.
+    The threads don't use the database. Returns the number sent.
+    """
+    chunks = [batch[n::workers] for n in range(max(workers, 1))]
+    chunks = [chunk for chunk in chunks if len(chunk) > 0]
+    outcomes = []  # type: List[Tuple[OutboundEmail, Optional[str]]]
+    with ThreadPoolExecutor(max_workers=max(len(chunks), 1)) as pool:
+        futures = [pool.submit(_send_chunk, [email.to_message() for email in chunk]) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            outcomes += zip(chunk, future.result())
+
+    now = timezone.now()
+    sent_count = 0
+    for email, error in outcomes:
+        if error is None:
+            email.status = OutboundEmail.STAT_SENT
+            email.sent = now
+            email.last_error = ""
+            sent_count += 1
+            continue
+        email.attempts += 1
+        email.last_error = error
+        if email.attempts >= MAX_ATTEMPTS:
+            email.status = OutboundEmail.STAT_FAILED
+            logger.error("Gave up on email '%s' after %d attempts: %s", email, email.attempts, error)
+        else:
+            email.next_attempt = now + timedelta(seconds=RETRY_SECONDS * 2**(email.attempts-1))
+            logger.warning("Failed to send email '%s', will retry: %s", email, error)
+    OutboundEmail.objects.bulk_update(
+        [email for email, _ in outcomes],
+        ['status', 'sent', 'attempts', 'last_error', 'next_attempt']
+    )
+    return sent_count
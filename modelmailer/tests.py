@@ -1,13 +1,20 @@
 # Standard
+import threading
+from datetime import timedelta
 
 # Third Party
-from django.test import TestCase, TransactionTestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.backends.locmem import EmailBackend
+from django.utils import timezone
 
 # Local
 from books.mailviews import PhysicalDonationMailView
 from books.models import Donation
 from modelmailer.mailviews import MailView
+from modelmailer.models import OutboundEmail
+import modelmailer.outbox as outbox
 
 
 class DonationTests(TestCase):
@@ -28,3 +35,76 @@ class DonationTests(TestCase):
         don = Donation.objects.create(donator_name="Frank", donator_email="")
         mv = PhysicalDonationMailView()
         self.assertFalse(mv.send(don))
+
+
+class FlakyBackend(EmailBackend):
+    """Fails to send to addresses that start with "bad", and counts connections."""
+
+    opens = 0
+    lock = threading.Lock()
+
+    def open(self):
+        with FlakyBackend.lock:
+            FlakyBackend.opens += 1
+        return True
+
+    def send_messages(self, messages):
+        for msg in messages:
+            if any(addr.startswith("bad") for addr in msg.to):
+                raise ConnectionError("Recipient refused")
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='modelmailer.tests.FlakyBackend')
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        FlakyBackend.opens = 0
+
+    @staticmethod
+    def message(to: str) -> EmailMultiAlternatives:
+        msg = EmailMultiAlternatives("Hello", "Hi there", "sender@example.com", [to], ["archive@example.com"])
+        msg.attach_alternative("<p>Hi there</p>", "text/html")
+        return msg
+
+    def test_pooled_delivery(self):
+        outbox.enqueue_many([self.message("person%d@example.com" % n) for n in range(10)])
+        self.assertEqual(len(mail.outbox), 0)  # Nothing is sent until delivery.
+        self.assertEqual(outbox.deliver(workers=3), 10)
+        self.assertEqual(FlakyBackend.opens, 3)  # One connection per worker, not per message.
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertEqual(mail.outbox[0].alternatives, [("<p>Hi there</p>", "text/html")])
+        self.assertEqual(mail.outbox[0].bcc, ["archive@example.com"])
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.STAT_SENT).count(), 10)
+        self.assertEqual(outbox.deliver(), 0)  # Sent messages aren't sent again.
+
+    def test_retry_with_backoff(self):
+        outbox.enqueue(self.message("good@example.com"))
+        bad = outbox.enqueue(self.message("bad@example.com"))
+        self.assertEqual(outbox.deliver(), 1)
+        bad.refresh_from_db()
+        self.assertEqual((bad.status, bad.attempts), (OutboundEmail.STAT_QUEUED, 1))
+        self.assertIn("Recipient refused", bad.last_error)
+        self.assertGreater(bad.next_attempt, timezone.now())
+        self.assertEqual(outbox.deliver(), 0)  # The retry isn't due yet.
+
+        for attempt in range(2, outbox.MAX_ATTEMPTS+1):
+            OutboundEmail.objects.filter(pk=bad.pk).update(next_attempt=timezone.now()-timedelta(seconds=1))
+            outbox.deliver()
+            bad.refresh_from_db()
+            self.assertEqual(bad.attempts, attempt)
+        self.assertEqual(bad.status, OutboundEmail.STAT_FAILED)
+
+    def test_send_now(self):
+        self.assertTrue(outbox.send(self.message("good@example.com")))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(outbox.send(self.message("bad@example.com")))
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.STAT_QUEUED).count(), 1)
+
+    def test_mailview_send_now(self):
+        mv = PhysicalDonationMailView()
+        self.assertTrue(mv.send(Donation.objects.create(donator_name="Frank", donator_email="good@example.com")))
+        # Queued for a retry, but not sent.
+        self.assertFalse(mv.send(Donation.objects.create(donator_name="Fred", donator_email="bad@example.com")))
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.STAT_QUEUED).count(), 1)
+        self.assertTrue(mv.enqueue(Donation.objects.create(donator_name="Bob", donator_email="bad@example.com")))
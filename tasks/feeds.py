@@ -0,0 +1,77 @@
+# Standard
+import hashlib
+import time
+import uuid
+from datetime import date
+from typing import Callable, NamedTuple
+
+# Third Party
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from icalendar import Calendar
+
+# Local
+
+__author__ = 'Adrian'
+
+# The name of the cache, in settings.CACHES, that holds the serialized calendar feeds.
+FEED_CACHE_ALIAS = settings.BZWOPS_TASKS_CONFIG.get('FEED_CACHE', 'default')
+
+# Every cached feed is keyed by the current generation, so changing it invalidates all of them at once.
+GENERATION_KEY = "feed-generation"
+
+
+class CachedFeed(NamedTuple):
+    ics: bytes
+    etag: str  # Quoted, as in the ETag header
+    last_modified: float  # Seconds since the epoch
+    as_of: date  # Feeds cover a window relative to today, so they're only valid on this day
+
+
+def _cache():
+    return caches[FEED_CACHE_ALIAS]
+
+
+def _generation() -> str:
+    generation = _cache().get(GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        _cache().set(GENERATION_KEY, generation, None)
+    return generation
+
+
+def invalidate() -> None:
+    """Invalidate every cached feed. Called when tasks or claims change."""
+    def new_generation():
+        _cache().set(GENERATION_KEY, uuid.uuid4().hex, None)
+    new_generation()
+    # Another process might cache a feed built from the old data before the change commits, so do it again afterwards.
+    transaction.on_commit(new_generation)
+
+
+def get_feed(request: HttpRequest, feed_name: str, build: Callable[[], Calendar]) -> CachedFeed:
+    """The named feed from the cache, or built and cached if necessary. Feeds contain absolute urls, so host is part of the key."""
+    key = "feed:{}:{}:{}".format(_generation(), request.get_host(), feed_name)
+    feed = _cache().get(key)  # type: CachedFeed
+    if feed is not None and feed.as_of == date.today():
+        return feed
+    ics = build().to_ical()
+    feed = CachedFeed(ics, quote_etag(hashlib.md5(ics).hexdigest()), time.time(), date.today())
+    _cache().set(key, feed)
+    return feed
+
+
+def feed_response(request: HttpRequest, feed_name: str, build: Callable[[], Calendar]) -> HttpResponse:
+    """Respond with the named feed, or with 304 Not Modified if the client's copy is current."""
+    feed = get_feed(request, feed_name, build)
+    response = get_conditional_response(request, etag=feed.etag, last_modified=int(feed.last_modified))
+    if response is None:
+        response = HttpResponse(feed.ics, content_type='text/calendar')
+        response['Content-Disposition'] = 'attachment; filename="calendar.ics"'
+    response['ETag'] = feed.etag
+    response['Last-Modified'] = http_date(feed.last_modified)
+    return response
@@ -13,6 +13,7 @@ import django.utils.timezone as timezone
 # Local
 from tasks.models import Worker, TimeAccountEntry
 from tasks.views import render_time_acct_statement_as_html
+import modelmailer.outbox as outbox
 
 __author__ = 'adrian'
 
@@ -31,10 +32,10 @@ class Command(BaseCommand):
         bcc_email = XIS_EMAIL
         to = user.email
         text_content = "Please view this message on a device that supports HTML email."
-        html_content = render_time_acct_statement_as_html(user, "recent")
+        html_content = render_time_acct_statement_as_html(user, "recent", regenerate_expirations=False)
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
+        outbox.enqueue(msg)
 
     def handle(self, *args, **options):
         logger = logging.getLogger("tasks")
@@ -56,8 +57,13 @@ class Command(BaseCommand):
                 continue
             users_to_update.add(user)
 
+        # Bring all the expirations up to date in one pass, instead of once per statement:
+        if len(users_to_update) > 0:
+            TimeAccountEntry.regenerate_all_expirations()
+
         # Send a statement to each of the users:
         for user in users_to_update:  # type: User
             logger.info("Sent latest work-trade statement to %s.", user.username)
             Command.send_statement(user)
 
+        outbox.deliver()
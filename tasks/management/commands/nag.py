@@ -10,8 +10,10 @@ from django.db.models import F
 from django.conf import settings
 
 # Local
-from tasks.models import Task, Claim, Nag, Worker, EligibleClaimant2
+from tasks.models import Claim, Nag, EligibleClaimant2
+from tasks.nagplanner import plan_nags
 from members.models import Member
+import modelmailer.outbox as outbox
 
 __author__ = 'adrian'
 
@@ -24,8 +26,6 @@ ONEDAY = datetime.timedelta(days=1)
 TWODAYS = ONEDAY + ONEDAY
 THREEDAYS = TWODAYS + ONEDAY
 FOURDAYS = THREEDAYS + ONEDAY
-ONEWEEK = datetime.timedelta(weeks=1)
-TWOWEEKS = ONEWEEK + ONEWEEK
 
 
 class Command(BaseCommand):
@@ -55,64 +55,21 @@ class Command(BaseCommand):
         html_content = html_content_template.render(d)
         msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
         msg.attach_alternative(html_content, "text/html")
-        msg.send()
+        outbox.enqueue(msg)
 
     @staticmethod
     def nag_for_workers(HOST):
-        today = datetime.date.today()
-
-        # Find out who's doing what over the next 2 weeks. Who's already scheduled to work and who's heavily scheduled?
-        ppl_already_scheduled = Claim.sum_in_period(today, today+TWOWEEKS)
-        ppl_heavily_scheduled = set([member for member, dur in ppl_already_scheduled.items() if dur >= datetime.timedelta(hours=6.0)])
-
-        # Rule out the following sets:
-        ppl_excluded = set()
-        ppl_excluded |= set([worker.member for worker in Worker.objects.filter(should_nag=False)])
-        ppl_excluded |= set(Member.objects.filter(auth_user__email=""))
-        ppl_excluded |= set(Member.objects.filter(auth_user__is_active=False))
-
-        # Cycle through future days' NAGGING tasks to see which need workers and who should be nagged.
-        nag_lists = {}
-        emergency_tasks = []
-        for task in Task.objects.filter(scheduled_date__gte=today, scheduled_date__lt=today+THREEDAYS, should_nag=True):
-
-            # No need to nag if task is fully claimed or not workable.
-            if (not task.is_active()) or task.is_fully_claimed:
-                continue
-
-            # Skip tasks that repeat at intervals and can slide. Nags for these will be
-            # notifications pushed when an eligible worker walks into the facility.
-            rtt = task.recurring_task_template
-            if rtt.repeat_interval is not None and rtt.missed_date_action == rtt.MDA_SLIDE_SELF_AND_LATER:
-                continue
-
-            potentials = task.all_eligible_claimants()
-            potentials -= task.claimant_set(Claim.STAT_CURRENT)
-            potentials -= task.claimant_set(Claim.STAT_UNINTERESTED)
-            # potentials -= task.claimant_set(Claim.STAT_EXPIRED) Their claim expired but they're still a possibility.
-            potentials -= task.claimant_set(Claim.STAT_ABANDONED)
-            potentials -= ppl_excluded
-
-            panic_situation = task.scheduled_date == today and task.priority == Task.PRIO_HIGH
-            if panic_situation:
-                emergency_tasks.append(task)
-            else:
-                # Don't bother heavily scheduled people if it's not time to panic
-                potentials -= ppl_heavily_scheduled
-
-            for member in potentials:
-                if member not in nag_lists:
-                    nag_lists[member] = []
-                nag_lists[member] += [task]
+        # Decide which future days' NAGGING tasks need workers and who should be nagged.
+        plan = plan_nags(datetime.date.today())
 
         # Send staffing emergency message to staff list:
-        if len(emergency_tasks) > 0:
-            Command.send_staffing_emergency_message(emergency_tasks, HOST)
+        if len(plan.emergency_tasks) > 0:
+            Command.send_staffing_emergency_message(plan.emergency_tasks, HOST)
 
         # Send email nag messages to potential workers:
         text_content_template = get_template('tasks/email_nag_template.txt')
         html_content_template = get_template('tasks/email_nag_template.html')
-        for member, tasks in nag_lists.items():
+        for member, tasks in plan.nag_lists.items():
 
             b64, md5 = Member.generate_auth_token_str(
                 lambda token: Nag.objects.filter(auth_token_md5=token).count() == 0  # uniqueness test
@@ -135,7 +92,7 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            outbox.enqueue(msg)
 
     @staticmethod
     def abandon_suspect_claims():
@@ -215,7 +172,7 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            outbox.enqueue(msg)
 
     def handle(self, *args, **options):
 
@@ -225,3 +182,6 @@ class Command(BaseCommand):
         self.abandon_suspect_claims()
         self.verify_default_claims(HOST)
         self.nag_for_workers(HOST)
+
+        # Everything above only queued its email, so send it all now.
+        outbox.deliver()
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.18 on 2026-10-18 05:09
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def compute_running_balances(apps, schema_editor):
+    TimeAccountEntry = apps.get_model('tasks', 'TimeAccountEntry')
+    changed = []
+    worker_id, balance = None, Decimal('0.00')
+    for entry in TimeAccountEntry.objects.order_by('worker_id', 'when', 'pk'):
+        if entry.worker_id != worker_id:
+            worker_id, balance = entry.worker_id, Decimal('0.00')
+        balance += entry.change
+        entry.running_balance = balance
+        changed.append(entry)
+    TimeAccountEntry.objects.bulk_update(changed, ['running_balance'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0016_class_rsvp_period'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timeaccountentry',
+            name='running_balance',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), help_text="The worker's balance just after this change. Maintained automatically.", max_digits=7),
+        ),
+        migrations.RunPython(compute_running_balances, migrations.RunPython.noop),
+    ]
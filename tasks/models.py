@@ -2,13 +2,15 @@
 # Standard
 import logging
 import abc
+import itertools
 from datetime import date, timedelta, datetime, time  # TODO: Replace datetime with django.utils.timezone
 import re
-from typing import Optional, Set
+from typing import Dict, Iterable, List, Optional, Set
 from decimal import Decimal
 
 # Third party
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator, MinValueValidator
 
@@ -19,9 +21,12 @@ from django.utils import timezone
 from members import models as mm
 from inventory.models import Shop  # TODO: Move "Shop" to bzw_ops?
 from abutils.deprecation import deprecated
-from abutils.time import days_of_week_str, matches_weekday_of_month_pattern
+from abutils.signals import objects_saved_in_bulk
+from abutils.time import days_of_week_str, WeekdayOfMonthPatternMixin
 from abutils.validators import positive_duration
 from books.models import SaleLineItem
+from tasks.recurrence import interval_dates
+import tasks.feeds as feeds
 
 
 _DEC0 = Decimal('0.00')
@@ -189,7 +194,7 @@ class TemplateEligibleClaimant2(models.Model):
         return "{} can claim {}".format(self.member.username, self.template.short_desc)
 
 
-class RecurringTaskTemplate(TaskMixin):
+class RecurringTaskTemplate(WeekdayOfMonthPatternMixin, TaskMixin):
     """Uses two mutually exclusive methods to define a schedule for recurring tasks.
     (1) A 'day-of-week vs nth-of-month' matrix for schedules like "every first and third Thursday"
     (2) A 'repeat delay' value for schedules like "every 30 days"
@@ -269,14 +274,12 @@ class RecurringTaskTemplate(TaskMixin):
     def greatest_scheduled_date(self):
         "Of the Tasks that correspond to this template, returns the greatest scheduled_date."
 
-        if len(self.instances.all()) == 0:
+        result = self.instances.aggregate(models.Max('scheduled_date'))['scheduled_date__max']
+        if result is None:
             # Nothing is scheduled yet but nothing can be scheduled before start_date.
             # So, pretend that day before start_date is the greatest scheduled date.
             result = self.start_date + timedelta(days=-1)
-            return result
-
-        scheduled_dates = map(lambda x: x.scheduled_date, self.instances.all())
-        return max(scheduled_dates)
+        return result
 
     def date_matches_template(self, d: date):
 
@@ -292,21 +295,7 @@ class RecurringTaskTemplate(TaskMixin):
         return days_since.days >= self.repeat_interval  # >= instead of == b/c of a bootstrapping scenario.
 
     def date_matches_template_certain_days(self, d: date):
-        month_matches = (d.month == 1 and self.jan) \
-            or (d.month == 2 and self.feb) \
-            or (d.month == 3 and self.mar) \
-            or (d.month == 4 and self.apr) \
-            or (d.month == 5 and self.may) \
-            or (d.month == 6 and self.jun) \
-            or (d.month == 7 and self.jul) \
-            or (d.month == 8 and self.aug) \
-            or (d.month == 9 and self.sep) \
-            or (d.month == 10 and self.oct) \
-            or (d.month == 11 and self.nov) \
-            or (d.month == 12 and self.dec)
-        if not month_matches:
-            return False
-        return matches_weekday_of_month_pattern(self, d)
+        return self.weekday_of_month_pattern.matches(d)
 
     def is_dow_chosen(self):
         return self.monday    \
@@ -355,28 +344,41 @@ class RecurringTaskTemplate(TaskMixin):
         if not self.active:
             return
 
+        logger = logging.getLogger("tasks")
+
         # Earliest possible date to schedule is "day after GSD" or "today", whichever is later.
-        # Note that curr gets inc'ed at start of while, so we need "GSD" and "yesterday" here.
         gsd = self.greatest_scheduled_date()  # TODO: This should work with orig_sched_date, not scheduled_date
-        yesterday = date.today()+timedelta(days=-1)
-        curr = max(gsd, yesterday)
-        stop = date.today() + timedelta(days=max_days_in_advance)
-        logger = logging.getLogger("tasks")
-        while curr < stop:
-            curr += timedelta(days=+1)
-            if self.date_matches_template(curr):
-
-                # If task creation fails, log it and carry on.
-                t = None  # type: Task
-                try:
-                    t = Task.objects.create(
+        first = max(gsd + timedelta(days=+1), date.today())
+        last = date.today() + timedelta(days=max_days_in_advance)
+        dates = self.recurrence_dates(gsd, first, last)
+        if len(dates) == 0:
+            return
+
+        default_claim_duration = None  # type: Optional[timedelta]
+        if self.default_claimant is not None:
+            default_claim_duration = self.work_duration
+            if default_claim_duration is None:
+                if self.max_workers != 1:
+                    logger.error("Couldn't create %s because a default claim with multiple workers needs a work duration.", self.short_desc)
+                    return
+                default_claim_duration = self.max_work
+
+        # Everything that's the same for all the new tasks is loaded once.
+        instructions = Snippet.expand(self.instructions)
+        template_claimants = list(TemplateEligibleClaimant2.objects.filter(template_id=self.id))
+
+        # If task creation fails, log it and carry on.
+        try:
+            with transaction.atomic():
+                tasks = Task.objects.bulk_create([
+                    Task(
                         recurring_task_template =self,
                         creation_date           =date.today(),
-                        scheduled_date          =curr,
-                        orig_sched_date         =curr,
+                        scheduled_date          =d,
+                        orig_sched_date         =d,
                         # Copy mixin fields from template to instance:
                         owner                   =self.owner,
-                        instructions            =Snippet.expand(self.instructions),
+                        instructions            =instructions,
                         short_desc              =self.short_desc,
                         reviewer                =self.reviewer,
                         max_work                =self.max_work,
@@ -387,24 +389,51 @@ class RecurringTaskTemplate(TaskMixin):
                         priority                =self.priority,
                         anybody_is_eligible     =self.anybody_is_eligible
                     )
-
-                    # Many-to-many fields:
-                    for ec in TemplateEligibleClaimant2.objects.filter(template_id=self.id):  # type: TemplateEligibleClaimant2
-                        EligibleClaimant2.objects.create(
-                            task_id=t.id,
-                            member_id=ec.member.id,
-                            type=ec.type
+                    for d in dates
+                ])
+
+                objects_saved_in_bulk.send(sender=Task, objs=tasks)
+
+                # Many-to-many fields:
+                eligibles = EligibleClaimant2.objects.bulk_create([
+                    EligibleClaimant2(task_id=t.id, member_id=ec.member_id, type=ec.type)
+                    for t in tasks for ec in template_claimants
+                ])
+                objects_saved_in_bulk.send(sender=EligibleClaimant2, objs=eligibles)
+
+                # Same as create_default_claim(), but these new tasks can't have claims yet.
+                if self.default_claimant is not None:
+                    claims = Claim.objects.bulk_create([
+                        Claim(
+                            claiming_member=self.default_claimant,
+                            status=Claim.STAT_CURRENT,
+                            claimed_task=t,
+                            claimed_start_time=t.work_start_time,
+                            claimed_duration=default_claim_duration
                         )
+                        for t in tasks
+                    ])
+                    objects_saved_in_bulk.send(sender=Claim, objs=claims)
 
-                    if self.default_claimant is not None:
-                        t.create_default_claim()
+        except Exception as e:
+            logger.error("Couldn't create %s on %s because %s", self.short_desc, ", ".join(map(str, dates)), str(e))
+            return
 
-                    logger.info("Created %s on %s", self.short_desc, curr)
+        # bulk_create doesn't send post_save, which is what usually invalidates the calendar feeds.
+        feeds.invalidate()
+        for d in dates:
+            logger.info("Created %s on %s", self.short_desc, d)
 
-                except Exception as e:
-                    logger.error("Couldn't create %s on %s because %s", self.short_desc, curr, str(e))
-                    if t is not None:
-                        t.delete()
+    def recurrence_dates(self, gsd: date, first: date, last: date) -> List[date]:
+        """
+        The dates from first to last (inclusive) on which instances of this template should be scheduled,
+        given the greatest scheduled date of the existing instances.
+        """
+        if self.repeats_at_intervals():
+            return interval_dates(gsd, self.repeat_interval, first, last)
+        if self.repeats_on_certain_days():
+            return self.weekday_of_month_pattern.matching_dates(first, last)
+        return []
 
     def recurrence_str(self):
         days_of_week = self.repeats_on_certain_days()
@@ -511,14 +540,19 @@ class Claim(models.Model, TimeWindowedObject):
     @staticmethod
     def sum_in_period(startDate, endDate):
         """ Sum up hours claimed per claimant during period startDate to endDate, inclusive. """
-        claimants = {}
-        for task in Task.objects.filter(scheduled_date__gte=startDate).filter(scheduled_date__lte=endDate):  # type: Task
-            for claim in task.claim_set.all():  # type: Claim
-                if claim.status == claim.STAT_CURRENT:
-                    if claim.claiming_member not in claimants:
-                        claimants[claim.claiming_member] = timedelta(0)
-                    claimants[claim.claiming_member] += claim.claimed_duration
-        return claimants
+        sums = Claim.sum_in_period_by_member_id(startDate, endDate)
+        members = mm.Member.objects.in_bulk(list(sums.keys()))
+        return {members[member_id]: dur for member_id, dur in sums.items()}
+
+    @staticmethod
+    def sum_in_period_by_member_id(startDate, endDate) -> Dict[int, timedelta]:
+        """ Same as sum_in_period, but keyed by member id and computed with a single query. """
+        rows = Claim.objects.filter(
+            status=Claim.STAT_CURRENT,
+            claimed_task__scheduled_date__gte=startDate,
+            claimed_task__scheduled_date__lte=endDate,
+        ).values('claiming_member_id').annotate(total=models.Sum('claimed_duration')).order_by()
+        return {row['claiming_member_id']: row['total'] for row in rows}
 
     # Implementation of TimeWindowedObject abstract methods:
     def window_start_time(self):
@@ -624,8 +658,34 @@ class EligibleClaimant2(models.Model):
         help_text="If true, member may receive email concerning the related task.")
 
 
+class TaskQuerySet(models.QuerySet):
+
+    def with_staffing(self) -> 'TaskQuerySet':
+        """
+        Annotate each task with the claim totals that staffing_status() and friends need, so that
+        they don't query claims once per task. The annotations are a snapshot taken when the
+        queryset is evaluated, so don't use them after changing the task's claims.
+        """
+        return self.annotate(
+            staffing_claimed_duration=Coalesce(
+                models.Sum('claim__claimed_duration',
+                    filter=models.Q(claim__status__in=[Claim.STAT_CURRENT, Claim.STAT_WORKING])),
+                models.Value(timedelta(0)),
+                output_field=models.DurationField()
+            ),
+            staffing_unverified_count=models.Count('claim',
+                filter=models.Q(claim__date_verified__isnull=True)),
+            staffing_unverified_current_count=models.Count('claim',
+                filter=models.Q(claim__date_verified__isnull=True, claim__status=Claim.STAT_CURRENT)),
+            staffing_done_count=models.Count('claim',
+                filter=models.Q(claim__status=Claim.STAT_DONE)),
+        )
+
+
 class Task(TaskMixin, TimeWindowedObject):
 
+    objects = TaskQuerySet.as_manager()
+
     creation_date = models.DateField(null=False, default=date.today,
         help_text="The date on which this task was created in the database.")
 
@@ -706,8 +766,14 @@ class Task(TaskMixin, TimeWindowedObject):
         worker = self.likely_worker  # type: Optional[mm.Member]
         return worker.friendly_name if worker is not None else None
 
+    def _has_staffing_annotations(self) -> bool:
+        """True if this task came from a TaskQuerySet.with_staffing() query."""
+        return hasattr(self, 'staffing_claimed_duration')
+
     def unclaimed_hours(self):
         """The grand total of hours still available to ALL WORKERS, considering other member's existing claims, if any."""
+        if self._has_staffing_annotations():
+            return self.max_work - self.staffing_claimed_duration
         unclaimed_hours = self.max_work
         for claim in self.claim_set.all():  # type: Claim
             if claim.status in [claim.STAT_CURRENT, claim.STAT_WORKING]:
@@ -734,6 +800,8 @@ class Task(TaskMixin, TimeWindowedObject):
         return unclaimed_hours == timedelta(0)
 
     def all_claims_verified(self) -> bool:
+        if self._has_staffing_annotations():
+            return self.staffing_unverified_count == 0
         return all(claim.date_verified is not None for claim in self.claim_set.all())
 
     STAFFING_STATUS_STAFFED     = "S"  # There is a verified current claim.
@@ -742,6 +810,14 @@ class Task(TaskMixin, TimeWindowedObject):
     STAFFING_STATUS_DONE        = "D"  # A claim is marked as done.
 
     def staffing_status(self) -> str:
+        if self._has_staffing_annotations():
+            if self.staffing_done_count > 0:
+                return Task.STAFFING_STATUS_DONE
+            if not self.is_fully_claimed:
+                return Task.STAFFING_STATUS_UNSTAFFED
+            if self.staffing_unverified_current_count > 0:
+                return Task.STAFFING_STATUS_PROVISIONAL
+            return Task.STAFFING_STATUS_STAFFED
         currClaims = self.claim_set.filter(status__in=[Claim.STAT_CURRENT, Claim.STAT_DONE])
         for claim in currClaims:  # type: Claim
             if claim.status == Claim.STAT_DONE:
@@ -953,9 +1029,21 @@ class Nag(models.Model):
             self.when.strftime('%b %d'))
 
 
+class WorkerQuerySet(models.QuerySet):
+
+    def with_time_acct_balance(self) -> 'WorkerQuerySet':
+        """Annotate each worker with their current time account balance, so time_acct_balance doesn't query per worker."""
+        latest = TimeAccountEntry.objects.filter(worker=models.OuterRef('pk')).order_by('-when', '-pk')
+        return self.annotate(
+            latest_running_balance=models.Subquery(latest.values('running_balance')[:1])
+        )
+
+
 class Worker(models.Model):
     """ Settings per worker. """
 
+    objects = WorkerQuerySet.as_manager()
+
     member = models.OneToOneField(mm.Member, null=False, unique=True, related_name="worker",
         help_text="This must point to the corresponding member.",
         on_delete=models.CASCADE)
@@ -974,11 +1062,12 @@ class Worker(models.Model):
 
     @property
     def time_acct_balance(self) -> Decimal:
-        entries = TimeAccountEntry.objects.filter(worker=self.member.worker)
-        if len(entries) == 0:
-            return _DEC0
+        if hasattr(self, 'latest_running_balance'):
+            balance = self.latest_running_balance  # From WorkerQuerySet.with_time_acct_balance()
         else:
-            return entries.last().balance
+            balance = TimeAccountEntry.objects.filter(worker=self)\
+                .order_by('when', 'pk').values_list('running_balance', flat=True).last()
+        return balance if balance is not None else _DEC0
 
     def populate_calendar_token(self):
         "Creates a calendar token if none exists, else does nothing."
@@ -1210,6 +1299,10 @@ class TimeAccountEntry(models.Model):
         on_delete=models.CASCADE,  # Delete this entry if the mship backing it up is deleted.
         help_text="For debits, a link to the associated membership, if any.")
 
+    running_balance = models.DecimalField(max_digits=7, decimal_places=2,
+        null=False, blank=False, default=_DEC0,
+        help_text="The worker's balance just after this change. Maintained automatically.")
+
     class Meta:
         ordering = ['when']
         verbose_name_plural = "time account entries"
@@ -1220,13 +1313,7 @@ class TimeAccountEntry(models.Model):
 
     @property
     def balance(self) -> Decimal:
-        log = TimeAccountEntry.objects.filter(
-            worker=self.worker,
-            when__lte=self.when,
-            # expires__gt=self.effective No, we'll add an explicit Entry to reverse it.
-        )
-        balance = log.aggregate(models.Sum('change'))['change__sum']
-        return balance
+        return self.running_balance
 
     def clean(self):
         link_count = sum([self.work is not None, self.mship is not None, self.play is not None])
@@ -1234,58 +1321,156 @@ class TimeAccountEntry(models.Model):
             raise ValidationError("Specify ONE of work/play/mship or NONE of them.")
 
     @classmethod
-    def regenerate_expirations(cls, worker: Worker) -> None:
-        # TODO: This code doesn't yet handle TYPE_ADJUSTMENT
+    def update_running_balances(cls, worker_ids: Optional[Iterable[int]] = None, since: Optional[datetime] = None) -> Dict[int, Decimal]:
+        """
+        Recompute the running balances of the given workers' entries (or everybody's) in a single ordered scan,
+        writing only the ones that changed. If since is given, only entries from then on are recomputed,
+        continuing from the balances before then. Returns the changed balances, keyed by entry pk.
+        The workers are locked for the duration, so concurrent updates for a worker take turns and each
+        scan sees the entries written by the one before it.
+        """
+        with transaction.atomic():
+            workers = Worker.objects.select_for_update()
+            if worker_ids is not None:
+                worker_ids = list(worker_ids)
+                workers = workers.filter(pk__in=worker_ids)
+            list(workers.order_by('pk').values_list('pk', flat=True))  # Locked in order, to avoid deadlocks.
+
+            entries = TimeAccountEntry.objects.all()
+            if worker_ids is not None:
+                entries = entries.filter(worker_id__in=worker_ids)
+            opening = {}  # type: Dict[int, Decimal]
+            if since is not None:
+                # The balance of each worker's latest entry before "since".
+                opening = dict(entries.filter(when__lt=since)
+                    .order_by('worker_id', '-when', '-pk').distinct('worker_id')
+                    .values_list('worker_id', 'running_balance'))
+                entries = entries.filter(when__gte=since)
+
+            changed = []  # type: List[TimeAccountEntry]
+            worker_id, balance = None, _DEC0
+            for entry in entries.order_by('worker_id', 'when', 'pk').only('worker_id', 'change', 'running_balance'):
+                if entry.worker_id != worker_id:
+                    worker_id, balance = entry.worker_id, opening.get(entry.worker_id, _DEC0)
+                balance += entry.change
+                if entry.running_balance != balance:
+                    entry.running_balance = balance
+                    changed.append(entry)
+            if len(changed) > 0:
+                TimeAccountEntry.objects.bulk_update(changed, ['running_balance'], batch_size=1000)
+                objects_saved_in_bulk.send(sender=TimeAccountEntry, objs=changed)
+            return {entry.pk: entry.running_balance for entry in changed}
 
-        # Delete the current expirations since we'll regenerate all of them:
-        TimeAccountEntry.objects.filter(
-            worker=worker,
-            type=TimeAccountEntry.TYPE_EXPIRATION,
-        ).delete()
+    @classmethod
+    def regenerate_expirations(cls, worker: Worker) -> None:
+        """Bring the worker's expiration entries up to date with their deposits and withdrawals."""
+        cls._regenerate_expirations(worker=worker)
 
-        deposits = TimeAccountEntry.objects.filter(
-            worker=worker,
-            type=TimeAccountEntry.TYPE_DEPOSIT
-        ).exclude(change=_DEC0).order_by('when')
+    @classmethod
+    def regenerate_all_expirations(cls) -> None:
+        """Same as regenerate_expirations, but for all workers at once. Meant for nightly jobs."""
+        cls._regenerate_expirations()
 
-        withdrawals = TimeAccountEntry.objects.filter(
-            worker=worker,
-            type=TimeAccountEntry.TYPE_WITHDRAWAL
-        ).exclude(change=_DEC0).order_by('when')
+    @classmethod
+    def _regenerate_expirations(cls, **filters) -> None:
+        # TODO: This code doesn't yet handle TYPE_ADJUSTMENT
 
+        now = timezone.now()
+        entries = TimeAccountEntry.objects.filter(**filters)
+        deposits = list(entries.filter(type=TimeAccountEntry.TYPE_DEPOSIT).exclude(change=_DEC0)
+            .order_by('worker_id', 'when', 'pk'))
+        withdrawals = list(entries.filter(type=TimeAccountEntry.TYPE_WITHDRAWAL).exclude(change=_DEC0)
+            .order_by('worker_id', 'when', 'pk'))
+        existing = {e.pk: e for e in entries.filter(type=TimeAccountEntry.TYPE_EXPIRATION)}
+
+        withdrawals_by_worker = {
+            worker_id: list(group)
+            for worker_id, group in itertools.groupby(withdrawals, key=lambda e: e.worker_id)
+        }
+        expired_amounts = {}  # type: Dict[int, Decimal]
+        for worker_id, worker_deposits in itertools.groupby(deposits, key=lambda e: e.worker_id):
+            expired_amounts.update(cls._expired_amounts(
+                list(worker_deposits), withdrawals_by_worker.get(worker_id, []), now))
+
+        # Only write the expirations that changed.
+        to_create = []  # type: List[TimeAccountEntry]
+        to_update = []  # type: List[TimeAccountEntry]
+        to_link = []  # type: List[TimeAccountEntry]
+        keep = set()  # type: Set[int]
         for deposit in deposits:  # type: TimeAccountEntry
-            deposit_available = deposit.change
-
-            # Look at all the withdrawals and decide which use the deposit available.
-            for withdrawal in withdrawals:  # type: TimeAccountEntry
-                if deposit_available.is_zero():
-                    # The deposit under examination has been fully utilized, so skip the rest of the withdrawals.
-                    break
-                if withdrawal.when > deposit.expires:
-                    # The deposit has expired from the perspective of the withdrawal, so skip it.
-                    # This is what limits rollover.
-                    continue
-                if not hasattr(withdrawal, 'not_covered'):
-                    withdrawal.not_covered = withdrawal.change
-                if withdrawal.not_covered.is_zero():
-                    # The withdrawal is already completely covered by other deposits, so skip it.
-                    continue
-                deposit_amt_to_use = min(deposit_available, -1*withdrawal.not_covered)
-                deposit_available -= deposit_amt_to_use
-                withdrawal.not_covered += deposit_amt_to_use
-
-            if deposit_available > _DEC0 and timezone.now() > deposit.expires:
-                explanation = "{} rolled-over hour(s) expired".format(deposit_available, deposit.when)
-                TimeAccountEntry.objects.create(
+            amount = expired_amounts.get(deposit.pk)
+            if amount is None:
+                continue
+            expiration = existing.get(deposit.expiration_id)  # type: Optional[TimeAccountEntry]
+            explanation = "{} rolled-over hour(s) expired".format(amount)
+            if expiration is None:
+                deposit.expiration = TimeAccountEntry(
                     type=TimeAccountEntry.TYPE_EXPIRATION,
                     work=None,
                     play=None,
                     explanation=explanation,
-                    worker=deposit.worker,
-                    change=-1 * deposit_available,
+                    worker_id=deposit.worker_id,
+                    change=-1 * amount,
                     when=deposit.expires,
                     expires=None  # not applicable.
                 )
+                to_create.append(deposit.expiration)
+                to_link.append(deposit)
+            else:
+                keep.add(expiration.pk)
+                if (expiration.change, expiration.when, expiration.explanation) != (-1 * amount, deposit.expires, explanation):
+                    expiration.change = -1 * amount
+                    expiration.when = deposit.expires
+                    expiration.explanation = explanation
+                    to_update.append(expiration)
+        # This includes expirations that aren't linked to any deposit.
+        to_delete = [pk for pk in existing.keys() if pk not in keep]
+        if len(to_delete) + len(to_create) + len(to_update) == 0:
+            return
+
+        with transaction.atomic():
+            if len(to_delete) > 0:
+                TimeAccountEntry.objects.filter(pk__in=to_delete).delete()
+            if len(to_create) > 0:
+                TimeAccountEntry.objects.bulk_create(to_create)
+                for deposit in to_link:
+                    deposit.expiration = deposit.expiration  # Picks up the pk assigned by bulk_create.
+                TimeAccountEntry.objects.bulk_update(to_link, ['expiration'])
+            if len(to_update) > 0:
+                TimeAccountEntry.objects.bulk_update(to_update, ['change', 'when', 'explanation'])
+            objects_saved_in_bulk.send(sender=TimeAccountEntry, objs=to_create + to_link + to_update)
+            # The bulk writes don't send the signals that usually maintain the running balances.
+            cls.update_running_balances(
+                {e.worker_id for e in to_create + to_update} | {existing[pk].worker_id for pk in to_delete})
+
+    @staticmethod
+    def _expired_amounts(deposits: List['TimeAccountEntry'], withdrawals: List['TimeAccountEntry'], now: datetime) -> Dict[int, Decimal]:
+        """
+        Allocate one worker's withdrawals to their deposits, first in first out, and return the unused
+        amount of each deposit that had expired by now, keyed by deposit pk. Both lists must be in order of when.
+        Each deposit covers the earliest withdrawals that aren't yet covered, up to the deposit's expiration.
+        This limits rollover. Since the covered withdrawals are always the earliest ones, a single pass
+        over the deposits and withdrawals does the allocation.
+        """
+        result = {}  # type: Dict[int, Decimal]
+        w = 0  # Index of the earliest withdrawal that isn't completely covered.
+        not_covered = -1 * withdrawals[0].change if len(withdrawals) > 0 else _DEC0
+        for deposit in deposits:
+            available = deposit.change
+            while available > _DEC0 and w < len(withdrawals):
+                if deposit.expires is not None and withdrawals[w].when > deposit.expires:
+                    # The deposit has expired from the perspective of the remaining withdrawals.
+                    break
+                if not_covered > _DEC0:
+                    used = min(available, not_covered)
+                    available -= used
+                    not_covered -= used
+                if not_covered <= _DEC0:
+                    w += 1
+                    not_covered = -1 * withdrawals[w].change if w < len(withdrawals) else _DEC0
+            if available > _DEC0 and deposit.expires is not None and now > deposit.expires:
+                result[deposit.pk] = available
+        return result
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -0,0 +1,91 @@
+# Standard
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, List, NamedTuple, Set
+
+# Third Party
+from django.db.models import Q
+
+# Local
+from members.models import Member
+from tasks.models import Task, Claim, EligibleClaimant2
+
+__author__ = 'Adrian'
+
+NAG_WINDOW = timedelta(days=3)  # Tasks scheduled this soon are nagged.
+SCHEDULE_WINDOW = timedelta(weeks=2)  # Claims over this period determine who's heavily scheduled.
+HEAVILY_SCHEDULED = timedelta(hours=6.0)
+
+# Members with these claims on a task won't be nagged about it.
+# Note that EXPIRED isn't here. Their claim expired but they're still a possibility.
+CLAIM_STATS_NOT_NAGGED = [Claim.STAT_CURRENT, Claim.STAT_UNINTERESTED, Claim.STAT_ABANDONED]
+
+
+class NagPlan(NamedTuple):
+    nag_lists: Dict[Member, List[Task]]  # The tasks to nag each member about.
+    emergency_tasks: List[Task]  # High priority tasks that need workers today.
+
+
+def _is_sliding(task: Task) -> bool:
+    rtt = task.recurring_task_template
+    return rtt is not None \
+        and rtt.repeat_interval is not None \
+        and rtt.missed_date_action == rtt.MDA_SLIDE_SELF_AND_LATER
+
+
+def plan_nags(today: date) -> NagPlan:
+    """
+    Decide who to nag about which of the upcoming tasks that need workers.
+    Everything is loaded up front in a fixed number of queries and the decisions are made with sets of
+    member ids, so the number of queries doesn't depend on the number of tasks. Only the members that will
+    actually be nagged are loaded.
+    """
+
+    # Who's heavily scheduled over the next 2 weeks?
+    already_scheduled = Claim.sum_in_period_by_member_id(today, today+SCHEDULE_WINDOW)
+    heavily_scheduled = {member_id for member_id, dur in already_scheduled.items() if dur >= HEAVILY_SCHEDULED}
+
+    # Rule out people that don't want nags or can't get them.
+    excluded = set(Member.objects.filter(
+        Q(worker__should_nag=False) | Q(auth_user__email="") | Q(auth_user__is_active=False)
+    ).values_list('id', flat=True))  # type: Set[int]
+
+    # Future days' NAGGING tasks that need workers.
+    tasks = [
+        task for task in Task.objects.filter(
+            scheduled_date__gte=today,
+            scheduled_date__lt=today+NAG_WINDOW,
+            should_nag=True,
+            status=Task.STAT_ACTIVE,
+        ).with_staffing().select_related('recurring_task_template')
+        # Tasks that repeat at intervals and can slide are skipped. Nags for these will be
+        # notifications pushed when an eligible worker walks into the facility.
+        if not task.is_fully_claimed and not _is_sliding(task)
+    ]  # type: List[Task]
+    task_ids = [task.pk for task in tasks]
+
+    eligible = defaultdict(set)  # type: Dict[int, Set[int]]
+    for task_id, member_id in EligibleClaimant2.objects.filter(task_id__in=task_ids).values_list('task_id', 'member_id'):
+        eligible[task_id].add(member_id)
+
+    not_nagged = defaultdict(set)  # type: Dict[int, Set[int]]
+    for task_id, member_id in Claim.objects.filter(claimed_task_id__in=task_ids, status__in=CLAIM_STATS_NOT_NAGGED)\
+            .values_list('claimed_task_id', 'claiming_member_id'):
+        not_nagged[task_id].add(member_id)
+
+    nag_ids = defaultdict(list)  # type: Dict[int, List[Task]]
+    emergency_tasks = []  # type: List[Task]
+    for task in tasks:
+        potentials = eligible[task.pk] - not_nagged[task.pk] - excluded
+        panic_situation = task.scheduled_date == today and task.priority == Task.PRIO_HIGH
+        if panic_situation:
+            emergency_tasks.append(task)
+        else:
+            # Don't bother heavily scheduled people if it's not time to panic
+            potentials -= heavily_scheduled
+        for member_id in potentials:
+            nag_ids[member_id].append(task)
+
+    members = Member.objects.select_related('auth_user').in_bulk(list(nag_ids.keys()))
+    nag_lists = {members[member_id]: member_tasks for member_id, member_tasks in nag_ids.items()}
+    return NagPlan(nag_lists, emergency_tasks)
@@ -0,0 +1,24 @@
+# Standard
+from datetime import date, timedelta
+from typing import List
+
+# Third Party
+
+# Local
+
+__author__ = 'Adrian'
+
+
+def interval_dates(greatest_scheduled_date: date, interval: int, start: date, end: date) -> List[date]:
+    """
+    The dates from start to end (inclusive) on which an "every <interval> days" recurrence falls,
+    given the date of the latest existing instance. The first date is at least interval days after
+    greatest_scheduled_date, but no earlier than start, and the rest follow at the interval.
+    """
+    interval = max(interval, 1)
+    result = []  # type: List[date]
+    d = max(greatest_scheduled_date + timedelta(days=interval), start)
+    while d <= end:
+        result.append(d)
+        d += timedelta(days=interval)
+    return result
@@ -51,7 +51,7 @@ class PlayViewSet(viewsets.ModelViewSet):
 # ---------------------------------------------------------------------------
 
 class TaskViewSet(viewsets.ModelViewSet):
-    queryset = tm.Task.objects.all().order_by('id')
+    queryset = tm.Task.objects.with_staffing().order_by('id')
     serializer_class = ts.TaskSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, tp.TaskPermission]
     authentication_classes = [
@@ -65,7 +65,7 @@ class TaskViewSet(viewsets.ModelViewSet):
 # ---------------------------------------------------------------------------
 
 class WorkerViewSet(viewsets.ModelViewSet):
-    queryset = tm.Worker.objects.all().order_by('id')
+    queryset = tm.Worker.objects.with_time_acct_balance().order_by('id')
     serializer_class = ts.WorkerSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, tp.WorkerPermission]
     # filter_class = filt.WorkerFilter
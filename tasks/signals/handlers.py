@@ -2,9 +2,11 @@
 import logging
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
+from collections import defaultdict
+from typing import Dict, List
 
 # Third Party
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.urls import reverse
 from django.contrib.sites.models import Site
@@ -14,11 +16,13 @@ from django.utils.timezone import localtime
 
 # Local
 from members.models import Member, Tagging, VisitEvent, Membership
+from members.signals import visit_events_saved
 from tasks.models import (
     Task, Worker, Claim, Work, Nag, RecurringTaskTemplate, TimeAccountEntry, Play,
     Class_x_Person, ClassPayment
 )
 import members.notifications as notifications
+import tasks.feeds as feeds
 
 __author__ = 'Adrian'
 
@@ -66,6 +70,19 @@ def staffing_update_notification(sender, **kwargs):
         logger.error("Problem sending staffing update.")
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CALENDAR FEEDS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+@receiver(post_save, sender=Claim)
+@receiver(post_delete, sender=Claim)
+def invalidate_calendar_feeds(sender, **kwargs):
+    unused(sender)
+    feeds.invalidate()
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # VISIT
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -93,43 +110,68 @@ except:
 def notify_manager_re_staff_arrival(sender, **kwargs):
     """Notify the Volunteer Coordinator when a staffer checks in around the time they're scheduled to work a task."""
     unused(sender)
-    try:
-        if kwargs.get('created', True):
-            visit = kwargs.get('instance')  # type: VisitEvent
+    if kwargs.get('created', True):
+        notify_manager_re_staff_arrivals(sender, visits=[kwargs.get('instance')])
 
-            # We're only interested in arrivals
-            if visit.event_type != VisitEvent.EVT_ARRIVAL:
-                return
 
-            try:
-                recipient = Member.objects.get(auth_user__username=USER_VOLUNTEER)
-            except Member.DoesNotExist:
-                return
-
-            if visit.debounced():
-                claims = Claim.objects.filter(
-                    claiming_member=visit.who,
-                    claimed_task__priority=Task.PRIO_HIGH,
-                    claimed_task__scheduled_date=datetime.now().date(),
-                    status=Claim.STAT_CURRENT,
-                    # TODO: Is a window around the claimed start time necessary?
-                )
+@receiver(visit_events_saved)
+def notify_manager_re_staff_arrivals(sender, **kwargs):
+    """Same as notify_manager_re_staff_arrival, but for a batch of visits saved by the visit event queue."""
+    unused(sender)
+    try:
+        # We're only interested in arrivals
+        visits = [v for v in kwargs.get('visits') if v.event_type == VisitEvent.EVT_ARRIVAL]  # type: List[VisitEvent]
+        if len(visits) == 0:
+            return
 
-                if len(claims) == 0:
-                    return
+        try:
+            recipient = Member.objects.get(auth_user__username=USER_VOLUNTEER)
+        except Member.DoesNotExist:
+            return
 
-                task = claims[0].claimed_task  # type: Task
-                title = "{} Arrived".format(visit.who.friendly_name)
-                message = "Scheduled to work {} at {}".format(
-                    task.short_desc,
-                    task.window_start_time()
+        # Same as VisitEvent.debounced() but with one query for the whole batch.
+        who_ids = set(v.who_id for v in visits)
+        earlier_arrivals = defaultdict(list)  # type: Dict[int, List[datetime]]
+        for who_id, when in VisitEvent.objects.filter(
+          who_id__in=who_ids,
+          event_type=VisitEvent.EVT_ARRIVAL,
+          when__gte=min(v.when for v in visits) - timedelta(hours=1),
+          when__lt=max(v.when for v in visits)).values_list('who_id', 'when'):
+            earlier_arrivals[who_id].append(when)
+        debounced = [
+            v for v in visits
+            if not any(v.when - timedelta(hours=1) <= when < v.when for when in earlier_arrivals[v.who_id])
+        ]
+        if len(debounced) == 0:
+            return
 
-                )
-                notifications.notify(recipient, title, message)
+        claims = Claim.objects.filter(
+            claiming_member_id__in=set(v.who_id for v in debounced),
+            claimed_task__priority=Task.PRIO_HIGH,
+            claimed_task__scheduled_date=datetime.now().date(),
+            status=Claim.STAT_CURRENT,
+            # TODO: Is a window around the claimed start time necessary?
+        ).select_related('claimed_task')
+        task_by_who = {}  # type: Dict[int, Task]
+        for claim in claims:
+            task_by_who.setdefault(claim.claiming_member_id, claim.claimed_task)
+
+        notified = set()
+        for visit in debounced:
+            task = task_by_who.get(visit.who_id)  # type: Task
+            if task is None or visit.who_id in notified:
+                continue
+            notified.add(visit.who_id)
+            title = "{} Arrived".format(visit.who.friendly_name)
+            message = "Scheduled to work {} at {}".format(
+                task.short_desc,
+                task.window_start_time()
+            )
+            notifications.notify(recipient, title, message)
 
     except Exception as e:
         # Makes sure that problems here do not prevent the visit event from being saved!
-        logger.error("Problem in notify_manager_re_staff_arrival: %s", str(e))
+        logger.error("Problem in notify_manager_re_staff_arrivals: %s", str(e))
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -291,6 +333,42 @@ def debit_time_acct_for_play(sender, **kwargs):
         logger.error("Problem in debit_time_acct_for_play: %s", str(e))
 
 
+@receiver(pre_save, sender=TimeAccountEntry)
+def note_time_acct_entry_position(sender, **kwargs):
+    """Remember where an existing entry was, since moving it changes balances from there on."""
+    unused(sender)
+    entry = kwargs.get('instance')  # type: TimeAccountEntry
+    entry._old_position = None
+    if entry.pk is not None and not kwargs.get('raw', False):
+        entry._old_position = TimeAccountEntry.objects.filter(pk=entry.pk).values_list('worker_id', 'when').first()
+
+
+@receiver(post_save, sender=TimeAccountEntry)
+def update_time_acct_balances_after_save(sender, **kwargs):
+    """Keep the running balances of the entry's worker up to date, from the entry onward."""
+    unused(sender)
+    if kwargs.get('raw', False):
+        return
+    entry = kwargs.get('instance')  # type: TimeAccountEntry
+    since = entry.when
+    old_position = getattr(entry, '_old_position', None)
+    if old_position is not None:
+        old_worker_id, old_when = old_position
+        if old_worker_id != entry.worker_id:
+            TimeAccountEntry.update_running_balances([old_worker_id], old_when)
+        else:
+            since = min(since, old_when)
+    changed = TimeAccountEntry.update_running_balances([entry.worker_id], since)
+    entry.running_balance = changed.get(entry.pk, entry.running_balance)
+
+
+@receiver(post_delete, sender=TimeAccountEntry)
+def update_time_acct_balances_after_delete(sender, **kwargs):
+    unused(sender)
+    entry = kwargs.get('instance')  # type: TimeAccountEntry
+    TimeAccountEntry.update_running_balances([entry.worker_id], entry.when)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # CLASSES
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -1,7 +1,9 @@
 # Standard
 from datetime import datetime, date, timedelta, time
+from decimal import Decimal
 from pydoc import locate  # for loading classes
 import os
+import random
 
 # Third Party
 from django.core import management, mail
@@ -12,6 +14,7 @@ from django.contrib.admin import site
 from django.core.management import call_command
 from django.utils import timezone
 from django.conf import settings
+from django.db import DatabaseError
 from freezegun import freeze_time
 from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException
@@ -27,10 +30,14 @@ from tasks.models import (
     Work, WorkNote,
     Nag,
     Snippet,
-    Worker
+    Worker, TimeAccountEntry
 
 )
 from members.models import Member, VisitEvent
+from tasks.recurrence import interval_dates
+from tasks.views import render_time_acct_statement_as_html
+from tasks.nagplanner import plan_nags
+from members.visitqueue import VisitEventQueue
 import tasks.restapi as restapi
 from members.notifications import notify
 
@@ -366,6 +373,118 @@ class TestRecurringTaskTemplateIntervals(TransactionTestCase):
         self.assertEqual(len(Task.objects.all()), 13)
 
 
+class TestRecurrenceEngine(TestCase):
+
+    @staticmethod
+    def day_by_day_match(rt: RecurringTaskTemplate, d: date) -> bool:
+        """The pattern check as it was originally coded, for comparison."""
+        months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+        days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+        if not getattr(rt, months[d.month-1]) or not getattr(rt, days[d.weekday()]):
+            return False
+        if rt.every:
+            return True
+        if rt.last and (d + timedelta(weeks=1)).month != d.month:
+            return True
+        ord_num = 1
+        dom_num = d.day
+        while dom_num > 7:
+            dom_num -= 7
+            ord_num += 1
+        return getattr(rt, {1: 'first', 2: 'second', 3: 'third', 4: 'fourth'}.get(ord_num, 'every'))
+
+    def test_compiled_pattern(self):
+        start, end = date(2018, 1, 1), date(2019, 12, 31)
+        days = [start + timedelta(days=n) for n in range((end-start).days+1)]
+        rand = random.Random(0)
+        for _ in range(50):
+            rt = RecurringTaskTemplate(short_desc="Pattern", max_work=timedelta(hours=1), start_date=start)
+            for name in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                         'first', 'second', 'third', 'fourth', 'last', 'every', 'jan', 'feb', 'jul', 'dec']:
+                setattr(rt, name, rand.random() < 0.4)
+            expected = [d for d in days if self.day_by_day_match(rt, d)]
+            pattern = rt.weekday_of_month_pattern
+            self.assertEqual([d for d in days if pattern.matches(d)], expected)
+            self.assertEqual(pattern.matching_dates(start, end), expected)
+            self.assertEqual(pattern.next_occurrence(start), ([d for d in expected if d > start] + [None])[0])
+
+    def test_compiled_pattern_cache(self):
+        rt = RecurringTaskTemplate.objects.create(short_desc="Cached", max_work=timedelta(hours=1),
+            start_date=date.today(), monday=True, every=True)
+        self.assertIs(rt.weekday_of_month_pattern, rt.weekday_of_month_pattern)
+        self.assertEqual(rt.weekday_of_month_pattern.next_occurrence(date(2018, 7, 3)), date(2018, 7, 9))
+        rt.monday, rt.tuesday = False, True
+        rt.save()  # Saving drops the compiled pattern.
+        self.assertEqual(rt.weekday_of_month_pattern.next_occurrence(date(2018, 7, 3)), date(2018, 7, 10))
+
+    def test_interval_dates(self):
+        gsd = date(2018, 1, 10)
+        self.assertEqual(
+            interval_dates(gsd, 7, date(2018, 1, 11), date(2018, 2, 1)),
+            [date(2018, 1, 17), date(2018, 1, 24), date(2018, 1, 31)]
+        )
+        # A template that hasn't been scheduled in a while starts again from "start".
+        self.assertEqual(interval_dates(gsd, 7, date(2018, 3, 1), date(2018, 3, 9)), [date(2018, 3, 1), date(2018, 3, 8)])
+
+    def test_create_tasks_queries(self):
+        rt = RecurringTaskTemplate.objects.create(
+            short_desc="Bulk", max_work=timedelta(hours=1), start_date=date.today(),
+            work_start_time=time(18, 0), work_duration=timedelta(hours=1),
+            every=True, monday=True, wednesday=True, friday=True,
+        )
+        member = User.objects.create_user(username='claimant', password='123').member
+        rt.default_claimant = member
+        rt.save()
+        TemplateEligibleClaimant2.objects.create(template=rt, member=member, type=TemplateEligibleClaimant2.TYPE_DEFAULT_CLAIMANT)
+        rt = RecurringTaskTemplate.objects.select_related('default_claimant', 'owner', 'reviewer').get(pk=rt.pk)
+
+        # The number of queries doesn't depend on the number of tasks created.
+        # Three of them record the new tasks, eligible claimants, and claims for dbcheck.
+        with self.assertNumQueries(10):
+            rt.create_tasks(max_days_in_advance=60)
+        count = Task.objects.filter(recurring_task_template=rt).count()
+        self.assertGreater(count, 20)
+        self.assertEqual(EligibleClaimant2.objects.filter(task__recurring_task_template=rt).count(), count)
+        self.assertEqual(Claim.objects.filter(claimed_task__recurring_task_template=rt, claiming_member=member).count(), count)
+
+
+class TestStaffingAnnotations(TestCase):
+
+    def test_annotations_agree_with_claims(self):
+        members = [User.objects.create_user(username='worker%d' % n, password='123').member for n in range(2)]
+        configs = [
+            [],
+            [(Claim.STAT_CURRENT, 2, None)],
+            [(Claim.STAT_CURRENT, 2, date.today())],
+            [(Claim.STAT_CURRENT, 1, date.today()), (Claim.STAT_WORKING, 1, None)],
+            [(Claim.STAT_CURRENT, 1, date.today())],
+            [(Claim.STAT_DONE, 2, date.today())],
+            [(Claim.STAT_ABANDONED, 2, date.today()), (Claim.STAT_CURRENT, 2, None)],
+        ]
+        for n, config in enumerate(configs):
+            task = Task.objects.create(short_desc="Staffing %d" % n, max_work=timedelta(hours=2), max_workers=2,
+                scheduled_date=date.today(), work_start_time=time(18, 0), work_duration=timedelta(hours=2))
+            for member, (status, hours, verified) in zip(members, config):
+                Claim.objects.create(claimed_task=task, claiming_member=member, status=status,
+                    claimed_start_time=time(18, 0), claimed_duration=timedelta(hours=hours), date_verified=verified)
+
+        with self.assertNumQueries(1):
+            annotated = list(Task.objects.with_staffing().order_by('id'))
+        self.assertEqual(len(annotated), len(configs))
+        for task in annotated:
+            plain = Task.objects.get(pk=task.pk)
+            self.assertEqual(task.unclaimed_hours(), plain.unclaimed_hours())
+            self.assertEqual(task.is_fully_claimed, plain.is_fully_claimed)
+            self.assertEqual(task.all_claims_verified(), plain.all_claims_verified())
+            self.assertEqual(task.staffing_status(), plain.staffing_status())
+        self.assertEqual(
+            [t.staffing_status() for t in annotated],
+            [Task.STAFFING_STATUS_UNSTAFFED, Task.STAFFING_STATUS_PROVISIONAL, Task.STAFFING_STATUS_STAFFED,
+             Task.STAFFING_STATUS_STAFFED, Task.STAFFING_STATUS_UNSTAFFED, Task.STAFFING_STATUS_DONE,
+             Task.STAFFING_STATUS_PROVISIONAL]
+        )
+
+
 class TestPriorityMatch(TestCase):
 
     def testPrioMatch(self):
@@ -576,6 +695,35 @@ class TestViews(TestCase):
         self.assertContains(response, "TCV")
 
 
+    def test_calendar_feed_caching(self):
+        client = Client()
+        url = reverse('task:ops-calendar')
+        response = client.get(url)
+        etag = response['ETag']
+        self.assertContains(response, "Test Task")
+
+        # Polling with the ETag gets a 304 without any database queries.
+        with self.assertNumQueries(0):
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Changing a task invalidates the feed.
+        self.task.short_desc = "Changed Task"
+        self.task.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, "Changed Task")
+
+        # Member feeds are cached separately.
+        url = reverse('task:member-calendar', kwargs={'token': self.arbitrary_token_b64})
+        etag = client.get(url)['ETag']
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.claim.status = Claim.STAT_ABANDONED
+        self.claim.save()
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 class TestOpsCalendarSpa(TestCase):
@@ -618,6 +766,38 @@ class RunSchedAndNagCmds(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(len(Nag.objects.all()), 1)
 
+    def test_nag_plan(self):
+        def make_member(name, should_nag=True):
+            member = User.objects.create_user(username=name, password='123', email=name+'@example.com').member
+            member.worker.should_nag = should_nag
+            member.worker.save()
+            return member
+        eager, uninterested, busy, quiet = [make_member(n) for n in ['eager', 'uninterested', 'busy']] + [make_member('quiet', False)]
+
+        tasks = []
+        for n in range(6):
+            task = Task.objects.create(short_desc="Plan %d" % n, max_work=ONEHOUR, max_workers=1, should_nag=True,
+                scheduled_date=date.today()+timedelta(days=n % 3), work_start_time=time(18, 0), work_duration=ONEHOUR,
+                priority=Task.PRIO_HIGH if n == 0 else Task.PRIO_MED)
+            for member in [eager, uninterested, busy, quiet]:
+                EligibleClaimant2.objects.create(task=task, member=member, type=EligibleClaimant2.TYPE_ELIGIBLE_2ND)
+            Claim.objects.create(claimed_task=task, claiming_member=uninterested, status=Claim.STAT_UNINTERESTED,
+                claimed_start_time=time(18, 0), claimed_duration=ONEHOUR)
+            tasks.append(task)
+        # Busy has a lot of hours claimed elsewhere.
+        busy_task = Task.objects.create(short_desc="Busy", max_work=timedelta(hours=8), should_nag=False,
+            scheduled_date=date.today()+timedelta(days=5), work_start_time=time(8, 0), work_duration=timedelta(hours=8))
+        Claim.objects.create(claimed_task=busy_task, claiming_member=busy, status=Claim.STAT_CURRENT,
+            claimed_start_time=time(8, 0), claimed_duration=timedelta(hours=8))
+
+        with self.assertNumQueries(6):
+            plan = plan_nags(date.today())
+            self.assertEqual(set(plan.nag_lists.keys()), {eager, busy})
+            self.assertEqual({m.email for m in plan.nag_lists}, {'eager@example.com', 'busy@example.com'})
+        self.assertEqual(set(plan.nag_lists[eager]), set(tasks))
+        self.assertEqual(plan.nag_lists[busy], [tasks[0]])  # Only the panic situation.
+        self.assertEqual(plan.emergency_tasks, [tasks[0]])
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -671,6 +851,148 @@ class RunEmailWMTD(TestCase):
         self.assertEqual(len(mail.outbox), 1)
 
 
+class TestTimeAccountExpirations(TestCase):
+
+    @staticmethod
+    def nested_loop_expired_amounts(deposits, withdrawals, now):
+        """The allocation as it was originally coded, for comparison."""
+        not_covered = {w.pk: w.change for w in withdrawals}
+        result = {}
+        for deposit in deposits:
+            deposit_available = deposit.change
+            for withdrawal in withdrawals:
+                if deposit_available.is_zero():
+                    break
+                if withdrawal.when > deposit.expires:
+                    continue
+                if not_covered[withdrawal.pk].is_zero():
+                    continue
+                deposit_amt_to_use = min(deposit_available, -1*not_covered[withdrawal.pk])
+                deposit_available -= deposit_amt_to_use
+                not_covered[withdrawal.pk] += deposit_amt_to_use
+            if deposit_available > Decimal("0.00") and now > deposit.expires:
+                result[deposit.pk] = deposit_available
+        return result
+
+    def test_allocation_matches_nested_loop(self):
+        rand = random.Random(0)
+        now = timezone.now()
+        for _ in range(200):
+            entries = []
+            for pk in range(rand.randint(0, 30)):
+                when = now - timedelta(days=rand.randint(0, 300))
+                if rand.random() < 0.5:
+                    entry = TimeAccountEntry(pk=pk, type=TimeAccountEntry.TYPE_DEPOSIT, when=when,
+                        expires=when+timedelta(days=90), change=Decimal(rand.randint(1, 16))/4)
+                else:
+                    entry = TimeAccountEntry(pk=pk, type=TimeAccountEntry.TYPE_WITHDRAWAL, when=when,
+                        change=-Decimal(rand.randint(1, 16))/4)
+                entries.append(entry)
+            entries.sort(key=lambda e: e.when)
+            deposits = [e for e in entries if e.type == TimeAccountEntry.TYPE_DEPOSIT]
+            withdrawals = [e for e in entries if e.type == TimeAccountEntry.TYPE_WITHDRAWAL]
+            self.assertEqual(
+                TimeAccountEntry._expired_amounts(deposits, withdrawals, now),
+                self.nested_loop_expired_amounts(deposits, withdrawals, now)
+            )
+
+    def test_only_changes_are_written(self):
+        worker = User.objects.create_user(username='trader', password='123').member.worker
+        other = User.objects.create_user(username='other', password='123').member.worker
+        long_ago = timezone.now() - timedelta(days=200)
+        for w in [worker, other]:
+            TimeAccountEntry.objects.create(type=TimeAccountEntry.TYPE_DEPOSIT, explanation="Work", worker=w,
+                change=Decimal("3.00"), when=long_ago, expires=long_ago+timedelta(days=90))
+        withdrawal = TimeAccountEntry.objects.create(type=TimeAccountEntry.TYPE_WITHDRAWAL, explanation="Play",
+            worker=worker, change=Decimal("-1.00"), when=long_ago+timedelta(days=1))
+        expirations = TimeAccountEntry.objects.filter(type=TimeAccountEntry.TYPE_EXPIRATION)
+
+        TimeAccountEntry.regenerate_expirations(worker)
+        self.assertEqual([e.change for e in expirations.filter(worker=worker)], [Decimal("-2.00")])
+        self.assertEqual(expirations.filter(worker=other).count(), 0)
+
+        # Nothing changed, so nothing is written.
+        with self.assertNumQueries(3):
+            TimeAccountEntry.regenerate_expirations(worker)
+
+        withdrawal.change = Decimal("-1.50")
+        withdrawal.save()
+        TimeAccountEntry.regenerate_all_expirations()
+        self.assertEqual([e.change for e in expirations.filter(worker=worker)], [Decimal("-1.50")])
+        self.assertEqual([e.change for e in expirations.filter(worker=other)], [Decimal("-3.00")])
+        self.assertEqual(expirations.count(), 2)
+
+        withdrawal.change = Decimal("-3.00")
+        withdrawal.save()
+        TimeAccountEntry.regenerate_all_expirations()
+        self.assertEqual(expirations.filter(worker=worker).count(), 0)
+
+
+class TestTimeAccountBalances(TestCase):
+
+    def setUp(self):
+        self.worker = User.objects.create_user(username='trader', password='123').member.worker
+        self.other = User.objects.create_user(username='other', password='123').member.worker
+        self.start = timezone.now() - timedelta(days=30)
+
+    def entry(self, worker, days, change):
+        return TimeAccountEntry.objects.create(type=TimeAccountEntry.TYPE_ADJUSTMENT, explanation="Adjustment",
+            worker=worker, change=Decimal(change), when=self.start+timedelta(days=days))
+
+    def assertBalancesConsistent(self):
+        for worker in [self.worker, self.other]:
+            balance = Decimal("0.00")
+            for entry in TimeAccountEntry.objects.filter(worker=worker).order_by('when', 'pk'):
+                balance += entry.change
+                self.assertEqual(entry.running_balance, balance)
+            self.assertEqual(worker.time_acct_balance, balance)
+            annotated = Worker.objects.with_time_acct_balance().get(pk=worker.pk)
+            self.assertEqual(annotated.time_acct_balance, balance)
+
+    def test_running_balances_are_maintained(self):
+        self.assertEqual(self.worker.time_acct_balance, Decimal("0.00"))
+        self.entry(self.worker, 10, "3.00")
+        early = self.entry(self.worker, 5, "-1.00")  # Inserted before an existing entry.
+        self.assertEqual(early.balance, Decimal("-1.00"))
+        late = self.entry(self.worker, 20, "2.50")
+        self.entry(self.other, 1, "4.00")
+        self.assertBalancesConsistent()
+
+        late.when = self.start  # Moved to the front.
+        late.save()
+        self.assertEqual(late.balance, Decimal("2.50"))
+        self.assertBalancesConsistent()
+
+        early.worker = self.other  # Moved to another worker.
+        early.save()
+        self.assertBalancesConsistent()
+
+        early.delete()
+        self.assertBalancesConsistent()
+
+        TimeAccountEntry.objects.filter(worker=self.worker).update(running_balance=Decimal("0.00"))
+        TimeAccountEntry.update_running_balances()
+        self.assertBalancesConsistent()
+
+    def test_expirations_update_balances(self):
+        long_ago = timezone.now() - timedelta(days=200)
+        TimeAccountEntry.objects.create(type=TimeAccountEntry.TYPE_DEPOSIT, explanation="Work", worker=self.worker,
+            change=Decimal("3.00"), when=long_ago, expires=long_ago+timedelta(days=90))
+        self.entry(self.worker, 0, "-1.00")
+        TimeAccountEntry.regenerate_all_expirations()
+        self.assertBalancesConsistent()
+        self.assertEqual(self.worker.time_acct_balance, Decimal("-1.00"))
+
+    def test_statement(self):
+        self.entry(self.worker, -200, "5.00")  # Before the statement period.
+        self.entry(self.worker, 1, "-2.00")
+        self.entry(self.worker, 2, "1.25")
+        html = render_time_acct_statement_as_html(self.worker.member.auth_user, "recent", regenerate_expirations=False)
+        self.assertIn("5.00", html)  # Balance forward
+        self.assertIn("3.00", html)
+        self.assertIn("4.25", html)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 today = date.today()
@@ -965,7 +1287,7 @@ class TestNotifications(TestCase):
         self.assertEqual(notify.MOST_RECENT_TITLE, title)
         self.assertEqual(notify.MOST_RECENT_MESSSAGE, message)
 
-    def test_arrival_of_scheduled_worker(self):
+    def schedule_worker(self):
         VisitEvent.objects.all().delete()
         tz = timezone.get_current_timezone()
         start_dt = datetime.now() + timedelta(minutes=15)  # type: datetime
@@ -988,6 +1310,9 @@ class TestNotifications(TestCase):
             status=Claim.STAT_CURRENT,
         )
         claim.clean()
+
+    def test_arrival_of_scheduled_worker(self):
+        self.schedule_worker()
         VisitEvent.objects.create(
             who=self.worker_member,
             event_type=VisitEvent.EVT_ARRIVAL
@@ -996,6 +1321,58 @@ class TestNotifications(TestCase):
         self.assertTrue("Arrived" in notify.MOST_RECENT_TITLE)
         self.assertTrue("Scheduled" in notify.MOST_RECENT_MESSSAGE)
 
+    def test_batched_arrival_of_scheduled_worker(self):
+        self.schedule_worker()
+        queue = VisitEventQueue(flush_seconds=None)
+        now = timezone.now()
+        queue._pending = [
+            VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_ARRIVAL, when=now),
+            VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_PRESENT, when=now),
+            VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_ARRIVAL, when=now+timedelta(minutes=5)),
+        ]
+        self.assertEqual(notify.MOST_RECENT_MEMBER, None)
+        saved = queue.flush()
+        self.assertEqual(len(saved), 3)
+        self.assertEqual(VisitEvent.objects.filter(who=self.worker_member).count(), 3)
+        self.assertEqual(notify.MOST_RECENT_MEMBER, self.manager_member)
+        self.assertTrue("Arrived" in notify.MOST_RECENT_TITLE)
+        self.assertTrue("Scheduled" in notify.MOST_RECENT_MESSSAGE)
+
+    def test_batch_with_deleted_member(self):
+        self.schedule_worker()
+        queue = VisitEventQueue(flush_seconds=None)
+        gone = Member(id=self.worker_member.pk + 1000)  # E.g. deleted while the visit was queued.
+        queue._pending = [
+            VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_ARRIVAL),
+            VisitEvent(who=gone, event_type=VisitEvent.EVT_ARRIVAL),
+            VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_PRESENT),
+        ]
+        saved = queue.flush()
+        self.assertEqual([v.event_type for v in saved], [VisitEvent.EVT_ARRIVAL, VisitEvent.EVT_PRESENT])
+        self.assertEqual(VisitEvent.objects.filter(who=self.worker_member).count(), 2)
+        self.assertEqual(queue._pending, [])
+        self.assertEqual(notify.MOST_RECENT_MEMBER, self.manager_member)
+
+    def test_backlog_is_capped(self):
+        queue = VisitEventQueue(flush_seconds=None, max_pending=2)
+        now = timezone.now()
+        old = [
+            VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_PRESENT, when=now-timedelta(minutes=n))
+            for n in [3, 2, 1]
+        ]
+        try:
+            raise DatabaseError("Unavailable")
+        except DatabaseError:
+            with self.assertLogs("members", level="ERROR") as logs:
+                queue._requeue(old)
+        self.assertEqual(queue._pending, old[1:])
+        self.assertIn("Dropped a visit event for member #{}".format(self.worker_member.pk), logs.output[-1])
+
+        # With the backlog at its cap, a new visit is saved right away and the backlog is left alone.
+        queue.put(VisitEvent(who=self.worker_member, event_type=VisitEvent.EVT_ARRIVAL))
+        self.assertEqual(queue._pending, old[1:])
+        self.assertEqual(VisitEvent.objects.filter(who=self.worker_member).count(), 1)
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # Miscellaneous
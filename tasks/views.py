@@ -17,12 +17,14 @@ from django.template.loader import render_to_string
 from django.urls import reverse
 from django.views.decorators.csrf import ensure_csrf_cookie
 import django.utils.timezone as timezone
+from django.db.models import Prefetch
 from icalendar import Calendar, Event
 
 # Local
 from tasks.models import Task, Nag, Claim, Work, WorkNote, Worker
 from members.models import Member
 from tasks.models import TimeAccountEntry
+import tasks.feeds as feeds
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -137,7 +139,7 @@ def offer_more_tasks(request, task_pk, auth_token):
             recurring_task_template=task.recurring_task_template,
             scheduled_date__gt=task.scheduled_date,
             status=Task.STAT_ACTIVE
-        )
+        ).with_staffing()
         future_instances_same_dow = []
         for instance in all_future_instances:
             if instance.scheduled_weekday() == task.scheduled_weekday() \
@@ -469,7 +471,9 @@ def _add_event(cal, task: Task, request):
     # be email addresses and we don't want to expose personal information about the workers.
     # So we'll build a worker string and make it part of the event description.
     worker_str = ""
-    for claim in task.claim_set.filter(status__in=[Claim.STAT_CURRENT, Claim.STAT_WORKING],):  # type: Claim
+    for claim in task.claim_set.all():  # type: Claim
+        if claim.status not in [Claim.STAT_CURRENT, Claim.STAT_WORKING]:
+            continue
         worker_str += ", " if worker_str else ""
         worker_str += claim.claiming_member.friendly_name
     if not worker_str:
@@ -498,20 +502,30 @@ def _ical_response(cal):
     return response
 
 
+# _add_event needs each claim's member's name, which comes from auth.User.
+_CLAIMS_WITH_MEMBERS = Prefetch("claim_set", queryset=Claim.objects.select_related("claiming_member__auth_user"))
+
+
 def _gen_tasks_for(member):
     """For the given member, generate all future tasks and past tasks in last 60 days"""
-    for task in member.tasks_claimed.filter(scheduled_date__gte=datetime.now()-timedelta(days=60)):  # type: Task
+    qset = member.tasks_claimed\
+        .filter(scheduled_date__gte=datetime.now()-timedelta(days=60))\
+        .prefetch_related(_CLAIMS_WITH_MEMBERS)
+
+    for task in qset:  # type: Task
         if task.scheduled_date is None or task.work_start_time is None or task.work_duration is None:
             continue
         yield task
 
 
-def _gen_all_tasks() -> Generator[Task, None, None]:
+def _gen_all_tasks(with_staffing: bool = False) -> Generator[Task, None, None]:
     """Generate all future tasks and past tasks in last 60 days"""
 
     qset = Task.objects\
         .filter(scheduled_date__gte=datetime.now()-timedelta(days=60))\
-        .prefetch_related("claim_set")
+        .prefetch_related(_CLAIMS_WITH_MEMBERS)
+    if with_staffing:
+        qset = qset.with_staffing()
 
     for task in qset:  # type: Task
         if task.scheduled_date is None or task.work_start_time is None or task.work_duration is None:
@@ -535,49 +549,61 @@ def member_calendar(request, token):
     if member is None:
         raise Http404("No such calendar")
 
-    cal = _new_calendar("My Xerocraft Tasks")
-    for task in _gen_tasks_for(member):  # type: Task
-        _add_event(cal, task, request)
-        # TODO: Add ALARM
-    return _ical_response(cal)
+    def build():
+        cal = _new_calendar("My Xerocraft Tasks")
+        for task in _gen_tasks_for(member):  # type: Task
+            _add_event(cal, task, request)
+            # TODO: Add ALARM
+        return cal
+
+    # Feeds are cached, so polling calendar clients usually don't cause any task queries.
+    return feeds.feed_response(request, "member-{}".format(member.pk), build)
 
 
 def ops_calendar(request):
-    cal = _new_calendar("All {} Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        _add_event(cal, task, request)
-        # Intentionally lacks ALARM
-    return _ical_response(cal)
+    def build():
+        cal = _new_calendar("All {} Tasks".format(_ORG_NAME_POSSESSIVE))
+        for task in _gen_all_tasks():  # type: Task
+            _add_event(cal, task, request)
+            # Intentionally lacks ALARM
+        return cal
+    return feeds.feed_response(request, "ops", build)
 
 
 def ops_calendar_staffed(request) -> HttpResponse:
     """A calendar containing tasks that have been verified as staffed."""
-    cal = _new_calendar("{} Staffed Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        if task.is_fully_claimed and task.all_claims_verified():
-            _add_event(cal, task, request)
-            # Intentionally lacks ALARM
-    return _ical_response(cal)
+    def build():
+        cal = _new_calendar("{} Staffed Tasks".format(_ORG_NAME_POSSESSIVE))
+        for task in _gen_all_tasks(with_staffing=True):  # type: Task
+            if task.is_fully_claimed and task.all_claims_verified():
+                _add_event(cal, task, request)
+                # Intentionally lacks ALARM
+        return cal
+    return feeds.feed_response(request, "ops-staffed", build)
 
 
 def ops_calendar_provisional(request) -> HttpResponse:
     """A calendar containing provisionally staffed (i.e. claims not yet verified) tasks."""
-    cal = _new_calendar("{} Provisionally Staffed Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        if task.is_fully_claimed and not task.all_claims_verified():
-            _add_event(cal, task, request)
-            # Intentionally lacks ALARM
-    return _ical_response(cal)
+    def build():
+        cal = _new_calendar("{} Provisionally Staffed Tasks".format(_ORG_NAME_POSSESSIVE))
+        for task in _gen_all_tasks(with_staffing=True):  # type: Task
+            if task.is_fully_claimed and not task.all_claims_verified():
+                _add_event(cal, task, request)
+                # Intentionally lacks ALARM
+        return cal
+    return feeds.feed_response(request, "ops-provisional", build)
 
 
 def ops_calendar_unstaffed(request) -> HttpResponse:
     """A calendar containing tasks that are not even provisionally staffed."""
-    cal = _new_calendar("{} Unstaffed Tasks".format(_ORG_NAME_POSSESSIVE))
-    for task in _gen_all_tasks():  # type: Task
-        if not task.is_fully_claimed:
-            _add_event(cal, task, request)
-            # Intentionally lacks ALARM
-    return _ical_response(cal)
+    def build():
+        cal = _new_calendar("{} Unstaffed Tasks".format(_ORG_NAME_POSSESSIVE))
+        for task in _gen_all_tasks(with_staffing=True):  # type: Task
+            if not task.is_fully_claimed:
+                _add_event(cal, task, request)
+                # Intentionally lacks ALARM
+        return cal
+    return feeds.feed_response(request, "ops-unstaffed", build)
 
 
 def resource_calendar(request):
@@ -616,9 +642,10 @@ def desktop_timesheet(request):
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 # This will be used by the view, below, AND the management command that emails statements.
-def render_time_acct_statement_as_html(user:User, range:str) -> str:
-    # TODO: Need to drive creation of expirations more sensibly.
-    TimeAccountEntry.regenerate_expirations(user.member.worker)
+def render_time_acct_statement_as_html(user:User, range:str, regenerate_expirations:bool=True) -> str:
+    # Callers that have already regenerated everybody's expirations, e.g. email_statements, can skip this.
+    if regenerate_expirations:
+        TimeAccountEntry.regenerate_expirations(user.member.worker)
 
     subtitle = ""
     statement_start_datetime = timezone.now()  # type: datetime
@@ -631,17 +658,16 @@ def render_time_acct_statement_as_html(user:User, range:str) -> str:
     lines = TimeAccountEntry.objects.filter(
         worker=user.member.worker,
         when__gte=statement_start_datetime
-    ).order_by('when')
+    ).order_by('when', 'pk')
 
+    # Balances are maintained on the entries, so the statement is a single scan.
     if len(lines) > 0:
-        balance_forward = lines[0].balance - lines[0].change
+        balance_forward = lines[0].running_balance - lines[0].change
     else:
         balance_forward = Decimal("0.00")
-    balance = balance_forward
     for line in lines:  # type: TimeAccountEntry
         line.when = timezone.localtime(line.when)
-        balance += line.change
-        line.bal = balance
+        line.bal = line.running_balance
 
     args = {
         'user': user,